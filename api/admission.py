@@ -0,0 +1,117 @@
+import asyncio
+from contextlib import asynccontextmanager
+from functools import wraps
+
+import pymongo
+from fastapi import HTTPException
+
+from api.common import get_env_var
+from api.metrics import ADMISSION_QUEUED, ADMISSION_RUNNING, ADMISSION_SHED
+
+
+# Limits of the heavy computations: how many run at the same time, how many
+# more wait for a slot (the rest get a 503 right away), the seconds they
+# wait at most and the time budget of their Mongo queries (sent as
+# maxTimeMS). Override them like
+# APP_ADMISSION={"top_transactors": {"concurrency": 1, "max_time_ms": 5000}}
+ADMISSION_LIMITS = {
+    "transactions_base": {"concurrency": 8, "queue": 32, "max_wait": 10,
+                          "max_time_ms": 30000},
+    "stats_series": {"concurrency": 4, "queue": 16, "max_wait": 10,
+                     "max_time_ms": 30000},
+    "top_transactors": {"concurrency": 2, "queue": 8, "max_wait": 10,
+                        "max_time_ms": 20000}
+}
+
+for name, limits in (get_env_var("APP_ADMISSION", dict) or {}).items():
+    ADMISSION_LIMITS[name] = dict(ADMISSION_LIMITS.get(name, {}), **limits)
+
+# Seconds the shed requests are told to wait before retrying
+RETRY_AFTER = get_env_var("APP_ADMISSION_RETRY_AFTER", int) or 5
+
+
+class Admission:
+    """
+    Bounds the computations of a route running at the same time and the ones
+    waiting for them, and sheds the rest
+    """
+
+    def __init__(self, name, concurrency, queue=0, max_wait=None,
+                 max_time_ms=None):
+        self.name = name
+        self.queue = queue
+        self.max_wait = max_wait
+        self.max_time_ms = max_time_ms
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def shed(self, reason):
+        ADMISSION_SHED.inc((self.name, reason))
+        raise HTTPException(
+            status_code=503,
+            detail="Too many requests in progress, retry later",
+            headers={"Retry-After": str(RETRY_AFTER)})
+
+    @asynccontextmanager
+    async def slot(self):
+        if not self._semaphore.locked():
+            # a free slot is taken right away
+            await self._semaphore.acquire()
+        elif self.waiting >= self.queue:
+            self.shed("queue_full")
+        else:
+            self.waiting += 1
+            ADMISSION_QUEUED.inc((self.name, ))
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(),
+                                       self.max_wait)
+            except asyncio.TimeoutError:
+                self.shed("max_wait")
+            finally:
+                self.waiting -= 1
+                ADMISSION_QUEUED.dec((self.name, ))
+
+        ADMISSION_RUNNING.inc((self.name, ))
+        try:
+            if self.max_time_ms:
+                # every command within gets the time left as maxTimeMS
+                with pymongo.timeout(self.max_time_ms / 1000):
+                    yield
+            else:
+                yield
+        finally:
+            ADMISSION_RUNNING.dec((self.name, ))
+            self._semaphore.release()
+
+
+# Admission per name, made on their first use
+_admissions = {}
+
+
+def get_admission(name):
+    admission = _admissions.get(name)
+    if admission is None and name in ADMISSION_LIMITS:
+        admission = _admissions[name] = Admission(
+            name, **ADMISSION_LIMITS[name])
+    return admission
+
+
+def admitted(name):
+    """
+    Decorator that runs an async function within the admission limits of
+    the name, unlimited when it has none
+    """
+
+    def decorator(fnc):
+
+        @wraps(fnc)
+        async def wrapper(*args, **kwargs):
+            admission = get_admission(name)
+            if admission is None:
+                return await fnc(*args, **kwargs)
+            async with admission.slot():
+                return await fnc(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
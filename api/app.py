@@ -5,14 +5,26 @@ from fastapi.middleware.trustedhost import TrustedHostMiddleware
 from api.routers import operations
 from api.routers import fastbtc
 from api.routers import stats
+from api.routers import diagnosis
+from api.routers import live
 
 from api.models.base import InfoApi
 from api.logger import log
 from api.db import connect_and_init_db, close_db_connect
+from api.rollups import start_rollups, stop_rollups
+from api.live import stop_live
+from api.columnar import start_engine, stop_engine
+from api.cache import response_cache, pages_cache, \
+    StaleResponseMiddleware
+from api.conditional import ConditionalGetMiddleware, CONDITIONAL_PATHS
+from api.metrics import MetricsMiddleware, render as render_metrics
+from api.tenants import TenantMiddleware
+from api.ratelimit import RateLimitMiddleware
 
 from pymongo.errors import ServerSelectionTimeoutError as MongoTimeout
+from pymongo.errors import ExecutionTimeout, NetworkTimeout
 from fastapi import Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 
 from .common import get_env_var
 
@@ -45,12 +57,22 @@ app = FastAPI(
 )
 
 app.add_event_handler("startup", connect_and_init_db)
+app.add_event_handler("startup", start_rollups)
+app.add_event_handler("startup", start_engine)
+app.add_event_handler("shutdown", stop_rollups)
+app.add_event_handler("shutdown", stop_live)
+app.add_event_handler("shutdown", stop_engine)
 app.add_event_handler("shutdown", close_db_connect)
 
 app.include_router(operations.router)
 app.include_router(fastbtc.router)
+app.include_router(live.router)
 app.include_router(stats.router)
 
+# The query plans report is not public, set APP_DIAGNOSIS=True to serve it
+if get_env_var("APP_DIAGNOSIS", bool):
+    app.include_router(diagnosis.router)
+
 @app.exception_handler(MongoTimeout)
 async def db_error_exception_handler(request: Request,
                                      exc: MongoTimeout):
@@ -59,6 +81,21 @@ async def db_error_exception_handler(request: Request,
         content={"detail": "Cannot get DB access"},
     )    
 
+@app.exception_handler(ExecutionTimeout)
+@app.exception_handler(NetworkTimeout)
+async def db_timeout_exception_handler(request: Request, exc: Exception):
+    # the timeoutMS of the workload ran out
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "DB query timed out"},
+    )
+
+# Age / Warning headers of the responses served from stale results
+app.add_middleware(StaleResponseMiddleware)
+
+# ETag / Last-Modified validators and 304 answers
+app.add_middleware(ConditionalGetMiddleware)
+
 BACKEND_CORS_ORIGINS = get_env_var("BACKEND_CORS_ORIGINS", list)
 ALLOWED_HOSTS = get_env_var("ALLOWED_HOSTS", list)
 
@@ -79,6 +116,17 @@ if ALLOWED_HOSTS is not None:
     app.add_middleware(TrustedHostMiddleware,
                        allowed_hosts=[str(host) for host in ALLOWED_HOSTS])
 
+# Token bucket per client IP, weighted by the cost of each route
+app.add_middleware(RateLimitMiddleware)
+
+# Latency, size and shape of every request
+app.add_middleware(MetricsMiddleware,
+                   prefixes=[prefix for prefix, _ in CONDITIONAL_PATHS] +
+                            ["/api/v1/stats/"])
+
+# Resolves the tenant (protocol environment) of every request
+app.add_middleware(TenantMiddleware)
+
 
 log.info("Starting webservice API version: {0}".format(API_VERSION))
 
@@ -98,3 +146,22 @@ async def info_api():
 @app.get("/ping", tags=["Diagnosis"])
 async def ping():
     return "webAppAPI OK"
+
+
+@app.get("/cachestats", tags=["Diagnosis"])
+async def cache_stats():
+    """
+    Returns the hits, misses and size of the in-process response cache, and
+    of the one of the webapp pages under pages
+    """
+    return dict(response_cache.stats(), pages=pages_cache.stats())
+
+
+@app.get("/metrics", tags=["Diagnosis"], response_class=PlainTextResponse)
+async def metrics():
+    """
+    Returns the request, Mongo and cache metrics in the Prometheus text
+    format
+    """
+    return PlainTextResponse(render_metrics(),
+                             media_type="text/plain; version=0.0.4")
@@ -0,0 +1,332 @@
+import asyncio
+import inspect
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from enum import Enum
+from functools import partial, wraps
+
+from fastapi import HTTPException
+from pymongo.errors import PyMongoError
+
+from api.common import get_env_var
+from api.tenants import get_tenant
+
+
+# Seconds past their ttl that results are served while they are computed
+# again in the background, and served when computing them fails because
+# Mongo is unavailable
+STALE_WHILE_REVALIDATE = get_env_var("APP_CACHE_STALE_WHILE_REVALIDATE",
+                                     (int, float))
+if STALE_WHILE_REVALIDATE is None:
+    STALE_WHILE_REVALIDATE = 300
+STALE_IF_ERROR = get_env_var("APP_CACHE_STALE_IF_ERROR", (int, float))
+if STALE_IF_ERROR is None:
+    STALE_IF_ERROR = 86400
+
+# Warning codes of the stale responses
+REVALIDATING = 110
+REVALIDATION_FAILED = 111
+
+# Age and warning of the stale results the request being answered got,
+# filled by the cache in the dict StaleResponseMiddleware sets
+stale_response: ContextVar = ContextVar("stale_response", default=None)
+
+
+def is_unavailable(exc):
+    """
+    Returns whether the exception comes from Mongo being down or too slow
+    """
+    return isinstance(exc, PyMongoError) or \
+        (isinstance(exc, HTTPException) and exc.status_code == 503)
+
+
+def mark_stale(age, warning):
+    state = stale_response.get()
+    if state is None:
+        return
+    state["age"] = max(state.get("age", 0), int(age))
+    state["warning"] = max(state.get("warning", 0), warning)
+
+
+def estimate_size(value, sample=8):
+    """
+    Returns roughly the bytes of the value as JSON, long lists are measured
+    from a sample of their items
+    """
+    if isinstance(value, dict):
+        return 2 + sum(len(str(k)) + 4 + estimate_size(v, sample)
+                       for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        if len(value) > sample:
+            return 2 + len(value) * sum(
+                estimate_size(v, sample) + 1 for v in value[:sample]) \
+                // sample
+        return 2 + sum(estimate_size(v, sample) + 1 for v in value)
+    return len(str(value))
+
+
+class TotalsCache:
+    """
+    Memoizes the total of documents matching a list filter.
+
+    Each total is stored along with a marker of the newest matching document
+    (its blockNumber and _id), when a newer document shows up the marker no
+    longer matches and the total has to be counted again. Entries also
+    expire after ttl seconds and the least recently used are evicted once
+    there are more than max_entries.
+    """
+
+    def __init__(self, max_entries=10000, ttl=600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def peek(self, key):
+        """
+        Returns the (marker, total) stored for the key or None
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        marker, total, expires = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return marker, total
+
+    def get(self, key, marker):
+        entry = self.peek(key)
+        if entry is None or entry[0] != marker:
+            return None
+        return entry[1]
+
+    def set(self, key, marker, total):
+        self._entries[key] = (marker, total, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+class ResponseCache:
+    """
+    Async cache of computed results.
+
+    Entries are fresh for the ttl given when they are computed. Past it they
+    are served for stale_while_revalidate more seconds while a background
+    computation replaces them, and for stale_if_error seconds when computing
+    them again fails because Mongo is unavailable. The least recently used
+    are evicted once there are more than max_entries or their estimated size
+    goes over max_bytes. Requests are coalesced: while a key is being
+    computed the rest of the callers await the very same result, so only one
+    computation per key runs at a time.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=64 * 2**20,
+                 stale_while_revalidate=0, stale_if_error=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.stale_hits = 0
+        self.stale_errors = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "stale_hits": self.stale_hits,
+            "stale_errors": self.stale_errors,
+            "entries": len(self._entries),
+            "bytes": self.size
+        }
+
+    def get(self, key):
+        """
+        Returns the (value, fresh_until, stored_at, size) of the key, also
+        when it is stale, or None
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, fresh_until, stored_at, size = entry
+        if fresh_until + max(self.stale_while_revalidate,
+                             self.stale_if_error) < time.monotonic():
+            self._discard(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    async def get_or_compute(self, key, compute, ttl):
+        """
+        Returns the cached value of the key or awaits compute() for it
+        """
+
+        now = time.monotonic()
+        entry = self.get(key)
+        if entry is not None:
+            value, fresh_until, stored_at, size = entry
+            if now < fresh_until:
+                self.hits += 1
+                return value
+            # results cached for no time are only kept for the errors
+            if ttl and now < fresh_until + self.stale_while_revalidate:
+                self.stale_hits += 1
+                if key not in self._pending:
+                    self._compute(key, compute, ttl)
+                mark_stale(now - stored_at, REVALIDATING)
+                return value
+
+        task = self._pending.get(key)
+        if task is None:
+            self.misses += 1
+            task = self._compute(key, compute, ttl)
+        else:
+            self.coalesced += 1
+
+        try:
+            # a caller that goes away must not cancel the computation the
+            # rest of the callers are waiting for
+            return await asyncio.shield(task)
+        except Exception as e:
+            if entry is None or not is_unavailable(e) or \
+                    now > entry[1] + self.stale_if_error:
+                raise
+            self.stale_errors += 1
+            mark_stale(now - entry[2], REVALIDATION_FAILED)
+            return entry[0]
+
+    def _compute(self, key, compute, ttl):
+        task = asyncio.ensure_future(compute())
+        self._pending[key] = task
+        task.add_done_callback(partial(self._computed, key, ttl))
+        return task
+
+    def _computed(self, key, ttl, task):
+        self._pending.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        self.set(key, task.result(), ttl)
+
+    def set(self, key, value, ttl):
+        if not ttl and not self.stale_if_error:
+            return
+        self._discard(key)
+        size = estimate_size(value)
+        now = time.monotonic()
+        self._entries[key] = (value, now + ttl, now, size)
+        self.size += size
+        while self._entries and (len(self._entries) > self.max_entries or
+                                 self.size > self.max_bytes):
+            self._discard(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[3]
+
+
+def cache_key(name, fnc, args, kwargs):
+    """
+    Returns a key made of the name, the tenant and the normalized arguments
+    of the call, enums stand for their values, lists for tuples and defaults
+    are filled in
+    """
+    bound = inspect.signature(fnc).bind(*args, **kwargs)
+    bound.apply_defaults()
+    normalize = lambda v: v.value if isinstance(v, Enum) else \
+        tuple(normalize(i) for i in v) if isinstance(v, list) else v
+    return (name, get_tenant()["name"]) + tuple(
+        (k, normalize(v)) for k, v in bound.arguments.items())
+
+
+def cached(name, ttl, cache=None):
+    """
+    Decorator that caches the results of an async function in the cache
+    given (response_cache by default), the ttl can be overridden with
+    APP_CACHE_TTL. With a ttl of 0 every call computes them again and the
+    last one is only kept to be served when Mongo is unavailable.
+    """
+
+    def decorator(fnc):
+
+        @wraps(fnc)
+        async def wrapper(*args, **kwargs):
+            store = cache if cache is not None else response_cache
+            seconds = (CACHE_TTL or {}).get(name, ttl)
+            if not seconds and not store.stale_if_error:
+                return await fnc(*args, **kwargs)
+            return await store.get_or_compute(
+                cache_key(name, fnc, args, kwargs),
+                lambda: fnc(*args, **kwargs),
+                seconds)
+
+        return wrapper
+
+    return decorator
+
+
+# seconds per cached function, like {"transactions_base": 60}
+CACHE_TTL = get_env_var("APP_CACHE_TTL", dict)
+
+response_cache = ResponseCache(
+    max_entries=get_env_var("APP_CACHE_MAX_ENTRIES", int) or 1000,
+    max_bytes=get_env_var("APP_CACHE_MAX_BYTES", int) or 64 * 2**20,
+    stale_while_revalidate=STALE_WHILE_REVALIDATE,
+    stale_if_error=STALE_IF_ERROR)
+
+# Last good webapp pages (one per address, page and fields) only kept to be
+# served when Mongo is unavailable, apart so they never evict the results
+# of response_cache
+pages_cache = ResponseCache(
+    max_entries=get_env_var("APP_CACHE_PAGES_MAX_ENTRIES", int) or 500,
+    max_bytes=get_env_var("APP_CACHE_PAGES_MAX_BYTES", int) or 8 * 2**20,
+    stale_if_error=STALE_IF_ERROR)
+
+
+class StaleResponseMiddleware:
+    """
+    Adds the Age and Warning headers to the responses built from stale
+    results of the cache
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        state = {}
+        token = stale_response.set(state)
+
+        async def send_with_age(message):
+            if message['type'] == 'http.response.start' and state:
+                text = "Revalidation Failed" \
+                    if state["warning"] == REVALIDATION_FAILED \
+                    else "Response is Stale"
+                message = dict(message)
+                message['headers'] = list(message.get('headers', [])) + [
+                    (b'age', str(state["age"]).encode()),
+                    (b'warning',
+                     f'{state["warning"]} - "{text}"'.encode())
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_age)
+        finally:
+            stale_response.reset(token)
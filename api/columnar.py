@@ -0,0 +1,452 @@
+import asyncio
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from api.common import get_env_var
+from api.db import get_db
+from api.logger import log
+from api.models.stats import (TransactionsCountType, TransactionsCountFnc,
+                              TransactionsCountEvent, EVENT_NAMES)
+from api.rollups import bucket_date, window_since
+from api.tenants import TENANTS, get_tenant, use_tenant
+
+
+# Set APP_STATS_ENGINE=numpy to answer the stats from columns of the
+# transactions kept in memory and synced every APP_STATS_ENGINE_INTERVAL
+# seconds. It needs numpy, which is not in the requirements.
+STATS_ENGINE = get_env_var("APP_STATS_ENGINE", str)
+SYNC_INTERVAL = get_env_var("APP_STATS_ENGINE_INTERVAL", (int, float)) or 5
+
+# Documents read per round trip while syncing
+SYNC_BATCH_SIZE = 10000
+
+# Wei amounts are kept as the whole units of WEI and the wei left, both
+# fit an int64, and summed split in int64 limbs of LIMB wei at most
+WEI = 10**18
+LIMB = 10**9
+
+EPOCH = datetime(1970, 1, 1)
+EPOCH_DAY = EPOCH.date()
+MS_PER_DAY = 86400000
+
+# Fields of the transactions the columns keep
+SNAPSHOT_PROJECTION = {
+    'confirmationTime': 1,
+    'createdAt': 1,
+    'amount': 1,
+    'USDAmount': 1,
+    'tokenInvolved': 1,
+    'event': 1,
+    'address': 1,
+    'lastUpdatedAt': 1
+}
+
+_task: asyncio.Task = None
+
+# Snapshot per tenant name
+_snapshots = {}
+
+
+def to_ms(value):
+    """
+    Returns the milliseconds since the epoch of a datetime or date, None for
+    anything else
+    """
+    if isinstance(value, datetime):
+        return (value - EPOCH) // timedelta(milliseconds=1)
+    if isinstance(value, date):
+        return (value - EPOCH_DAY).days * MS_PER_DAY
+    return None
+
+
+def lower(value):
+    """
+    Returns the string in lower case, '' for anything else like $toLower
+    """
+    return value.lower() if isinstance(value, str) else ''
+
+
+def to_wei(value):
+    """
+    Returns the wei amount (a string, Decimal128 or number) as an int, 0 for
+    a missing one like $sum does
+    """
+    if value is None:
+        return 0
+    try:
+        return int(Decimal(str(value)))
+    except (InvalidOperation, ValueError):
+        return 0
+
+
+def wei_sums(indexes, whole, rest, size):
+    """
+    Returns the exact sums, as ints, of the wei amounts split in whole and
+    rest of each one of the size indexes
+    """
+    sums = []
+    for values, scale in [(whole, WEI), (rest // LIMB, LIMB),
+                          (rest % LIMB, 1)]:
+        limb = np.zeros(size, np.int64)
+        np.add.at(limb, indexes, values)
+        sums.append(limb.astype(object) * scale)
+    return sums[0] + sums[1] + sums[2]
+
+
+class Codes:
+    """
+    Integer code of each distinct string
+    """
+
+    def __init__(self):
+        self.values = []
+        self._codes = {}
+
+    def code(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def get(self, value):
+        return self._codes.get(value)
+
+
+class Snapshot:
+    """
+    Columns of the stats fields of every transaction of a tenant: datetimes
+    as int64 milliseconds (MISSING when null), wei amounts exact as the int64
+    whole units of WEI and the wei left, and codes for the token, event and
+    address (in lower case) strings. The first load appends every document
+    and sorts the rows by _id once, the later syncs append the new ones or
+    replace them in place when updated, from the lastUpdatedAt watermark.
+    Their row is found through the sorted array of the 12 bytes of their
+    _id.
+    """
+
+    MISSING = -2**63
+
+    COLUMNS = {
+        'times': 'int64',
+        'created': 'int64',
+        'amounts': 'int64',
+        'amounts_wei': 'int64',
+        'usd': 'int64',
+        'usd_wei': 'int64',
+        'tokens': 'int16',
+        'events': 'int16',
+        'addresses': 'int32'
+    }
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.columns = {name: np.zeros(capacity, dtype)
+                        for name, dtype in self.COLUMNS.items()}
+        self.tokens = Codes()
+        self.events = Codes()
+        self.addresses = Codes()
+        self.ready = False
+        # sorted _ids and the row of each
+        self._ids = np.zeros(0, 'S12')
+        self._id_rows = np.zeros(0, np.int64)
+        # _ids of the rows appended and not indexed yet
+        self._appended = []
+        # latest lastUpdatedAt synced
+        self._mark = None
+
+    @property
+    def synced_until(self):
+        """
+        The latest lastUpdatedAt synced
+        """
+        return self._mark
+
+    def column(self, name):
+        return self.columns[name][:self.size]
+
+    def _grow(self, size):
+        capacity = len(self.columns['times'])
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for name, values in self.columns.items():
+            grown = np.zeros(capacity, values.dtype)
+            grown[:self.size] = values[:self.size]
+            self.columns[name] = grown
+
+    def row(self, document):
+        times = to_ms(document.get('confirmationTime'))
+        created = to_ms(document.get('createdAt'))
+        amount = divmod(to_wei(document.get('amount')), WEI)
+        usd = divmod(to_wei(document.get('USDAmount')), WEI)
+        return {
+            'times': self.MISSING if times is None else times,
+            'created': self.MISSING if created is None else created,
+            'amounts': amount[0],
+            'amounts_wei': amount[1],
+            'usd': usd[0],
+            'usd_wei': usd[1],
+            'tokens': self.tokens.code(document.get('tokenInvolved')),
+            'events': self.events.code(document.get('event')),
+            'addresses': self.addresses.code(lower(document.get('address')))
+        }
+
+    def append(self, documents):
+        """
+        Appends the documents as new rows, their _ids are indexed at once by
+        index_rows after the last ones
+        """
+        if not documents:
+            return
+        rows = [self.row(d) for d in documents]
+        self._grow(self.size + len(rows))
+        for name, column in self.columns.items():
+            column[self.size:self.size + len(rows)] = np.array(
+                [row[name] for row in rows], column.dtype)
+        self._appended.append(
+            np.array([d['_id'].binary for d in documents], 'S12'))
+        self.size += len(rows)
+
+    def index_rows(self):
+        """
+        Sorts the appended rows by _id, keeping the last version of the ones
+        appended more than once, and builds the _id index over them
+        """
+        ids = np.concatenate(self._appended) if self._appended \
+            else np.zeros(0, 'S12')
+        self._appended = []
+        order = np.argsort(ids, kind='stable')
+        ids = ids[order]
+        last = np.append(ids[1:] != ids[:-1], True)
+        rows = order[last]
+        for name, column in self.columns.items():
+            column[:len(rows)] = column[rows]
+        self.size = len(rows)
+        self._ids = ids[last]
+        self._id_rows = np.arange(self.size, dtype=np.int64)
+
+    def upsert(self, documents):
+        # the last version of each _id
+        latest = {d['_id'].binary: d for d in documents}
+        if not latest:
+            return
+        ids = np.array(list(latest), 'S12')
+        rows = [self.row(d) for d in latest.values()]
+
+        positions = np.searchsorted(self._ids, ids)
+        found = positions < len(self._ids)
+        found[found] = self._ids[positions[found]] == ids[found]
+        existing = self._id_rows[positions[found]]
+        new = ~found
+        count = int(new.sum())
+
+        self._grow(self.size + count)
+        for name, column in self.columns.items():
+            values = np.array([row[name] for row in rows], column.dtype)
+            column[existing] = values[found]
+            column[self.size:self.size + count] = values[new]
+
+        if count:
+            order = np.argsort(ids[new])
+            new_ids = ids[new][order]
+            new_rows = np.arange(self.size, self.size + count)[order]
+            at = np.searchsorted(self._ids, new_ids)
+            self._ids = np.insert(self._ids, at, new_ids)
+            self._id_rows = np.insert(self._id_rows, at, new_rows)
+        self.size += count
+
+    async def sync(self, db):
+        """
+        Loads every transaction the first time, then the ones written since
+        the previous sync
+        """
+        collection = db["Transaction"]
+
+        if self._mark is None:
+            # the watermark goes first, the writes during the scan are
+            # synced again next. The rows are indexed once after the scan.
+            latest = await collection\
+                .find({'lastUpdatedAt': {'$ne': None}}, {'lastUpdatedAt': 1})\
+                .sort('lastUpdatedAt', -1)\
+                .limit(1)\
+                .to_list(1)
+            mark = latest[0]['lastUpdatedAt'] if latest else EPOCH
+            cursor = collection.find({}, SNAPSHOT_PROJECTION,
+                                     batch_size=SYNC_BATCH_SIZE)
+            while True:
+                documents = await cursor.to_list(SYNC_BATCH_SIZE)
+                if not documents:
+                    break
+                self.append(documents)
+            self.index_rows()
+            self._mark = mark
+
+        # pages over (lastUpdatedAt, _id), the first one from the mark
+        # again since the writes of its millisecond can land after a sync
+        query = {'lastUpdatedAt': {'$gte': self._mark}}
+        while True:
+            documents = await collection\
+                .find(query, SNAPSHOT_PROJECTION)\
+                .sort([('lastUpdatedAt', 1), ('_id', 1)])\
+                .limit(SYNC_BATCH_SIZE)\
+                .to_list(SYNC_BATCH_SIZE)
+            self.upsert(documents)
+            if documents:
+                last = documents[-1]
+                self._mark = last['lastUpdatedAt']
+                query = {'$or': [
+                    {'lastUpdatedAt': {'$gt': last['lastUpdatedAt']}},
+                    {'lastUpdatedAt': last['lastUpdatedAt'],
+                     '_id': {'$gt': last['_id']}}
+                ]}
+            if len(documents) < SYNC_BATCH_SIZE:
+                break
+
+        self.ready = True
+
+    def match(self, token=None, events=None):
+        """
+        Returns the mask of the confirmed transactions of the tokenInvolved
+        and events given
+        """
+        mask = self.column('times') != self.MISSING
+        if token is not None:
+            code = self.tokens.get(token)
+            mask &= self.column('tokens') == (-1 if code is None else code)
+        if events is not None:
+            codes = [self.events.get(e) for e in events]
+            mask &= np.isin(self.column('events'),
+                            [c for c in codes if c is not None])
+        return mask
+
+    def count_by_date(self, type, token=None, events=None, group_by=None,
+                      fnc=TransactionsCountFnc.COUNT, since=None,
+                      until=None):
+        """
+        Returns a sorted list of (date, value) like the transactions_base
+        aggregation
+        """
+        times = self.column('times')
+        mask = self.match(token, events)
+        if until is not None:
+            mask &= times < to_ms(until + timedelta(days=1))
+
+        sum_ = False
+        if type==TransactionsCountType.ALL:
+            if since is not None:
+                mask &= times >= to_ms(since)
+            selected = times[mask]
+            sum_ = fnc==TransactionsCountFnc.SUM
+        else:
+            # earliest confirmation of each address
+            first = np.full(len(self.addresses.values),
+                            np.iinfo(np.int64).max)
+            np.minimum.at(first, self.column('addresses')[mask],
+                          times[mask])
+            selected = first[first != np.iinfo(np.int64).max]
+            if since is not None:
+                selected = selected[selected >= to_ms(since)]
+
+        if not len(selected):
+            return []
+
+        days = selected // MS_PER_DAY
+        start = days.min()
+        counts = np.bincount(days - start)
+        values = counts.astype(object)
+        if sum_:
+            values = wei_sums(days - start, self.column('amounts')[mask],
+                              self.column('amounts_wei')[mask], len(counts))
+
+        buckets = {}
+        for i in np.flatnonzero(counts):
+            key = bucket_date(EPOCH_DAY + timedelta(days=int(start + i)),
+                              group_by)
+            buckets[key] = buckets.get(key, 0) + values[i]
+
+        return [(key, buckets[key]) for key in sorted(buckets)]
+
+    def top_transactors(self, days, top, rank_by):
+        """
+        Returns a list of (address, count, volume) of the top transactors of
+        the mints and redeems of the last days, like the top_transactors
+        aggregation
+        """
+        events = EVENT_NAMES[TransactionsCountEvent.ONLY_MINT_AND_REDEEM]
+        codes = [self.events.get(e) for e in events]
+        mask = np.isin(self.column('events'),
+                       [c for c in codes if c is not None])
+        mask &= self.column('created') >= to_ms(window_since(days))
+
+        addresses = self.column('addresses')[mask]
+        size = len(self.addresses.values)
+        counts = np.bincount(addresses, minlength=size)
+        volumes = wei_sums(addresses, self.column('usd')[mask],
+                           self.column('usd_wei')[mask], size)
+
+        ranked = counts if rank_by == 'count' else volumes
+        candidates = np.flatnonzero(counts)
+        order = candidates[np.argsort(-ranked[candidates], kind='stable')]
+
+        return [(self.addresses.values[i], int(counts[i]), volumes[i])
+                for i in order[:top]]
+
+
+def ready_snapshot():
+    """
+    Returns the synced Snapshot of the current tenant, None when the engine
+    is disabled or still loading
+    """
+    snapshot = _snapshots.get(get_tenant()["name"])
+    if snapshot is None or not snapshot.ready:
+        return None
+    return snapshot
+
+
+async def engine_loop(interval):
+    while True:
+        for tenant in TENANTS.values():
+            try:
+                with use_tenant(tenant):
+                    db = await get_db("rollups")
+                    if db is not None:
+                        await _snapshots[tenant["name"]].sync(db)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.exception(f'Could not sync the stats engine of '
+                              f'{tenant["name"]}: {e}')
+        await asyncio.sleep(interval)
+
+
+async def start_engine():
+    """
+    Starts syncing the columns when APP_STATS_ENGINE=numpy
+    """
+    global _task
+    if STATS_ENGINE != 'numpy':
+        return
+    if np is None:
+        log.warning("APP_STATS_ENGINE=numpy needs numpy installed, the "
+                    "stats are answered by Mongo.")
+        return
+    for tenant in TENANTS.values():
+        _snapshots[tenant["name"]] = Snapshot()
+    _task = asyncio.create_task(engine_loop(SYNC_INTERVAL))
+    log.info(f"Stats engine syncing every {SYNC_INTERVAL}s.")
+
+
+async def stop_engine():
+    global _task
+    if _task is None:
+        return
+    _task.cancel()
+    _task = None
+    _snapshots.clear()
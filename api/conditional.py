@@ -0,0 +1,156 @@
+import asyncio
+import hashlib
+import time
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from bson import ObjectId
+
+from api.db import get_db
+from api.logger import log
+from api.tenants import get_tenant, route_path
+
+
+# Field that moves forward on every write of the indexer, per collection.
+# The inserts are also followed through the newest _id, the pegouts only get
+# their updated field once they change.
+WATERMARK_FIELDS = {
+    "Transaction": "lastUpdatedAt",
+    "FastBtcBridge": "updated"
+}
+
+# Path prefixes served with validators and the collection they read. The
+# stats are not, their bodies come from the response cache or the rollups,
+# which lag behind the watermark, so a fresh validator could be given to an
+# old body.
+CONDITIONAL_PATHS = [
+    ("/api/v1/webapp/transactions/list/", "Transaction"),
+    ("/api/v1/webapp/fastbtc/pegout/", "FastBtcBridge")
+]
+
+# Every poll within this many seconds shares one watermark query
+WATERMARK_TTL = 1.0
+
+_watermarks = {}
+
+
+async def watermark(db, collection):
+    """
+    Returns the latest write time of the collection and its newest _id, or
+    None when it is empty
+    """
+    key = (get_tenant()["name"], collection)
+    cached = _watermarks.get(key)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+
+    field = WATERMARK_FIELDS[collection]
+    latest, newest = await asyncio.gather(
+        db[collection]
+            .find({field: {'$ne': None}}, {field: 1, '_id': 0})
+            .sort(field, -1)
+            .limit(1)
+            .to_list(1),
+        db[collection]
+            .find({}, {'_id': 1})
+            .sort('_id', -1)
+            .limit(1)
+            .to_list(1))
+
+    times = [latest[0][field]] if latest else []
+    if newest and isinstance(newest[0]['_id'], ObjectId):
+        times.append(newest[0]['_id'].generation_time.replace(tzinfo=None))
+    mark = None
+    if times:
+        mark = (max(times), str(newest[0]['_id']) if newest else '')
+
+    _watermarks[key] = (mark, time.monotonic() + WATERMARK_TTL)
+    return mark
+
+
+def make_etag(tenant, scope, mark, newest_id):
+    data = '|'.join([tenant, scope.get('root_path', ''), scope['path'],
+                     scope.get('query_string', b'').decode('latin-1'),
+                     mark.isoformat(), newest_id])
+    return 'W/"' + hashlib.sha1(data.encode()).hexdigest() + '"'
+
+
+def is_not_modified(headers, etag, mark):
+    if_none_match = headers.get(b'if-none-match')
+    if if_none_match is not None:
+        tags = [t.strip() for t in if_none_match.decode('latin-1').split(',')]
+        return '*' in tags or etag in tags or etag[2:] in tags
+    if_modified_since = headers.get(b'if-modified-since')
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since.decode('latin-1'))
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return mark.replace(microsecond=0, tzinfo=timezone.utc) <= since
+    return False
+
+
+class ConditionalGetMiddleware:
+    """
+    Adds ETag / Last-Modified validators built from the watermark of the
+    collection behind the route and answers 304 Not Modified, without
+    running the route at all, when the client already has them.
+
+    The watermark is read before the route runs, so a response is never
+    newer than its validator claims. Responses served from the in-process
+    cache may be older, those get their fresh copy with the next write of
+    the indexer.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+
+        if scope['type'] != 'http' or scope['method'] not in ['GET', 'HEAD']:
+            await self.app(scope, receive, send)
+            return
+
+        collection = None
+        for prefix, c in CONDITIONAL_PATHS:
+            if route_path(scope).startswith(prefix):
+                collection = c
+                break
+
+        db = await get_db() if collection is not None else None
+        mark = None
+        if db is not None:
+            try:
+                mark = await watermark(db, collection)
+            except Exception as e:
+                log.warning(f'Could not read the {collection} watermark: {e}')
+
+        if mark is None:
+            await self.app(scope, receive, send)
+            return
+
+        mark, newest_id = mark
+        etag = make_etag(get_tenant()["name"], scope, mark, newest_id)
+        validators = [
+            (b'etag', etag.encode('latin-1')),
+            (b'last-modified', format_datetime(
+                mark.replace(tzinfo=timezone.utc), usegmt=True).encode())
+        ]
+
+        if is_not_modified(dict(scope['headers']), etag, mark):
+            await send({'type': 'http.response.start', 'status': 304,
+                        'headers': validators})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        async def send_with_validators(message):
+            if message['type'] == 'http.response.start' \
+                    and message['status'] == 200:
+                message = dict(message)
+                message['headers'] = list(message.get('headers', [])) + \
+                    validators
+            await send(message)
+
+        await self.app(scope, receive, send_with_validators)
@@ -1,42 +1,74 @@
-from os import getenv
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
 from dotenv import load_dotenv
 
 from api.logger import log
+from api.common import get_env_var
+from api.indexes import check_indexes
+from api.metrics import mongo_listeners
+from api.tenants import TENANTS, get_tenant, use_tenant
 
 load_dotenv()
 
-db_client: AsyncIOMotorClient = None
+# Clients per (APP_MONGO_URI, workload), the tenants with the same URI share
+# them. The None workload is the default one of the URI.
+db_clients = {}
 
-VENDOR_ADDRESS = getenv("VENDOR_ADDRESS", default="0x")
-COMMISSION_SPLITTER_V2 = getenv("COMMISSION_SPLITTER_V2", default="0x")
+# pymongo client options per workload, like
+# {"stats": {"readPreference": "secondaryPreferred", "maxPoolSize": 10,
+#            "timeoutMS": 30000},
+#  "webapp": {"readPreference": "primaryPreferred", "timeoutMS": 2000}}
+# "default" applies to the rest of the queries.
+MONGO_WORKLOADS = get_env_var("APP_MONGO_WORKLOADS", dict) or {}
 
 
-async def get_db() -> AsyncIOMotorClient:
-    db_name = getenv("APP_MONGO_DB", default="example")
-    if db_client is None:
+async def get_db(workload: str = None) -> AsyncIOMotorClient:
+    """
+    Returns the database of the current tenant through the client of the
+    workload (webapp, stats, rollups) or the default one
+    """
+    tenant = get_tenant()
+    uri = tenant["APP_MONGO_URI"]
+    client = db_clients.get((uri, workload)) or db_clients.get((uri, None))
+    if client is None:
         log.warning('Connection is None, nothing to get.')
         return
-    return db_client[db_name]
+    return client[tenant["APP_MONGO_DB"]]
+
+
+def make_client(uri, options):
+    return AsyncIOMotorClient(uri, event_listeners=mongo_listeners(),
+                              **options)
 
 
 async def connect_and_init_db():
-    global db_client
     try:
-        db_client = AsyncIOMotorClient(getenv("APP_MONGO_URI", default="mongodb://localhost:27017"))
-        server_info = await db_client.server_info()
-        log.info(f"Connected to mongo! (version {server_info['version']}).")
+        for uri in sorted(set(t["APP_MONGO_URI"] for t in TENANTS.values())):
+            if (uri, None) in db_clients:
+                continue
+            db_clients[(uri, None)] = make_client(
+                uri, MONGO_WORKLOADS.get("default", {}))
+            for workload, options in MONGO_WORKLOADS.items():
+                if workload != "default":
+                    db_clients[(uri, workload)] = make_client(uri, options)
+            server_info = await db_clients[(uri, None)].server_info()
+            log.info(f"Connected to mongo! (version {server_info['version']}).")
+        for workload, options in MONGO_WORKLOADS.items():
+            log.info(f"Mongo clients of the {workload} workload: {options}.")
+        for tenant in TENANTS.values():
+            with use_tenant(tenant):
+                await check_indexes(
+                    await get_db(),
+                    create=bool(get_env_var("APP_CREATE_INDEXES", bool)))
     except Exception as e:
         log.exception(f'Could not connect to mongo: {e}')
         raise
 
 
 async def close_db_connect():
-    global db_client
-    if db_client is None:
+    if not db_clients:
         log.warning('Connection is None, nothing to close.')
         return
-    db_client.close()
-    db_client = None
+    for client in db_clients.values():
+        client.close()
+    db_clients.clear()
     log.info('Mongo connection closed.')
-
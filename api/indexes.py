@@ -0,0 +1,110 @@
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.collation import Collation, CollationStrength
+
+from api.logger import log
+
+
+# The indexer stores addresses as it receives them (checksummed or not), so
+# lookups compare them case-insensitively through this collation. A query
+# only uses a collated index when it is issued with the very same collation.
+ADDRESS_COLLATION = Collation(locale='en',
+                              strength=CollationStrength.SECONDARY)
+
+
+INDEXES = {
+    "Transaction": [
+        IndexModel([("address", ASCENDING), ("createdAt", DESCENDING),
+                    ("_id", DESCENDING)],
+                   name="address_ci_createdAt_id",
+                   collation=ADDRESS_COLLATION),
+        # high-water mark of the stats rollups
+        IndexModel([("lastUpdatedAt", DESCENDING)],
+                   name="lastUpdatedAt"),
+        IndexModel([("confirmationTime", ASCENDING)],
+                   name="confirmationTime"),
+        IndexModel([("tokenInvolved", ASCENDING), ("event", ASCENDING),
+                    ("confirmationTime", ASCENDING)],
+                   name="tokenInvolved_event_confirmationTime"),
+        IndexModel([("event", ASCENDING), ("createdAt", ASCENDING)],
+                   name="event_createdAt")
+    ],
+    "FastBtcBridge": [
+        IndexModel([("rskAddress", ASCENDING), ("type", ASCENDING),
+                    ("timestamp", DESCENDING), ("_id", DESCENDING)],
+                   name="rskAddress_ci_type_timestamp_id",
+                   collation=ADDRESS_COLLATION),
+        # watermark of the conditional responses
+        IndexModel([("updated", DESCENDING)],
+                   name="updated")
+    ]
+}
+
+
+# Index expected to back each query shape issued by the routers, the
+# diagnosis endpoint explains a canonical instance of each one
+QUERY_INDEXES = {
+    "transactions_list": ("Transaction", "address_ci_createdAt_id"),
+    "peg_out_list": ("FastBtcBridge", "rskAddress_ci_type_timestamp_id"),
+    "stats_token_event": ("Transaction",
+                          "tokenInvolved_event_confirmationTime"),
+    "stats_confirmation_time": ("Transaction", "confirmationTime"),
+    "top_transactors": ("Transaction", "event_createdAt"),
+    "rollups_high_water_mark": ("Transaction", "lastUpdatedAt"),
+    "peg_out_watermark": ("FastBtcBridge", "updated")
+}
+
+
+async def missing_indexes(db):
+    """
+    Returns a list of (collection, index name) of the indexes that are not
+    present in the database
+    """
+    missing = []
+    for collection, indexes in INDEXES.items():
+        existing = await db[collection].index_information()
+        for index in indexes:
+            name = index.document["name"]
+            if name not in existing:
+                missing.append((collection, name))
+    return missing
+
+
+async def create_indexes(db):
+    """
+    Creates the indexes. Existing documents do not need any backfill for the
+    case-insensitive address ones because the collation is applied by the
+    index itself.
+    """
+    for collection, indexes in INDEXES.items():
+        names = await db[collection].create_indexes(indexes)
+        log.info(f"Indexes {names} ready on {collection}.")
+
+
+async def check_indexes(db, create=False):
+    missing = await missing_indexes(db)
+    if not missing:
+        return
+    if create:
+        await create_indexes(db)
+        return
+    for collection, name in missing:
+        log.warning(f"Missing index {name} on {collection}, its queries "
+                    "will scan the whole collection. Run "
+                    "`python -m api.indexes` or set APP_CREATE_INDEXES=True.")
+
+
+if __name__ == '__main__':
+
+    import asyncio
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from api.tenants import TENANTS
+
+    async def main():
+        for tenant in TENANTS.values():
+            client = AsyncIOMotorClient(tenant["APP_MONGO_URI"])
+            try:
+                await create_indexes(client[tenant["APP_MONGO_DB"]])
+            finally:
+                client.close()
+
+    asyncio.run(main())
@@ -0,0 +1,244 @@
+import asyncio
+
+from pymongo.errors import OperationFailure
+
+from api.common import get_env_var
+from api.conditional import WATERMARK_FIELDS
+from api.db import get_db
+from api.logger import log
+from api.metrics import LIVE_SUBSCRIBERS, LIVE_EVENTS, LIVE_DROPPED
+from api.models.common import model_document
+from api.models.fastbtc import FastBtcBridge
+from api.models.operations import Transactions
+from api.tenants import get_tenant, use_tenant
+
+
+# Collections pushed to the subscribers, with the field that holds the
+# address a document belongs to and the model that shapes it
+LIVE_COLLECTIONS = {
+    "Transaction": ("address", Transactions),
+    "FastBtcBridge": ("rskAddress", FastBtcBridge)
+}
+
+# Seconds between the polls of the collections when change streams are not
+# available (standalone mongod)
+POLL_INTERVAL = get_env_var("APP_LIVE_POLL_INTERVAL", (int, float)) or 1.0
+
+# Events waiting per subscriber, one that falls further behind is dropped
+# and has to reconnect
+QUEUE_SIZE = get_env_var("APP_LIVE_QUEUE_SIZE", int) or 100
+
+# Documents read per collection on every poll
+POLL_BATCH_SIZE = 1000
+
+# Code of the error of the servers without change streams (standalone)
+NO_CHANGE_STREAMS = 40573
+
+
+def shape(collection, document):
+    """
+    Returns the document with the fields of the model of its collection, in
+    the form of the list routes
+    """
+    return model_document(LIVE_COLLECTIONS[collection][1], document)
+
+
+def keyset_sort(key, direction):
+    return [(k, direction) for k in dict.fromkeys([key, '_id'])]
+
+
+class Subscription:
+    """
+    The events of an address of a tenant to be sent to a client, None
+    closes it
+    """
+
+    def __init__(self, address, tenant):
+        self.address = address
+        self.tenant = tenant
+        self.queue = asyncio.Queue(QUEUE_SIZE)
+        self.dropped = False
+
+    def push(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # too slow, it gets the closing None in place of its events
+            self.dropped = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+            LIVE_DROPPED.inc()
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class Watcher:
+    """
+    Follows the writes to the live collections of a tenant, with a single
+    change stream or a single polling loop, and fans them out to the
+    subscriptions of each address
+    """
+
+    def __init__(self, tenant):
+        self.tenant = tenant
+        self.subscriptions = {}
+        self.task = None
+
+    def subscribe(self, address):
+        subscription = Subscription(address.lower(), self.tenant["name"])
+        self.subscriptions.setdefault(subscription.address, set())\
+            .add(subscription)
+        LIVE_SUBSCRIBERS.inc((self.tenant["name"], ))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscriptions = self.subscriptions.get(subscription.address)
+        if subscriptions is None or subscription not in subscriptions:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self.subscriptions[subscription.address]
+        LIVE_SUBSCRIBERS.dec((self.tenant["name"], ))
+        if not self.subscriptions:
+            # the next subscriber starts over from the latest writes
+            self.stop()
+
+    def dispatch(self, collection, document):
+        address = document.get(LIVE_COLLECTIONS[collection][0])
+        if not isinstance(address, str):
+            return
+        subscriptions = self.subscriptions.get(address.lower())
+        if not subscriptions:
+            return
+        event = (collection, shape(collection, document))
+        for subscription in list(subscriptions):
+            subscription.push(event)
+            if subscription.dropped:
+                self.unsubscribe(subscription)
+        LIVE_EVENTS.inc((self.tenant["name"], collection))
+
+    async def run(self):
+        with use_tenant(self.tenant):
+            while True:
+                try:
+                    db = await get_db("live")
+                    if db is None:
+                        await asyncio.sleep(POLL_INTERVAL)
+                        continue
+                    try:
+                        await self.watch(db)
+                    except OperationFailure as e:
+                        if e.code != NO_CHANGE_STREAMS:
+                            raise
+                        log.info(f"No change streams for the live feed of "
+                                 f"{self.tenant['name']}, polling instead.")
+                        await self.poll(db)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    log.exception(f"Live feed of {self.tenant['name']} "
+                                  f"interrupted: {e}")
+                    await asyncio.sleep(POLL_INTERVAL)
+
+    async def watch(self, db):
+        pipeline = [{
+            '$match': {
+                'ns.coll': {'$in': list(LIVE_COLLECTIONS)},
+                'operationType': {'$in': ['insert', 'update', 'replace']}
+            }
+        }]
+        async with db.watch(pipeline, full_document='updateLookup') \
+                as stream:
+            async for change in stream:
+                document = change.get('fullDocument')
+                if document is not None:
+                    self.dispatch(change['ns']['coll'], document)
+
+    async def poll(self, db):
+        # last (key value, _id) dispatched per collection and key: the
+        # writes are followed by their write time and the inserts that do
+        # not have one yet (new pegouts) by their _id
+        lasts = {}
+        for collection in LIVE_COLLECTIONS:
+            for key in [WATERMARK_FIELDS[collection], '_id']:
+                latest = await db[collection]\
+                    .find({key: {'$ne': None}}, {key: 1})\
+                    .sort(keyset_sort(key, -1))\
+                    .limit(1)\
+                    .to_list(1)
+                lasts[collection, key] = \
+                    (latest[0][key], latest[0]['_id']) if latest else None
+
+        while True:
+            await asyncio.sleep(POLL_INTERVAL)
+            for collection, key in lasts:
+                lasts[collection, key] = await self.follow(
+                    db, collection, key, lasts[collection, key])
+
+    async def follow(self, db, collection, key, last):
+        """
+        Dispatches the documents after the last (key value, _id) in that
+        order, paged over the (key, _id) keyset, and returns the new last
+        """
+        field = WATERMARK_FIELDS[collection]
+        while True:
+            if last is None:
+                query = {key: {'$ne': None}}
+            elif key == '_id':
+                query = {'_id': {'$gt': last[1]}}
+            else:
+                query = {'$or': [{key: {'$gt': last[0]}},
+                                 {key: last[0], '_id': {'$gt': last[1]}}]}
+            if key == '_id':
+                # the ones with a write time are followed by it
+                query[field] = None
+            documents = await db[collection]\
+                .find(query)\
+                .sort(keyset_sort(key, 1))\
+                .limit(POLL_BATCH_SIZE)\
+                .to_list(POLL_BATCH_SIZE)
+            for document in documents:
+                self.dispatch(collection, document)
+            if documents:
+                last = (documents[-1][key], documents[-1]['_id'])
+            if len(documents) < POLL_BATCH_SIZE:
+                return last
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+# Watcher per tenant name, started by its first subscriber
+_watchers = {}
+
+
+def subscribe(address):
+    """
+    Returns a Subscription to the writes of the address in the current
+    tenant
+    """
+    tenant = get_tenant()
+    watcher = _watchers.get(tenant["name"])
+    if watcher is None:
+        watcher = _watchers[tenant["name"]] = Watcher(tenant)
+    return watcher.subscribe(address)
+
+
+def unsubscribe(subscription):
+    # by the tenant of the subscription, a stream may be closed out of the
+    # context of its request
+    watcher = _watchers.get(subscription.tenant)
+    if watcher is not None:
+        watcher.unsubscribe(subscription)
+
+
+async def stop_live():
+    for watcher in _watchers.values():
+        watcher.stop()
+    _watchers.clear()
@@ -0,0 +1,402 @@
+import threading
+import time
+from enum import Enum
+from typing import get_args
+
+from pymongo import monitoring
+
+from api.cache import response_cache
+from api.common import get_env_var
+from api.tenants import get_tenant, route_path
+
+
+# Request and Mongo metrics, exposed in the Prometheus text format at
+# /metrics. Set APP_METRICS=False to stop recording them.
+METRICS_ENABLED = get_env_var("APP_METRICS", bool) is not False
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+SIZE_BUCKETS = [100, 1000, 10000, 100000, 1000000, 10000000]
+
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')\
+        .replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{escape(v)}"'
+                          for n, v in zip(names, values)) + '}'
+
+
+class Metric:
+    """
+    A metric family with a value per combination of its label values, safe
+    to update from the threads pymongo runs its listeners in
+    """
+
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.description}",
+                f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return self.header() + [
+            f"{self.name}{format_labels(self.labels, k)} {v}"
+            for k, v in values]
+
+
+class Gauge(Counter):
+
+    kind = 'gauge'
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value, labels=()):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # per bucket, then the sum and the count
+                counts = self._values[labels] = [0] * len(self.buckets) + \
+                    [0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self):
+        with self._lock:
+            values = sorted((k, list(v)) for k, v in self._values.items())
+        lines = self.header()
+        names = self.labels + ('le', )
+        for labels, counts in values:
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket"
+                             f"{format_labels(names, labels + (bound, ))} "
+                             f"{count}")
+            lines += [
+                f"{self.name}_bucket"
+                f"{format_labels(names, labels + ('+Inf', ))} {counts[-1]}",
+                f"{self.name}_sum{format_labels(self.labels, labels)} "
+                f"{counts[-2]}",
+                f"{self.name}_count{format_labels(self.labels, labels)} "
+                f"{counts[-1]}"
+            ]
+        return lines
+
+
+REQUEST_DURATION = Histogram(
+    "api_request_duration_seconds", "Time to answer a request",
+    ('tenant', 'route', 'method', 'status'))
+REQUEST_SHAPE_DURATION = Histogram(
+    "api_request_shape_duration_seconds",
+    "Time to answer a request per route and parameters given",
+    ('route', 'shape'))
+RESPONSE_SIZE = Histogram(
+    "api_response_size_bytes", "Size of the response bodies",
+    ('route', ), SIZE_BUCKETS)
+IN_FLIGHT = Gauge(
+    "api_requests_in_flight", "Requests being answered")
+
+MONGO_DURATION = Histogram(
+    "mongo_command_duration_seconds", "Time to run a Mongo command",
+    ('collection', 'command'))
+MONGO_FAILURES = Counter(
+    "mongo_command_failures_total", "Mongo commands that failed",
+    ('collection', 'command'))
+MONGO_DOCUMENTS = Counter(
+    "mongo_documents_returned_total",
+    "Documents returned by Mongo commands (n of counts and writes)",
+    ('collection', 'command'))
+MONGO_POOL_WAIT = Histogram(
+    "mongo_pool_wait_seconds", "Time waiting for a pooled connection")
+MONGO_POOL_FAILURES = Counter(
+    "mongo_pool_checkout_failures_total",
+    "Connection check outs that failed", ('reason', ))
+
+LIVE_SUBSCRIBERS = Gauge(
+    "api_live_subscribers", "Clients following the live feed", ('tenant', ))
+LIVE_EVENTS = Counter(
+    "api_live_events_total", "Writes fanned out to the live feed",
+    ('tenant', 'collection'))
+LIVE_DROPPED = Counter(
+    "api_live_dropped_total", "Live feed clients dropped for falling behind")
+
+ADMISSION_QUEUED = Gauge(
+    "api_admission_queued", "Computations waiting for a slot", ('route', ))
+ADMISSION_RUNNING = Gauge(
+    "api_admission_running", "Computations holding a slot", ('route', ))
+ADMISSION_SHED = Counter(
+    "api_admission_shed_total", "Computations refused with a 503",
+    ('route', 'reason'))
+
+RATE_LIMITED = Counter(
+    "api_rate_limited_total", "Requests answered 429 per route prefix",
+    ('route', ))
+
+METRICS = [REQUEST_DURATION, REQUEST_SHAPE_DURATION, RESPONSE_SIZE,
+           IN_FLIGHT, MONGO_DURATION, MONGO_FAILURES, MONGO_DOCUMENTS,
+           MONGO_POOL_WAIT, MONGO_POOL_FAILURES, LIVE_SUBSCRIBERS,
+           LIVE_EVENTS, LIVE_DROPPED, ADMISSION_QUEUED, ADMISSION_RUNNING,
+           ADMISSION_SHED, RATE_LIMITED]
+
+
+def cache_metrics():
+    stats = response_cache.stats()
+    lines = []
+    for key in ['hits', 'misses', 'coalesced', 'evictions', 'stale_hits',
+                'stale_errors']:
+        lines += [f"# TYPE api_cache_{key}_total counter",
+                  f"api_cache_{key}_total {stats[key]}"]
+    for key in ['entries', 'bytes']:
+        lines += [f"# TYPE api_cache_{key} gauge",
+                  f"api_cache_{key} {stats[key]}"]
+    return lines
+
+
+def render():
+    """
+    Returns every metric in the Prometheus text format
+    """
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    lines += cache_metrics()
+    return '\n'.join(lines) + '\n'
+
+
+def enum_values(annotation):
+    """
+    Returns the values of the Enum of a parameter annotation (Optional or
+    List of it too), None when it is not one
+    """
+    if isinstance(annotation, type) and issubclass(annotation, Enum):
+        return {str(e.value) for e in annotation}
+    for arg in get_args(annotation):
+        values = enum_values(arg)
+        if values is not None:
+            return values
+    return None
+
+
+def route_parameters(route):
+    """
+    Returns {name: enum values or None} of the query parameters the route
+    declares
+    """
+    dependant = getattr(route, 'dependant', None)
+    if dependant is None:
+        return {}
+    return {p.alias: enum_values(p.field_info.annotation)
+            for p in dependant.query_params}
+
+
+def request_shape(query_string, parameters):
+    """
+    Returns the sorted names of the query parameters the route declares,
+    with the value of the enum ones, like "event=only_mint&address&limit".
+    Any other name or value is left out, so the shapes stay bounded.
+    """
+    shape = set()
+    for part in query_string.decode('latin-1').split('&'):
+        name, _, value = part.partition('=')
+        if name not in parameters:
+            continue
+        values = parameters[name]
+        shape.add(f"{name}={value}" if values and value in values else name)
+    return '&'.join(sorted(shape))
+
+
+class MetricsMiddleware:
+    """
+    Records the latency, response size and parameters shape per route. Paths
+    that do not match a route count under the given prefix they start with
+    (answered before routing, like the 304 of the conditional GETs) or as
+    "unmatched", so the labels stay bounded.
+    """
+
+    def __init__(self, app, prefixes=()):
+        self.app = app
+        self.prefixes = prefixes
+        # query parameters per route
+        self._parameters = {}
+
+    def route_label(self, scope):
+        route = scope.get('route')
+        if route is not None:
+            return route.path
+        for prefix in self.prefixes:
+            if route_path(scope).startswith(prefix):
+                return prefix
+        return 'unmatched'
+
+    def route_parameters(self, scope):
+        route = scope.get('route')
+        if route is None:
+            return {}
+        parameters = self._parameters.get(id(route))
+        if parameters is None:
+            parameters = self._parameters[id(route)] = \
+                route_parameters(route)
+        return parameters
+
+    async def __call__(self, scope, receive, send):
+
+        if scope['type'] != 'http' or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        response = {'status': 500, 'size': 0}
+
+        async def send_measured(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+            elif message['type'] == 'http.response.body':
+                response['size'] += len(message.get('body', b''))
+            await send(message)
+
+        IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_measured)
+        finally:
+            elapsed = time.perf_counter() - start
+            IN_FLIGHT.dec()
+            route = self.route_label(scope)
+            REQUEST_DURATION.observe(elapsed, (
+                get_tenant()["name"], route, scope['method'],
+                str(response['status'])))
+            REQUEST_SHAPE_DURATION.observe(elapsed, (
+                route, request_shape(scope.get('query_string', b''),
+                                     self.route_parameters(scope))))
+            RESPONSE_SIZE.observe(response['size'], (route, ))
+
+
+def returned_documents(reply):
+    cursor = reply.get('cursor')
+    if isinstance(cursor, dict):
+        return len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+    n = reply.get('n')
+    return n if isinstance(n, int) else 0
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """
+    Records the duration and documents returned per collection and command
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        value = event.command.get(event.command_name)
+        collection = value if isinstance(value, str) else \
+            event.command.get('collection', '')
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = \
+                (str(collection), event.command_name)
+
+    def _finished(self, event):
+        with self._lock:
+            return self._pending.pop(
+                (event.connection_id, event.request_id),
+                ('', event.command_name))
+
+    def succeeded(self, event):
+        labels = self._finished(event)
+        MONGO_DURATION.observe(event.duration_micros / 10**6, labels)
+        MONGO_DOCUMENTS.inc(labels, returned_documents(event.reply))
+
+    def failed(self, event):
+        labels = self._finished(event)
+        MONGO_DURATION.observe(event.duration_micros / 10**6, labels)
+        MONGO_FAILURES.inc(labels)
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    Records the time waiting to check out a connection. The check out
+    events come one after the other in the thread that waits.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def connection_check_out_started(self, event):
+        self._local.start = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        start = getattr(self._local, 'start', None)
+        if start is not None:
+            MONGO_POOL_WAIT.observe(time.perf_counter() - start)
+            self._local.start = None
+
+    def connection_check_out_failed(self, event):
+        self._local.start = None
+        MONGO_POOL_FAILURES.inc((str(event.reason), ))
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+
+def mongo_listeners():
+    """
+    Returns the event_listeners of the Mongo clients
+    """
+    if not METRICS_ENABLED:
+        return []
+    return [CommandMetrics(), PoolMetrics()]
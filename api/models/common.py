@@ -1,5 +1,83 @@
+import datetime
 from enum import Enum
+from typing import Optional
+
+from bson import ObjectId
 
 class OutputFormat(Enum):
     JSON = 'json'
     TEXT = 'text'
+
+class ExportFormat(Enum):
+    CSV = 'csv'
+    NDJSON = 'ndjson'
+    TEXT = 'text'
+
+
+# Dates as the response models serialize them: UTC, with the fraction in
+# microseconds and without it on whole seconds (Mongo keeps milliseconds)
+MONGO_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%L000Z'
+MONGO_SECONDS_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def date_to_json(x):
+    """
+    Returns the datetime as the response models serialize it
+    """
+    if x.microsecond:
+        return x.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    return x.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def date_to_json_expression(field):
+    """
+    Returns the expression of date_to_json of the field, null when it is
+    """
+    return {'$cond': [
+        {'$eq': [{'$millisecond': field}, 0]},
+        {'$dateToString': {'format': MONGO_SECONDS_FORMAT, 'date': field}},
+        {'$dateToString': {'format': MONGO_DATE_FORMAT, 'date': field}}
+    ]}
+
+
+def model_fields(model):
+    return [f.alias or name for name, f in model.model_fields.items()]
+
+
+def json_value(value):
+    if isinstance(value, datetime.datetime):
+        return date_to_json(value)
+    if isinstance(value, ObjectId):
+        return str(value)
+    return value
+
+
+def model_document(model, document):
+    """
+    Returns the document with all the fields of the model, as
+    model_projection shapes it on the server
+    """
+    return {name: json_value(document.get(name))
+            for name in model_fields(model)}
+
+
+def model_projection(model, fields=None):
+    """
+    Returns a find() projection that shapes the documents like the model,
+    with all of its fields if fields is None. _id and the dates are
+    converted to strings on the server and missing fields come as null, so
+    rows can be serialized as they are. _id and the required fields are
+    always included.
+    """
+    projection = {'_id': {'$toString': '$_id'}}
+    for name, f in model.model_fields.items():
+        key = f.alias or name
+        if key=='_id':
+            continue
+        if fields is not None and key not in fields and not f.is_required():
+            continue
+        if f.annotation in [datetime.datetime, Optional[datetime.datetime]]:
+            projection[key] = date_to_json_expression('$' + key)
+        else:
+            projection[key] = {'$ifNull': ['$' + key, None]}
+    return projection
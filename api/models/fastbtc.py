@@ -47,13 +47,15 @@ class FastBtcBridge(BaseModel):
 class PegOutList(BaseModel):
     pegout_requests: List[FastBtcBridge]
     count: int = 0
-    total: int = 0
+    total: Optional[int] = 0
+    next_cursor: Optional[str] = None
 
     class Config:
         json_schema_extra = {
             "example": {
                 "pegout_requests": "[]",
                 "count": "0",
-                "total": "0"
+                "total": "0",
+                "next_cursor": None
             }
         }
@@ -1,9 +1,11 @@
 import datetime
-from pydantic import BaseModel, Field
-from typing import Optional, List
+from pydantic import BaseModel, Field, StringConstraints
+from typing import Annotated, Optional, List
 from enum import Enum
 import uuid
 
+from api.models.common import model_fields, model_projection
+
 
 class TokenName(Enum):
     STABLE = 'STABLE'
@@ -70,13 +72,70 @@ class Transactions(BaseModel):
 class TransactionsList(BaseModel):
     transactions: List[Transactions]
     count: int = 0
-    total: int = 0
+    total: Optional[int] = 0
+    next_cursor: Optional[str] = None
 
     class Config:
         json_schema_extra = {
             "example": {
                 "transactions": "[]",
                 "count": "0",
-                "total": "0"
+                "total": "0",
+                "next_cursor": None
+            }
+        }
+
+
+TRANSACTIONS_FIELDS = model_fields(Transactions)
+
+
+def transactions_projection(fields=None):
+    return model_projection(Transactions, fields)
+
+
+# addresses of a transactions batch
+MAX_BATCH_ADDRESSES = 20
+
+
+class TransactionsBatchRequest(BaseModel):
+    addresses: List[Annotated[str, StringConstraints(
+        pattern='^0x[a-fA-F0-9]{40}$')]] = Field(
+            min_length=1, max_length=MAX_BATCH_ADDRESSES)
+    token: Optional[TokenName] = None
+    limit: int = Field(default=20, ge=1, le=200)
+    include_total: bool = True
+    merged: bool = False
+    fields: Optional[List[str]] = None
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "addresses": [
+                    "0xCD8A1c9aCc980ae031456573e34dC05cD7daE6e3",
+                    "0x0000000000000000000000000000000000000001"
+                ],
+                "limit": 20,
+                "merged": True
+            }
+        }
+
+
+class TransactionsBatchAccount(BaseModel):
+    address: str
+    transactions: List[Transactions]
+    count: int = 0
+    total: Optional[int] = 0
+    next_cursor: Optional[str] = None
+
+
+class TransactionsBatch(BaseModel):
+    accounts: List[TransactionsBatchAccount]
+    merged: Optional[List[Transactions]] = None
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "accounts": "[]",
+                "merged": None
             }
         }
@@ -1,5 +1,5 @@
 from datetime import date as date_type
-from pydantic import BaseModel, computed_field
+from pydantic import BaseModel, Field, computed_field
 from typing import List, Optional
 from enum import Enum
 
@@ -25,12 +25,35 @@ class TransactionsCountEvent(Enum):
     ONLY_REDEEM = 'only_redeem'
     ONLY_MINT_AND_REDEEM = 'only_mint_and_redeem'
 
+class RankBy(Enum):
+    COUNT = 'count'
+    VOLUME = 'volume'
+
 class TransactionsCountToken(Enum):
     ALL = 'all'
     ONLY_STABLE = 'only_stable'
     ONLY_PRO = 'only_pro'
     ONLY_GOVERNANCE = 'only_governance'
 
+# tokenInvolved and event values selected by each filter
+
+TOKEN_INVOLVED = {
+    TransactionsCountToken.ONLY_STABLE: 'STABLE',
+    TransactionsCountToken.ONLY_PRO: 'RISKPRO',
+    TransactionsCountToken.ONLY_GOVERNANCE: 'MOC'
+}
+
+EVENT_NAMES = {
+    TransactionsCountEvent.ONLY_TRANSFER: ['Transfer'],
+    TransactionsCountEvent.ONLY_MINT: ['RiskProMint', 'StableTokenMint'],
+    TransactionsCountEvent.ONLY_REDEEM: ['RiskProRedeem',
+                                         'FreeStableTokenRedeem'],
+    TransactionsCountEvent.ONLY_MINT_AND_REDEEM: ['RiskProMint',
+                                                  'StableTokenMint',
+                                                  'RiskProRedeem',
+                                                  'FreeStableTokenRedeem']
+}
+
 class CountByDate(BaseModel):
     date: date_type
     count: float
@@ -48,6 +71,7 @@ class TransactionsCountList(BaseModel):
     accounts: List[CountByDate]
     group_by: Optional[str] = None
     type: Optional[str] = None
+    closed_until: Optional[date_type] = None
 
     @computed_field
     @property
@@ -84,7 +108,8 @@ class TransactionsCountList(BaseModel):
                 "total": 32220,
                 "count": 10740,
                 "group_by": "day",
-                "type": "all"
+                "type": "all",
+                "closed_until": "2009-01-02"
             }
         }
 
@@ -92,12 +117,14 @@ class TransactionsCountList(BaseModel):
 class TopTransactor(BaseModel):
     address: str
     tx_count: int
+    volume: Optional[float] = None
 
     class Config:
         json_schema_extra = {
             "example": {
                 "address": "0x0000000000000000000000000000000000000001",
-                "tx_count": 123
+                "tx_count": 123,
+                "volume": 4560.5
             }
         }
 
@@ -119,4 +146,109 @@ class TopTransactorList(BaseModel):
                     }
                 ]
             }
-        }
\ No newline at end of file
+        }
+
+
+class TopTransactorWindow(BaseModel):
+    days: int
+    transactors: List[TopTransactor]
+
+
+class TopTransactorWindows(BaseModel):
+    rank_by: str
+    windows: List[TopTransactorWindow]
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "rank_by": "count",
+                "windows": [
+                    {
+                        "days": 1,
+                        "transactors": [
+                            {
+                                "address": "0x0000000000000000000000000000000000000001",
+                                "tx_count": 12,
+                                "volume": 1500.0
+                            }
+                        ]
+                    }, {
+                        "days": 7,
+                        "transactors": [
+                            {
+                                "address": "0x0000000000000000000000000000000000000001",
+                                "tx_count": 45,
+                                "volume": 5230.25
+                            }
+                        ]
+                    }
+                ]
+            }
+        }
+
+
+# series of a multi-series request
+MAX_SERIES = 20
+
+
+class SeriesSpec(BaseModel):
+    name: Optional[str] = None
+    type: TransactionsCountType = TransactionsCountType.ALL
+    token: TransactionsCountToken = TransactionsCountToken.ALL
+    event: TransactionsCountEvent = TransactionsCountEvent.ALL
+    fnc: TransactionsCountFnc = TransactionsCountFnc.COUNT
+
+
+class StatsSeriesRequest(BaseModel):
+    series: List[SeriesSpec] = Field(min_length=1, max_length=MAX_SERIES)
+    group_by: Periods = Periods.DAY
+    from_: Optional[date_type] = Field(None, alias="from")
+    to: Optional[date_type] = None
+    since_bucket: Optional[date_type] = None
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "series": [
+                    {"name": "stable", "token": "only_stable", "fnc": "sum"},
+                    {"name": "pro", "token": "only_pro", "fnc": "sum"},
+                    {"name": "new_accounts", "type": "only_new_accounts"}
+                ],
+                "group_by": "month",
+                "from": "2024-01-01"
+            }
+        }
+
+
+class StatsSeriesColumn(BaseModel):
+    name: str
+    type: str
+    token: str
+    event: str
+    fnc: str
+    values: List[float]
+
+
+class StatsSeries(BaseModel):
+    group_by: str
+    dates: List[date_type]
+    closed_until: Optional[date_type] = None
+    series: List[StatsSeriesColumn]
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "group_by": "month",
+                "dates": ["2024-01-31", "2024-02-29"],
+                "series": [
+                    {
+                        "name": "stable",
+                        "type": "all",
+                        "token": "only_stable",
+                        "event": "all",
+                        "fnc": "sum",
+                        "values": [125000.5, 98000.25]
+                    }
+                ]
+            }
+        }
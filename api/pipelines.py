@@ -0,0 +1,134 @@
+from functools import lru_cache
+
+from api.models.stats import (Periods, TransactionsCountType,
+                              TransactionsCountFnc, TOKEN_INVOLVED,
+                              EVENT_NAMES)
+from api.rollups import time_range
+
+
+def period_date(group_by, field):
+    """
+    Returns the expression of the date (as a string) that stands for the
+    period of the date field: the sunday of its isoWeek, the last day of its
+    month or year, or the day itself
+    """
+
+    if group_by==Periods.WEEK:
+        return {
+            '$dateToString': {
+                'format': '%Y-%m-%d', 
+                'date': {
+                    '$dateFromParts': {
+                        'isoWeekYear': {
+                            '$year': field
+                        }, 
+                        'isoWeek': {
+                            '$isoWeek': field
+                        },
+                        "isoDayOfWeek": 7,
+                    }
+                }
+            }
+        }
+
+    if group_by==Periods.MONTH:
+        return {
+            '$dateToString': {
+                'format': '%Y-%m-%d', 
+                'date': {
+                    '$subtract': [
+                        {
+                            '$dateFromParts': {
+                                'year': {
+                                    '$year': field
+                                }, 
+                                'month': {
+                                    '$add': [
+                                        {
+                                            '$month': field
+                                        },
+                                        1
+                                    ]
+                                }
+                            }
+                        },
+                        86400000
+                    ]
+                }
+            }
+        }
+
+    if group_by==Periods.YEAR:
+        return {
+            '$dateToString': {
+                'format': '%Y-12-31', 
+                'date': field
+            }
+        }
+
+    # group per day
+    return {
+        '$dateToString': {
+            'format': '%Y-%m-%d', 
+            'date': field
+        }
+    }
+
+
+@lru_cache(maxsize=1024)
+def transactions_pipeline(type, token, event, group_by, fnc, from_=None,
+                          to=None):
+    """
+    Returns the aggregation of transactions_base, built once per combination
+    of its parameters (the stages are shared, do not modify them).
+
+    Every filter goes in a single $match over the confirmationTime indexes:
+    the confirmed transactions only, since the earliest confirmation of an
+    address is null only when all of them are. The new accounts take the
+    lower bound after the $group, where the first transaction of each
+    address is known. Nothing is projected, the $group reads amount only for
+    the sums. Addresses are compared case-insensitively.
+    """
+
+    match = {}
+    if token in TOKEN_INVOLVED:
+        match['tokenInvolved'] = TOKEN_INVOLVED[token]
+    if event in EVENT_NAMES:
+        match['event'] = {'$in': EVENT_NAMES[event]}
+
+    times = {'$ne': None}
+    if type==TransactionsCountType.ALL:
+        times.update(time_range(from_, to) or {})
+    else:
+        times.update(time_range(until=to) or {})
+    match['confirmationTime'] = times
+
+    stages = [{'$match': match}]
+
+    field = '$confirmationTime'
+    if type==TransactionsCountType.ONLY_NEW_ACCOUNTS:
+        stages.append({
+            '$group': {
+                '_id': {'$toLower': '$address'},
+                'timestamp': {'$min': '$confirmationTime'}
+            }
+        })
+        if from_ is not None:
+            stages.append({'$match': {'timestamp': time_range(from_)}})
+        field = '$timestamp'
+
+    if fnc==TransactionsCountFnc.COUNT:
+        value = {'$sum': 1.0}
+    else:
+        value = {'$sum': {'$toDecimal': '$amount'}}
+
+    stages += [{
+        '$group': {
+            '_id': period_date(group_by, field),
+            'count': value
+        }
+    }, {
+        '$sort': {'_id': 1}
+    }]
+
+    return tuple(stages)
@@ -0,0 +1,220 @@
+import math
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from ipaddress import ip_address, ip_network
+from urllib.parse import parse_qsl
+
+from pymongo import ReturnDocument
+
+from api.common import get_env_var
+from api.db import get_db
+from api.logger import log
+from api.metrics import RATE_LIMITED
+from api.tenants import route_path
+
+
+# Token bucket per client IP, like {"rate": 20, "burst": 200}: every request
+# takes the cost of its route from a bucket of burst tokens, refilled at rate
+# tokens per second. "store": "mongo" shares the buckets of the workers
+# through the database. Disabled when not set.
+RATE_LIMIT = get_env_var("APP_RATE_LIMIT", dict)
+
+# Tokens taken per request by path prefix (the longest one that matches),
+# override them with APP_RATE_LIMIT_COSTS
+RATE_LIMIT_COSTS = {
+    "/api/v1/stats/": 10,
+    "/api/v1/webapp/transactions/list/": 1,
+    "/api/v1/webapp/transactions/batch/": 5,
+    "/api/v1/webapp/transactions/export/": 20,
+    "/api/v1/webapp/fastbtc/pegout/": 1,
+    "/diagnosis/": 20,
+    "/metrics": 0
+}
+RATE_LIMIT_COSTS.update(get_env_var("APP_RATE_LIMIT_COSTS", dict) or {})
+
+# Documents (limit plus skip) of a page that cost one more token
+PAGE_COST_DOCUMENTS = 100
+
+# Buckets kept in memory, the least recently used are dropped (a full one)
+MAX_BUCKETS = 100000
+
+BUCKETS_COLLECTION = "RateLimitBuckets"
+
+# Addresses or networks of the proxies (nginx) whose X-Real-IP and
+# X-Forwarded-For headers are believed, like ["10.0.0.0/8"]. The headers of
+# any other client are ignored, it could send a new address every time.
+TRUSTED_PROXIES = [ip_network(p, strict=False)
+                   for p in get_env_var("APP_TRUSTED_PROXIES", list) or []]
+
+
+def trusted_proxy(address):
+    try:
+        address = ip_address(address)
+    except ValueError:
+        return False
+    return any(address in network for network in TRUSTED_PROXIES)
+
+
+def client_address(scope):
+    """
+    Returns the IP of the client. The ones of the requests coming from a
+    trusted proxy are taken from X-Real-IP, as given by nginx, or from the
+    first address of X-Forwarded-For.
+    """
+    client = scope.get('client')
+    address = client[0] if client else ''
+    if not trusted_proxy(address):
+        return address
+    headers = dict(scope.get('headers', []))
+    real_ip = headers.get(b'x-real-ip')
+    if real_ip:
+        return real_ip.decode('latin-1').strip()
+    forwarded_for = headers.get(b'x-forwarded-for')
+    if forwarded_for:
+        return forwarded_for.decode('latin-1').split(',')[0].strip()
+    return address
+
+
+def request_cost(scope):
+    """
+    Returns the route prefix and the tokens a request takes, the pages cost
+    more the deeper and longer they are
+    """
+    path = route_path(scope)
+    prefix = max((p for p in RATE_LIMIT_COSTS if path.startswith(p)),
+                 key=len, default=None)
+    cost = RATE_LIMIT_COSTS[prefix] if prefix is not None else 1
+    if cost:
+        query = dict(parse_qsl(scope.get('query_string', b'')
+                               .decode('latin-1')))
+        documents = 0
+        for name in ['limit', 'skip']:
+            try:
+                documents += max(int(query.get(name, 0)), 0)
+            except ValueError:
+                pass
+        cost += documents / PAGE_COST_DOCUMENTS
+    return prefix or 'other', cost
+
+
+class MemoryBuckets:
+    """
+    Token buckets of a single process
+    """
+
+    def __init__(self, max_entries=MAX_BUCKETS):
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()
+
+    async def take(self, key, cost, rate, burst):
+        """
+        Takes cost tokens from the bucket of the key, returns the seconds to
+        wait until they are there or 0 when they were taken
+        """
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        wait = 0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            wait = (cost - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_entries:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+class MongoBuckets:
+    """
+    Token buckets shared by the workers, updated atomically in the
+    RateLimitBuckets collection of the tenant
+    """
+
+    def __init__(self):
+        self._indexed = set()
+
+    async def take(self, key, cost, rate, burst):
+        db = await get_db("ratelimit")
+        if db is None:
+            return 0
+        collection = db[BUCKETS_COLLECTION]
+
+        if db.name not in self._indexed:
+            self._indexed.add(db.name)
+            await collection.create_index('expires', expireAfterSeconds=0)
+
+        now = datetime.utcnow()
+        elapsed = {'$divide': [
+            {'$subtract': [now, {'$ifNull': ['$updated', now]}]}, 1000]}
+        bucket = await collection.find_one_and_update({'_id': key}, [{
+            '$set': {
+                'tokens': {'$min': [burst, {'$add': [
+                    {'$ifNull': ['$tokens', burst]},
+                    {'$multiply': [elapsed, rate]}]}]},
+                'updated': now,
+                # a bucket left alone this long is full again
+                'expires': now + timedelta(seconds=burst / rate)
+            }
+        }, {
+            '$set': {'taken': {'$gte': ['$tokens', cost]}}
+        }, {
+            '$set': {'tokens': {'$cond': [
+                '$taken', {'$subtract': ['$tokens', cost]}, '$tokens']}}
+        }], upsert=True, return_document=ReturnDocument.AFTER)
+
+        if bucket['taken']:
+            return 0
+        return (cost - bucket['tokens']) / rate
+
+
+def make_buckets(config):
+    if config.get("store") == "mongo":
+        return MongoBuckets()
+    return MemoryBuckets()
+
+
+class RateLimitMiddleware:
+    """
+    Answers 429 Too Many Requests, with a Retry-After header, to the clients
+    whose bucket does not have the tokens their request costs
+    """
+
+    def __init__(self, app, config=None, buckets=None):
+        self.app = app
+        self.config = config if config is not None else RATE_LIMIT
+        self.buckets = buckets
+        if self.config and self.buckets is None:
+            self.buckets = make_buckets(self.config)
+
+    async def __call__(self, scope, receive, send):
+
+        if scope['type'] != 'http' or not self.config:
+            await self.app(scope, receive, send)
+            return
+
+        route, cost = request_cost(scope)
+        cost = min(cost, self.config["burst"])
+        wait = 0
+        if cost:
+            try:
+                wait = await self.buckets.take(
+                    client_address(scope), cost, self.config["rate"],
+                    self.config["burst"])
+            except Exception as e:
+                # the limits never take the API down
+                log.warning(f'Could not check the rate limit: {e}')
+
+        if not wait:
+            await self.app(scope, receive, send)
+            return
+
+        RATE_LIMITED.inc((route, ))
+        await send({'type': 'http.response.start', 'status': 429,
+                    'headers': [
+                        (b'content-type', b'application/json'),
+                        (b'retry-after', str(math.ceil(wait)).encode())]})
+        await send({'type': 'http.response.body',
+                    'body': b'{"detail":"Too many requests"}'})
@@ -0,0 +1,640 @@
+import asyncio
+import heapq
+from functools import lru_cache
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from pymongo import ReplaceOne, UpdateOne
+
+from api.common import get_env_var
+from api.db import get_db
+from api.logger import log
+from api.tenants import TENANTS, get_tenant, use_tenant
+from api.models.stats import Periods, TransactionsCountEvent, EVENT_NAMES
+
+
+STATE_COLLECTION = "StatsRollupState"
+
+# Every rollup keeps one row per day and keys, with the values accumulated
+# over the transactions of the day (per date_field) that match.
+ROLLUPS = {
+    "daily": {
+        "collection": "StatsDailyRollup",
+        "date_field": "confirmationTime",
+        "match": {},
+        "keys": {
+            'tokenInvolved': '$tokenInvolved',
+            'event': '$event'
+        },
+        "values": {
+            'count': {'$sum': 1},
+            'amount': {'$sum': {'$toDecimal': {'$ifNull': ['$amount', 0]}}}
+        }
+    },
+    "transactors": {
+        "collection": "StatsDailyTransactors",
+        "date_field": "createdAt",
+        "match": {
+            'event': {
+                '$in': EVENT_NAMES[TransactionsCountEvent.ONLY_MINT_AND_REDEEM]
+            }
+        },
+        "keys": {
+            'address': {'$toLower': '$address'}
+        },
+        "values": {
+            'count': {'$sum': 1},
+            'volume': {'$sum': {'$toDecimal': {'$ifNull': ['$USDAmount', 0]}}}
+        }
+    }
+}
+
+ROLLUP_COLLECTION = ROLLUPS["daily"]["collection"]
+TRANSACTORS_COLLECTION = ROLLUPS["transactors"]["collection"]
+
+# Earliest confirmed transaction of each account, and of each account per
+# tokenInvolved and event to answer the filtered new accounts series
+FIRST_SEEN_COLLECTION = "StatsFirstSeen"
+FIRST_SEEN_BY_COLLECTION = "StatsFirstSeenByTokenEvent"
+
+FIRST_SEEN_FIELDS = ['confirmationTime', 'blockNumber', 'transactionHash',
+                     'tokenInvolved', 'event']
+
+# Bulk writes of the first seen refresh
+FIRST_SEEN_BATCH_SIZE = 1000
+
+# Documents written right before the previous refresh may show up with an
+# older lastUpdatedAt, so every refresh looks this far behind the mark.
+# Recomputing a day is idempotent, looking twice at a document is harmless.
+REFRESH_OVERLAP = timedelta(minutes=5)
+
+# A period is closed, its bucket does not change anymore, once the stats are
+# computed up to this long after its last day ends (late confirmations
+# included)
+CLOSED_LAG = timedelta(hours=1)
+
+_task: asyncio.Task = None
+# (tenant, name) of the rollups built
+_ready = set()
+
+
+def day_range(day):
+    start = datetime.combine(date.fromisoformat(day), datetime.min.time())
+    return start, start + timedelta(days=1)
+
+
+def day_expression(date_field):
+    return {
+        '$dateToString': {
+            'format': '%Y-%m-%d',
+            'date': '$' + date_field
+        }
+    }
+
+
+def rollup_pipeline(rollup, match):
+    return [{
+        '$match': {**rollup["match"], **match}
+    }, {
+        '$group': {
+            '_id': {'day': day_expression(rollup["date_field"]),
+                    **rollup["keys"]},
+            **rollup["values"]
+        }
+    }]
+
+
+async def touched_days(db, rollup, since, until):
+    """
+    Returns the days (per the date_field of the rollup) of the transactions
+    updated between since and until
+    """
+    date_field = rollup["date_field"]
+    cursor = db["Transaction"].aggregate([{
+        '$match': {
+            **rollup["match"],
+            'lastUpdatedAt': {'$gt': since, '$lte': until},
+            date_field: {'$ne': None}
+        }
+    }, {
+        '$group': {
+            '_id': day_expression(date_field)
+        }
+    }])
+    return sorted([d['_id'] for d in await cursor.to_list(length=None)])
+
+
+async def write_day(db, rollup, day, rows):
+    """
+    Replaces the rollup rows of the day with the given ones
+    """
+    collection = db[rollup["collection"]]
+
+    requests = []
+    ids = []
+    for row in rows:
+        key = row['_id']
+        _id = '|'.join([day] + [str(key.get(k)) for k in rollup["keys"]])
+        ids.append(_id)
+        document = {'day': day}
+        document.update({k: key.get(k) for k in rollup["keys"]})
+        document.update({v: row[v] for v in rollup["values"]})
+        requests.append(ReplaceOne({'_id': _id}, document, upsert=True))
+
+    if requests:
+        await collection.bulk_write(requests, ordered=False)
+
+    # rows of the day that do not exist anymore
+    await collection.delete_many({'day': day, '_id': {'$nin': ids}})
+
+
+async def build_rollup(db, rollup):
+    """
+    Aggregates the whole collection into the rollup, streamed in order of
+    day and written one day at a time
+    """
+    date_field = rollup["date_field"]
+    cursor = db["Transaction"].aggregate(
+        rollup_pipeline(rollup, {date_field: {'$ne': None}}) +
+        [{'$sort': {'_id.day': 1}}],
+        allowDiskUse=True)
+
+    days = []
+    rows = []
+    async for row in cursor:
+        if days and row['_id']['day'] != days[-1]:
+            await write_day(db, rollup, days[-1], rows)
+            rows = []
+        if not rows:
+            days.append(row['_id']['day'])
+        rows.append(row)
+    if rows:
+        await write_day(db, rollup, days[-1], rows)
+
+    # days without transactions anymore
+    await db[rollup["collection"]].delete_many({'day': {'$nin': days}})
+
+
+async def refresh_rollup(db, name, until):
+    """
+    Brings a rollup up to date with the Transaction collection.
+
+    The first run aggregates the whole collection. The next ones only
+    recompute the days of the transactions whose lastUpdatedAt is newer than
+    the high-water mark left by the previous run.
+    """
+
+    rollup = ROLLUPS[name]
+    date_field = rollup["date_field"]
+
+    since = await read_mark(db, name)
+
+    if since is not None and until <= since:
+        return
+
+    if since is None:
+        await build_rollup(db, rollup)
+        log.info(f"Stats rollup {name} built up to {until}.")
+    else:
+        days = await touched_days(db, rollup, since - REFRESH_OVERLAP, until)
+        for day in days:
+            start, end = day_range(day)
+            cursor = db["Transaction"].aggregate(rollup_pipeline(
+                rollup, {date_field: {'$gte': start, '$lt': end}}))
+            await write_day(db, rollup, day,
+                            await cursor.to_list(length=None))
+
+    await write_mark(db, name, until)
+
+
+async def read_mark(db, name):
+    """
+    Returns the lastUpdatedAt high-water mark left by the previous refresh
+    """
+    state = await db[STATE_COLLECTION].find_one({'_id': name})
+    return state.get('lastUpdatedAt') if state else None
+
+
+async def write_mark(db, name, until):
+    await db[STATE_COLLECTION].update_one({'_id': name}, {'$set': {
+        'lastUpdatedAt': until,
+        'refreshedAt': datetime.utcnow()
+    }}, upsert=True)
+
+
+def keep_earliest(collection, _id, document):
+    """
+    Returns the (collection, request) pairs that store the document unless
+    one with an earlier confirmationTime is already there
+    """
+    return [
+        (collection, UpdateOne({'_id': _id}, {'$setOnInsert': document},
+                               upsert=True)),
+        (collection, UpdateOne({'_id': _id, 'confirmationTime': {
+            '$gt': document['confirmationTime']}}, {'$set': document}))
+    ]
+
+
+async def write_first_seen(db, requests):
+    for collection in [FIRST_SEEN_COLLECTION, FIRST_SEEN_BY_COLLECTION]:
+        batch = [r for c, r in requests if c==collection]
+        if batch:
+            await db[collection].bulk_write(batch, ordered=True)
+
+
+async def refresh_first_seen(db, until):
+    """
+    Brings the first seen accounts up to date, only with the transactions
+    updated after the high-water mark of the previous run (all of them the
+    first time).
+    """
+
+    since = await read_mark(db, "first_seen")
+
+    if since is not None and until <= since:
+        return
+
+    match = {'confirmationTime': {'$ne': None}, 'address': {'$ne': None}}
+    if since is not None:
+        match['lastUpdatedAt'] = {'$gt': since - REFRESH_OVERLAP,
+                                  '$lte': until}
+
+    cursor = db["Transaction"].aggregate([{
+        '$match': match
+    }, {
+        '$sort': {'confirmationTime': 1}
+    }, {
+        '$group': {
+            '_id': {
+                'address': {'$toLower': '$address'},
+                'tokenInvolved': '$tokenInvolved',
+                'event': '$event'
+            },
+            **{f: {'$first': '$' + f} for f in FIRST_SEEN_FIELDS}
+        }
+    }], allowDiskUse=True)
+
+    requests = []
+    async for row in cursor:
+        address = row['_id']['address']
+        document = {f: row.get(f) for f in FIRST_SEEN_FIELDS}
+        requests += keep_earliest(FIRST_SEEN_COLLECTION, address,
+                                  {'address': address, **document})
+        requests += keep_earliest(
+            FIRST_SEEN_BY_COLLECTION,
+            f"{address}|{document['tokenInvolved']}|{document['event']}",
+            {'address': address, **document})
+        if len(requests) >= FIRST_SEEN_BATCH_SIZE:
+            await write_first_seen(db, requests)
+            requests = []
+
+    await write_first_seen(db, requests)
+
+    if since is None:
+        log.info(f"First seen accounts built up to {until}.")
+
+    await write_mark(db, "first_seen", until)
+
+
+async def refresh_rollups(db):
+
+    latest = await db["Transaction"]\
+        .find({'lastUpdatedAt': {'$ne': None}}, {'lastUpdatedAt': 1})\
+        .sort('lastUpdatedAt', -1)\
+        .limit(1)\
+        .to_list(1)
+
+    if not latest:
+        return
+
+    for name in ROLLUPS:
+        await refresh_rollup(db, name, latest[0]['lastUpdatedAt'])
+
+    await refresh_first_seen(db, latest[0]['lastUpdatedAt'])
+
+
+async def rollup_ready(db, name="daily"):
+    """
+    True when the rollups are being refreshed and the named one (or
+    first_seen) has been built at least once
+    """
+    if _task is None:
+        return False
+    key = (get_tenant()["name"], name)
+    if key not in _ready:
+        state = await db[STATE_COLLECTION].find_one({'_id': name})
+        if state is not None:
+            _ready.add(key)
+    return key in _ready
+
+
+def bucket_date(day, group_by):
+    """
+    Returns the date that stands for the period of the day, as the
+    aggregation over Transaction labels it
+    """
+    if group_by==Periods.WEEK:
+        # sunday of the isoWeek, built from the calendar year
+        week = day.isocalendar()[1]
+        return date.fromisocalendar(day.year, 1, 7) + timedelta(weeks=week-1)
+    if group_by==Periods.MONTH:
+        next_month = (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+        return next_month - timedelta(days=1)
+    if group_by==Periods.YEAR:
+        return date(day.year, 12, 31)
+    return day
+
+
+def first_day(since, group_by):
+    """
+    Returns the earliest day of the periods labeled since or later by
+    bucket_date. The labels do not always follow the days: a week takes
+    its isoWeek from the calendar year, so the last days of a year can go to
+    a week labeled a year earlier and the first ones to a week a year later.
+    """
+    day = since
+    for offset in range(1, 380):
+        earlier = since - timedelta(days=offset)
+        if bucket_date(earlier, group_by) >= since:
+            day = earlier
+    return day
+
+
+@lru_cache(maxsize=64)
+def closed_label(today, group_by):
+    """
+    Returns the label of the latest period whose days, and the ones of every
+    earlier period, are all before today. A week can still take days of the
+    end of the year after its label (see first_day).
+    """
+    first_open = min(bucket_date(today + timedelta(days=offset), group_by)
+                     for offset in range(380))
+    labels = [bucket_date(today - timedelta(days=offset), group_by)
+              for offset in range(1, 760)]
+    return max((label for label in labels if label < first_open),
+               default=None)
+
+
+def last_closed_bucket(group_by, mark):
+    """
+    Returns the label of the latest period closed by the confirmationTime
+    mark, None without one
+    """
+    if mark is None:
+        return None
+    today = (min(mark, datetime.utcnow()) - CLOSED_LAG).date()
+    return closed_label(today, group_by)
+
+
+async def rollups_mark(db):
+    """
+    Returns the lastUpdatedAt the rollups are computed up to (the oldest of
+    their marks), None when they do not answer the stats
+    """
+    if not await rollup_ready(db):
+        return None
+    marks = [await read_mark(db, name)
+             for name in list(ROLLUPS) + ["first_seen"]]
+    return None if None in marks else min(marks)
+
+
+async def chain_mark(db, until=None):
+    """
+    Returns the latest confirmationTime (chain time) the indexer reached,
+    among the transactions it wrote up to the lastUpdatedAt until when
+    given. An indexer catching up writes old confirmations with a fresh
+    lastUpdatedAt, so that one cannot tell the closed periods.
+    """
+    query = {'confirmationTime': {'$ne': None}}
+    if until is not None:
+        query['lastUpdatedAt'] = {'$lte': until}
+    latest = await db["Transaction"]\
+        .find(query, {'confirmationTime': 1})\
+        .sort('confirmationTime', -1)\
+        .limit(1)\
+        .to_list(1)
+    return latest[0]['confirmationTime'] if latest else None
+
+
+def time_range(since=None, until=None):
+    """
+    Returns the query of the datetimes from the day since until the day
+    until (both included) or None when they are not given
+    """
+    query = {}
+    if since is not None:
+        query['$gte'] = datetime.combine(since, datetime.min.time())
+    if until is not None:
+        query['$lt'] = datetime.combine(until + timedelta(days=1),
+                                        datetime.min.time())
+    return query or None
+
+
+def day_range_query(since=None, until=None):
+    query = {}
+    if since is not None:
+        query['$gte'] = since.isoformat()
+    if until is not None:
+        query['$lte'] = until.isoformat()
+    return query or None
+
+
+async def transactions_by_date(db, token=None, events=None,
+                               group_by=Periods.DAY, since=None, until=None):
+    """
+    Returns a sorted list of (date, count, amount) re-bucketing the daily
+    rollup rows of the given tokenInvolved and events, between the days
+    since and until when given.
+    """
+    return (await series_by_date(
+        db, [(token, events)], group_by, since, until))[0]
+
+
+async def series_by_date(db, filters, group_by=Periods.DAY, since=None,
+                         until=None):
+    """
+    Returns a sorted list of (date, count, amount) per (tokenInvolved,
+    events) filter, from a single read of the daily rollup rows
+    """
+
+    if not filters:
+        return []
+
+    queries = []
+    for token, events in filters:
+        query = {}
+        if token is not None:
+            query['tokenInvolved'] = token
+        if events is not None:
+            query['event'] = {'$in': events}
+        queries.append(query)
+
+    # rows of any of them, all of them when one is not filtered
+    query = {} if {} in queries else {'$or': queries}
+    days = day_range_query(since, until)
+    if days is not None:
+        query['day'] = days
+
+    rows = await db[ROLLUP_COLLECTION]\
+        .find(query, {'day': 1, 'tokenInvolved': 1, 'event': 1, 'count': 1,
+                      'amount': 1, '_id': 0})\
+        .to_list(length=None)
+
+    series = []
+    for token, events in filters:
+        buckets = {}
+        for row in rows:
+            if token is not None and row.get('tokenInvolved') != token:
+                continue
+            if events is not None and row.get('event') not in events:
+                continue
+            key = bucket_date(date.fromisoformat(row['day']), group_by)
+            count, amount = buckets.get(key, (0, Decimal(0)))
+            if row.get('amount') is not None:
+                # Decimal128, or an int from rows written before $ifNull
+                amount += Decimal(str(row['amount']))
+            buckets[key] = (count + row['count'], amount)
+        series.append([(key, ) + buckets[key] for key in sorted(buckets)])
+
+    return series
+
+
+async def new_accounts_by_date(db, token=None, events=None,
+                               group_by=Periods.DAY, since=None, until=None):
+    """
+    Returns a sorted list of (date, count) of the accounts whose first
+    transaction (among the given tokenInvolved and events) falls in each
+    period, between the days since and until when given, from the first
+    seen accounts.
+    """
+
+    times = time_range(since, until)
+    in_range = [{'$match': {'confirmationTime': times}}] if times else []
+
+    by_day = {
+        '$group': {
+            '_id': day_expression('confirmationTime'),
+            'count': {'$sum': 1}
+        }
+    }
+
+    if token is None and events is None:
+        cursor = db[FIRST_SEEN_COLLECTION].aggregate(in_range + [by_day])
+    else:
+        query = {}
+        if token is not None:
+            query['tokenInvolved'] = token
+        if events is not None:
+            query['event'] = {'$in': events}
+        if until is not None:
+            query['confirmationTime'] = time_range(until=until)
+        # the earliest of each address is known only after the $group
+        cursor = db[FIRST_SEEN_BY_COLLECTION].aggregate([{
+            '$match': query
+        }, {
+            '$group': {
+                '_id': '$address',
+                'confirmationTime': {'$min': '$confirmationTime'}
+            }
+        }] + in_range + [by_day])
+
+    buckets = {}
+    for row in await cursor.to_list(length=None):
+        key = bucket_date(date.fromisoformat(row['_id']), group_by)
+        buckets[key] = buckets.get(key, 0) + row['count']
+
+    return [(key, buckets[key]) for key in sorted(buckets)]
+
+
+def window_start(days, today=None):
+    """
+    First day of a window of the given days until today (UTC), the window
+    of the top transactors on every path
+    """
+    today = today or datetime.utcnow().date()
+    return today - timedelta(days=days)
+
+
+def window_since(days, today=None):
+    """
+    Returns the createdAt the window of the given days starts at
+    """
+    return datetime.combine(window_start(days, today), datetime.min.time())
+
+
+async def top_transactors_by_window(db, windows, top, rank_by='count'):
+    """
+    Returns {days: [(address, count, volume), ...]} with the top transactors
+    of each window, merged from the daily transactors rollup with a bounded
+    heap. Addresses are compared, and returned, in lower case.
+    """
+
+    today = datetime.utcnow().date()
+    starts = {days: window_start(days, today).isoformat() for days in windows}
+
+    rows = await db[TRANSACTORS_COLLECTION]\
+        .find({'day': {'$gte': min(starts.values())}},
+              {'day': 1, 'address': 1, 'count': 1, 'volume': 1, '_id': 0})\
+        .to_list(length=None)
+
+    totals = {days: {} for days in windows}
+    for row in rows:
+        address = (row.get('address') or '').lower()
+        volume = row['volume'].to_decimal() if row.get('volume') else 0
+        for days, start in starts.items():
+            if row['day'] < start:
+                continue
+            count, total_volume = totals[days].get(address, (0, Decimal(0)))
+            totals[days][address] = (count + row['count'],
+                                     total_volume + volume)
+
+    rank = 0 if rank_by=='count' else 1
+    return {days: [(address, ) + v for address, v in heapq.nlargest(
+                top, totals[days].items(), key=lambda i: i[1][rank])]
+            for days in windows}
+
+
+async def rollups_loop(interval):
+    while True:
+        for tenant in TENANTS.values():
+            try:
+                with use_tenant(tenant):
+                    db = await get_db("rollups")
+                    if db is not None:
+                        await refresh_rollups(db)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.exception(f'Could not refresh stats rollups of '
+                              f'{tenant["name"]}: {e}')
+        await asyncio.sleep(interval)
+
+
+async def start_rollups():
+    """
+    Starts refreshing the rollups every APP_STATS_ROLLUPS_INTERVAL seconds,
+    they stay disabled when it is not set
+    """
+    global _task
+    interval = get_env_var("APP_STATS_ROLLUPS_INTERVAL", (int, float))
+    if not interval:
+        return
+    for tenant in TENANTS.values():
+        with use_tenant(tenant):
+            db = await get_db()
+        for rollup in ROLLUPS.values():
+            await db[rollup["collection"]].create_index('day')
+        await db[FIRST_SEEN_COLLECTION].create_index('confirmationTime')
+        await db[FIRST_SEEN_BY_COLLECTION].create_index(
+            [('tokenInvolved', 1), ('event', 1)])
+    _task = asyncio.create_task(rollups_loop(interval))
+    log.info(f"Stats rollups refreshing every {interval}s.")
+
+
+async def stop_rollups():
+    global _task
+    if _task is None:
+        return
+    _task.cancel()
+    _task = None
+    _ready.clear()
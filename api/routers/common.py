@@ -1,3 +1,18 @@
+import asyncio
+import base64
+import json
+from datetime import datetime
+
+from bson import ObjectId
+from fastapi import HTTPException
+
+from api.cache import TotalsCache
+from api.tenants import get_tenant
+
+
+list_totals = TotalsCache()
+
+
 
 
 
@@ -30,3 +45,115 @@ def make_responses(*args):
             responses[code] = data
 
     return responses
+
+
+def encode_cursor(value, id_):
+    """
+    Returns an opaque cursor pointing after the row (value, _id), the value
+    may come already formatted by mongo_date_to_str
+    """
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    else:
+        value = value.rstrip('Z')
+    data = json.dumps([value, str(id_)])
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value, id_ = json.loads(data)
+        value = datetime.fromisoformat(value)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if ObjectId.is_valid(id_):
+        id_ = ObjectId(id_)
+    return value, id_
+
+
+def head_marker(rows):
+    """
+    Returns the marker of the newest document of a page, None if empty
+    """
+    if not rows:
+        return None
+    return rows[0].get('blockNumber'), str(rows[0]['_id'])
+
+
+async def find_page(collection, query_filter, sort_field, limit, skip=0,
+                    cursor=None, include_total=True, projection=None,
+                    **kwargs):
+    """
+    Returns a page of documents sorted by (sort_field, _id) descending, the
+    total of documents matching the filter and the cursor of the next page.
+
+    When a cursor is given the page starts right after it, so the index
+    seeks to the position instead of walking the skipped documents, and the
+    skip is ignored. The projection only applies to the page.
+
+    The page, the newest document and the count are requested concurrently.
+    Totals are memoized per filter and only counted again once a newer
+    document matches it. With include_total=False the total is None and no
+    count is requested at all.
+    """
+
+    page_filter = query_filter
+    if cursor is not None:
+        value, id_ = decode_cursor(cursor)
+        page_filter = dict(query_filter)
+        page_filter['$or'] = [
+            {sort_field: {'$lt': value}},
+            {sort_field: value, '_id': {'$lt': id_}}
+        ]
+        skip = 0
+
+    sort = [(sort_field, -1), ('_id', -1)]
+    first_page = cursor is None and skip == 0
+
+    queries = [
+        collection
+            .find(page_filter, projection, **kwargs)
+            .sort(sort)
+            .skip(skip)
+            .limit(limit)
+            .to_list(limit)
+    ]
+
+    total_key = (get_tenant()["name"], collection.full_name,
+                 repr(query_filter))
+    cached = list_totals.peek(total_key) if include_total else None
+
+    if include_total and not first_page:
+        queries.append(collection
+            .find(query_filter, {'blockNumber': 1}, **kwargs)
+            .sort(sort)
+            .limit(1)
+            .to_list(1))
+
+    if include_total and cached is None:
+        queries.append(collection.count_documents(query_filter, **kwargs))
+
+    results = await asyncio.gather(*queries)
+    rows = results[0]
+
+    total = None
+    if include_total:
+        marker = head_marker(rows if first_page else results[1])
+        if cached is None:
+            total = results[-1]
+            list_totals.set(total_key, marker, total)
+        elif marker is None:
+            total = 0
+        else:
+            total = list_totals.get(total_key, marker)
+            if total is None:
+                total = await collection.count_documents(
+                    query_filter, **kwargs)
+                list_totals.set(total_key, marker, total)
+
+    next_cursor = None
+    if rows and len(rows) == limit and rows[-1].get(sort_field) is not None:
+        next_cursor = encode_cursor(rows[-1][sort_field], rows[-1]['_id'])
+
+    return rows, total, next_cursor
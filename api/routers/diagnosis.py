@@ -0,0 +1,160 @@
+from bson import SON
+from fastapi import APIRouter, HTTPException
+
+from api.db import get_db
+from api.indexes import ADDRESS_COLLATION, QUERY_INDEXES, missing_indexes
+from api.rollups import window_since
+from api.models.stats import TransactionsCountEvent, EVENT_NAMES
+
+from .common import make_responses
+from .operations import transactions_filter
+
+
+router = APIRouter(tags=["Diagnosis"])
+
+
+ZERO_ADDRESS = '0x0000000000000000000000000000000000000000'
+
+
+async def canonical_queries(db):
+    """
+    Returns a find command per QUERY_INDEXES entry shaped like the query the
+    routers issue, filled with values sampled from the collections
+    """
+
+    sample = await db["Transaction"].find_one(
+        {'address': {'$ne': None}}, {'address': 1})
+    address = sample['address'] if sample else ZERO_ADDRESS
+
+    sample = await db["FastBtcBridge"].find_one(
+        {'rskAddress': {'$ne': None}}, {'rskAddress': 1})
+    rsk_address = sample['rskAddress'] if sample else ZERO_ADDRESS
+
+    since = window_since(30)
+    mint_and_redeem = EVENT_NAMES[TransactionsCountEvent.ONLY_MINT_AND_REDEEM]
+
+    return {
+        "transactions_list": {
+            'find': "Transaction",
+            'filter': transactions_filter(address),
+            'sort': SON([("createdAt", -1), ("_id", -1)]),
+            'limit': 20,
+            'collation': ADDRESS_COLLATION.document},
+        "peg_out_list": {
+            'find': "FastBtcBridge",
+            'filter': {"rskAddress": rsk_address.lower(), "type": "PEG_OUT"},
+            'sort': SON([("timestamp", -1), ("_id", -1)]),
+            'limit': 20,
+            'collation': ADDRESS_COLLATION.document},
+        "stats_token_event": {
+            'find': "Transaction",
+            'filter': {'tokenInvolved': 'STABLE',
+                       'event': {'$in': mint_and_redeem},
+                       'confirmationTime': {'$ne': None}},
+            'projection': {'confirmationTime': 1, 'amount': 1}},
+        "stats_confirmation_time": {
+            'find': "Transaction",
+            'filter': {'confirmationTime': {'$gte': since}},
+            'projection': {'confirmationTime': 1}},
+        "top_transactors": {
+            'find': "Transaction",
+            'filter': {'event': {'$in': mint_and_redeem},
+                       'createdAt': {'$gte': since}},
+            'projection': {'address': 1, 'USDAmount': 1}},
+        "rollups_high_water_mark": {
+            'find': "Transaction",
+            'filter': {'lastUpdatedAt': {'$ne': None}},
+            'projection': {'lastUpdatedAt': 1},
+            'sort': {'lastUpdatedAt': -1},
+            'limit': 1},
+        "peg_out_watermark": {
+            'find': "FastBtcBridge",
+            'filter': {'updated': {'$ne': None}},
+            'projection': {'updated': 1},
+            'sort': {'updated': -1},
+            'limit': 1}
+    }
+
+
+def plan_values(plan, key):
+    """
+    Returns every value of the key found in the (nested) plan
+    """
+    values = []
+    if isinstance(plan, dict):
+        for k, v in plan.items():
+            if k==key:
+                values.append(v)
+            else:
+                values += plan_values(v, key)
+    elif isinstance(plan, list):
+        for v in plan:
+            values += plan_values(v, key)
+    return values
+
+
+def plan_report(name, explain):
+    collection, expected = QUERY_INDEXES[name]
+    winning_plan = explain.get('queryPlanner', {}).get('winningPlan', {})
+    stats = explain.get('executionStats', {})
+    indexes = sorted(set(plan_values(winning_plan, 'indexName')))
+    return {
+        "query": name,
+        "collection": collection,
+        "expected_index": expected,
+        "indexes_used": indexes,
+        "uses_expected_index": expected in indexes,
+        "collscan": 'COLLSCAN' in plan_values(winning_plan, 'stage'),
+        "executed": bool(stats),
+        "docs_examined": stats.get('totalDocsExamined'),
+        "keys_examined": stats.get('totalKeysExamined'),
+        "returned": stats.get('nReturned'),
+        "millis": stats.get('executionTimeMillis')
+    }
+
+
+async def index_usage(db, collection):
+    cursor = db[collection].aggregate([{'$indexStats': {}}])
+    return [{
+        "name": s['name'],
+        "ops": s['accesses']['ops'],
+        "since": s['accesses']['since']
+    } for s in await cursor.to_list(length=None)]
+
+
+@router.get(
+    "/diagnosis/indexes",
+    response_description="Successful Response",
+    responses = make_responses(503)
+)
+async def indexes_report():
+    """
+    Explains the plan of a canonical instance of each query the routers
+    issue and reports the indexes they use, collection scans, the missing
+    indexes and `$indexStats` usage. The bounded ones (with a limit) are
+    run to report the documents examined versus returned, the unbounded
+    stats scans are not.
+    """
+
+    # get mongo db connection
+    db = await get_db()
+
+    if db is None:
+        raise HTTPException(status_code=503, detail="Cannot get DB access")
+
+    queries = []
+    for name, command in (await canonical_queries(db)).items():
+        # queryPlanner only picks the plan, the query is not executed
+        verbosity = 'executionStats' if 'limit' in command \
+            else 'queryPlanner'
+        explain = await db.command('explain', command, verbosity=verbosity)
+        queries.append(plan_report(name, explain))
+
+    collections = sorted(set(c for c, _ in QUERY_INDEXES.values()))
+
+    return {
+        "missing": [{"collection": c, "index": i}
+                    for c, i in await missing_indexes(db)],
+        "queries": queries,
+        "index_usage": {c: await index_usage(db, c) for c in collections}
+    }
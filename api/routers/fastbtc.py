@@ -2,20 +2,55 @@ from fastapi import APIRouter, Query, HTTPException
 from typing import Annotated
 
 from api.db import get_db
-from api.models.fastbtc import mongo_date_to_str, PegOutList
+from api.cache import cached, pages_cache
+from api.models.fastbtc import FastBtcBridge, PegOutList
+from api.models.common import model_projection
+from api.indexes import ADDRESS_COLLATION
+from api.serialization import fast_response
 
-from .common import make_responses
+from .common import make_responses, find_page
 
 
 router = APIRouter()
 
 
+@cached('pegout_list', ttl=0, cache=pages_cache)
+async def peg_out_page(address, limit, skip, cursor, include_total):
+    """
+    Returns the pegout requests, total and next_cursor of a page of the
+    pegout requests of an address
+    """
+
+    # get mongo db connection
+    db = await get_db("webapp")
+
+    if db is None:
+        raise HTTPException(status_code=503, detail="Cannot get DB access")
+
+    query_filter = {
+        "rskAddress": address.lower(),
+        "type": "PEG_OUT"
+    }
+
+    transactions, transactions_count, next_cursor = await find_page(
+        db["FastBtcBridge"], query_filter, "timestamp", limit,
+        skip=skip, cursor=cursor, include_total=include_total,
+        projection=model_projection(FastBtcBridge),
+        collation=ADDRESS_COLLATION)
+
+    # _id is only projected for the cursor
+    for trx in transactions:
+        del trx['_id']
+
+    return transactions, transactions_count, next_cursor
+
+
 @router.get(
     "/api/v1/webapp/fastbtc/pegout/",
     tags=["Webapp"],
     response_description="Successful Response",
     response_model=PegOutList,
-    responses = make_responses(503)
+    responses = make_responses(503, 400)
 )
 async def peg_out_list(
         address: Annotated[str, Query(
@@ -29,44 +64,26 @@ async def peg_out_list(
         skip: Annotated[int, Query(
             title="Skip",
             description="Skip",
-            le=10000)] = 0):
+            le=10000)] = 0,
+        cursor: Annotated[str, Query(
+            title="Cursor",
+            description="Cursor returned as next_cursor by the previous "
+                        "page, when given skip is ignored")] = None,
+        include_total: Annotated[bool, Query(
+            title="Include total",
+            description="Set to false to skip counting the total")] = True):
     """
     Returns the pegout requests from an address
     """
 
-    # get mongo db connection
-    db = await get_db()
-
-    if db is None:
-        raise HTTPException(status_code=503, detail="Cannot get DB access")
-
-    query_filter = {
-        "rskAddress": {"$regex": address, '$options': 'i'},
-        "type": "PEG_OUT"
-    }
-
-    transactions = await db["FastBtcBridge"]\
-        .find(query_filter)\
-        .sort("timestamp", -1)\
-        .skip(skip)\
-        .limit(limit)\
-        .to_list(limit)
-
-    transactions_count = await db["FastBtcBridge"].count_documents(query_filter)
-
-    for trx in transactions:
-        trx['_id'] = str(trx['_id'])
-
-        if trx.get("timestamp"):
-            trx['timestamp'] = mongo_date_to_str(trx['timestamp'])
-
-        if trx.get("updated"):
-            trx['updated'] = mongo_date_to_str(trx['updated'])
+    transactions, transactions_count, next_cursor = await peg_out_page(
+        address, limit, skip, cursor, include_total)
 
     dict_values = {
         "pegout_requests": transactions,
         "count": len(transactions),
-        "total": transactions_count
+        "total": transactions_count,
+        "next_cursor": next_cursor
     }
 
-    return dict_values
+    return fast_response(dict_values)
@@ -0,0 +1,66 @@
+import asyncio
+from typing import Annotated
+
+from fastapi import APIRouter, Query
+from fastapi.responses import StreamingResponse
+
+from api import live
+from api.serialization import dumps
+
+
+router = APIRouter()
+
+
+# Seconds between the comments that keep idle connections open through the
+# proxies
+HEARTBEAT_INTERVAL = 15
+
+# Milliseconds a client waits before reconnecting
+RETRY_MS = 3000
+
+
+async def event_stream(address):
+    # subscribed only once the response streams, so a client gone before
+    # that leaves no subscriber behind
+    subscription = live.subscribe(address)
+    try:
+        yield f"retry: {RETRY_MS}\n\n".encode()
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.get(),
+                                               HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                yield b": keep-alive\n\n"
+                continue
+            if event is None:
+                # fell behind, the client reconnects and reloads the lists
+                yield b"event: dropped\ndata: {}\n\n"
+                return
+            collection, document = event
+            yield b"event: " + collection.encode() + b"\ndata: " + \
+                dumps(document) + b"\n\n"
+    finally:
+        live.unsubscribe(subscription)
+
+
+@router.get(
+    "/api/v1/webapp/live/",
+    tags=["Webapp"],
+    response_description="Server-Sent Events stream",
+    response_class=StreamingResponse
+)
+async def live_feed(
+        address: Annotated[str, Query(
+            title="Address",
+            description="User Address",
+            regex='^0x[a-fA-F0-9]{40}$')]):
+    """
+    Streams the new and updated transactions (`Transaction` events) and
+    pegout requests (`FastBtcBridge` events) of an address as Server-Sent
+    Events, shaped like the rows of the list routes. Pending operations
+    show up again as their status and confirmingPercent move.
+    """
+    return StreamingResponse(
+        event_stream(address),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
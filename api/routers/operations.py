@@ -1,21 +1,154 @@
 from fastapi import APIRouter, Query, HTTPException
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse, \
+    JSONResponse
 from typing import Annotated
 from tabulate import tabulate
 from decimal import Decimal
-
-from api.db import get_db, VENDOR_ADDRESS, COMMISSION_SPLITTER_V2
+from datetime import datetime
+import asyncio
+import csv
+import io
+
+from api.db import get_db
+from api.cache import cached, pages_cache
+from api.tenants import tenant_setting
 from api.models.operations import TokenName, EXCLUDED_EVENTS, \
-    mongo_date_to_str, TransactionsList
+    Transactions, TransactionsList, TRANSACTIONS_FIELDS, \
+    transactions_projection, TransactionsBatchRequest, TransactionsBatch
 
-from api.models.common import OutputFormat
+from api.models.common import OutputFormat, ExportFormat, model_document
+from api.indexes import ADDRESS_COLLATION
+from api.serialization import FAST_SERIALIZATION, fast_response, dumps
 
-from .common import make_responses
+from .common import make_responses, find_page
 
 
 router = APIRouter()
 
 
+TABLE_HEADERS = ['Date / time', '#Block', 'Asset', 'Event', 'Platform',
+                 'Wallet', 'Destination or origin']
+
+
+def transactions_filter(address, token=None):
+
+    query_filter = {
+        "address": address.lower(),
+        "event": {"$not": {"$in": EXCLUDED_EVENTS}},
+        "otherAddress": {"$not": {"$in": [
+            tenant_setting("VENDOR_ADDRESS"),
+            tenant_setting("COMMISSION_SPLITTER_V2")]}}
+    }
+
+    if token is not None:
+        query_filter["tokenInvolved"] = token.value
+
+    return query_filter
+
+
+def selected_fields(names):
+    """
+    Returns the set of fields to project, createdAt is always needed for the
+    cursor
+    """
+    fields = set(f.strip() for f in names if f.strip())
+    unknown = fields - set(TRANSACTIONS_FIELDS)
+    if unknown:
+        raise HTTPException(status_code=400,
+            detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    fields.add('createdAt')
+    return fields
+
+
+def transaction_row(tx):
+    """
+    Returns the TABLE_HEADERS columns of a transaction
+    """
+
+    row = []
+
+    for key in ['createdAt', 'blockNumber']:
+        row.append(tx.get(key, None))
+    
+    asset = str(tx['tokenInvolved'])       
+    if asset==TokenName.RISKPRO.value:
+        asset = 'Pro'
+    elif asset==TokenName.RISKPROX.value:
+        asset = 'ProX'
+    elif asset==TokenName.STABLE.value:
+        asset = 'Stable'
+    else:
+        asset = asset.lower()
+    asset = {
+        'tg': 'Governance'
+    }.get(asset, asset)   
+    row.append(asset)
+
+    event = str(tx['event']).lower()
+    if 'mint' in event:
+        event = 'mint'
+    elif 'redeem' in event:
+        event = 'redeem'
+    row.append(event.title())
+
+    platform = Decimal(tx.get('amount', 0))/Decimal(10**18)
+    if event=='redeem':
+        platform = -platform
+    elif event=='transfer' and not(tx['isPositive']):
+        platform = -platform
+    row.append(platform)
+
+    wallet = tx.get('RBTCTotal', None)
+    if wallet is not None:
+        wallet = Decimal(wallet)/Decimal(10**18)
+        if event!='redeem':
+            wallet = -wallet
+    row.append(wallet)
+
+    row.append(tx.get('otherAddress', None))
+
+    return row
+
+
+@cached('transactions_list', ttl=0, cache=pages_cache)
+async def transactions_page(address, token, limit, skip, cursor,
+                            include_total, fields, json_format):
+    """
+    Returns the transactions, total and next_cursor of a page of the
+    transactions of an address, json ones shaped by the projection
+    """
+
+    # get mongo db connection
+    db = await get_db("webapp")
+
+    if db is None:
+        raise HTTPException(status_code=503, detail="Cannot get DB access")
+
+    query_filter = transactions_filter(address, token)
+
+    projection = transactions_projection(fields) if json_format else None
+
+    return await find_page(
+        db["Transaction"], query_filter, "createdAt", limit,
+        skip=skip, cursor=cursor, include_total=include_total,
+        projection=projection, collation=ADDRESS_COLLATION)
+
+
+def token_label(token):
+    if token==TokenName.RISKPRO:
+        return 'Pro'
+    elif token==TokenName.RISKPROX:
+        return 'ProX'
+    elif token==TokenName.STABLE:
+        return 'Stable'
+    return 'All'
+
+
+def title_lines(address):
+    title = ' '.join(f"Account: {address}".split())
+    return [title, ' '.join([len(x)*"=" for x in title.split()]), '']
+
+
 @router.get(
     "/api/v1/webapp/transactions/list/",
     tags=["Webapp"],
@@ -52,7 +185,7 @@ Date / time            #Block  Asset       Event            Platform        Wall
                 }
             }
         }),
-        503
+        503, 400
     )
 )
 async def transactions_list(
@@ -69,122 +202,63 @@ async def transactions_list(
             title="Skip",
             description="Skip",
             le=10000)] = 0,
+        cursor: Annotated[str, Query(
+            title="Cursor",
+            description="Cursor returned as next_cursor by the previous "
+                        "page, when given skip is ignored")] = None,
+        include_total: Annotated[bool, Query(
+            title="Include total",
+            description="Set to false to skip counting the total")] = True,
+        fields: Annotated[str, Query(
+            title="Fields",
+            description="Comma separated fields of the transactions to "
+                        "return, _id, address, transactionHash and "
+                        "createdAt are always included")] = None,
         format: OutputFormat = None,
         ):
     """
     Returns a list of operations of the given address user
     """
 
-    # get mongo db connection
-    db = await get_db()
-
-    if db is None:
-        raise HTTPException(status_code=503, detail="Cannot get DB access")
+    if fields is not None:
+        fields = selected_fields(fields.split(','))
 
-    query_filter = {
-        "address": {"$regex": address, '$options': 'i'},
-        "event": {"$not": {"$in": EXCLUDED_EVENTS}},
-        "otherAddress": {"$not": {"$in": [VENDOR_ADDRESS, COMMISSION_SPLITTER_V2]}}
-    }
-
-    if token is not None:
-        query_filter["tokenInvolved"] = token.value
+    json_format = format in [OutputFormat.JSON, None]
 
-    transactions = await db["Transaction"]\
-        .find(query_filter)\
-        .sort("createdAt", -1)\
-        .skip(skip)\
-        .limit(limit)\
-        .to_list(limit)
+    # the text output always shows the total and needs the raw documents,
+    # json ones come already shaped by the projection
+    if not json_format:
+        include_total = True
 
-    transactions_count = await db["Transaction"].count_documents(query_filter)
+    transactions, transactions_count, next_cursor = await transactions_page(
+        address, token, limit, skip, cursor, include_total,
+        sorted(fields) if fields is not None else None, json_format)
 
-    if format in [OutputFormat.JSON, None]:
-
-        for trx in transactions:
-            trx['_id'] = str(trx['_id'])
-
-            if trx.get("createdAt"):
-                trx['createdAt'] = mongo_date_to_str(trx['createdAt'])
-
-            if trx.get("lastUpdatedAt"):
-                trx['lastUpdatedAt'] = mongo_date_to_str(trx['lastUpdatedAt'])
-
-            if trx.get("confirmationTime"):
-                trx['confirmationTime'] = mongo_date_to_str(trx['confirmationTime'])
+    if json_format:
 
         dict_values = {
             "transactions": transactions,
             "count": len(transactions),
-            "total": transactions_count
+            "total": transactions_count,
+            "next_cursor": next_cursor
         }
 
-        return dict_values
+        if FAST_SERIALIZATION or fields is None:
+            return fast_response(dict_values)
+
+        # leave out the fields that were not selected
+        return JSONResponse(TransactionsList(**dict_values).model_dump(
+            mode='json', by_alias=True, exclude_unset=True))
     
     table = []
     
     for tx in transactions:
-        
-        row = []
-
-        for key in ['createdAt', 'blockNumber']:
-            row.append(tx.get(key, None))
-        
-        asset = str(tx['tokenInvolved'])       
-        if asset==TokenName.RISKPRO.value:
-            asset = 'Pro'
-        elif asset==TokenName.RISKPROX.value:
-            asset = 'ProX'
-        elif asset==TokenName.STABLE.value:
-            asset = 'Stable'
-        else:
-            asset = asset.lower()
-        asset = {
-            'tg': 'Governance'
-        }.get(asset, asset)   
-        row.append(asset)
-
-        event = str(tx['event']).lower()
-        if 'mint' in event:
-            event = 'mint'
-        elif 'redeem' in event:
-            event = 'redeem'
-        row.append(event.title())
-
-        platform = Decimal(tx.get('amount', 0))/Decimal(10**18)
-        if event=='redeem':
-            platform = -platform
-        elif event=='transfer' and not(tx['isPositive']):
-            platform = -platform
-        row.append(platform)
-
-        wallet = tx.get('RBTCTotal', None)
-        if wallet is not None:
-            wallet = Decimal(wallet)/Decimal(10**18)
-            if event!='redeem':
-                wallet = -wallet
-        row.append(wallet)
-
-        row.append(tx.get('otherAddress', None))
-
-        table.append(row)
-
-    text = []
-
-    title = f"Account: {address}"
-
-    str_token = 'All'
-    if token==TokenName.RISKPRO:
-        str_token = 'Pro'
-    elif token==TokenName.RISKPROX:
-        str_token = 'ProX'
-    elif token==TokenName.STABLE:
-        str_token = 'Stable'
+        table.append(transaction_row(tx))
+
+    text = title_lines(address)
+
+    str_token = token_label(token)
 
-    title = ' '.join(title.split())
-    text.append(title)       
-    text.append(' '.join([len(x)*"=" for x in title.split()]))       
-    text.append('')    
     if len(transactions)==transactions_count:
         text.append(tabulate([
             ['Token:', str_token],
@@ -199,11 +273,7 @@ async def transactions_list(
             ['Total:', transactions_count]
         ], tablefmt='plain'))
     text.append('')
-    text.append(tabulate(table,
-                            headers=[
-                                'Date / time', '#Block', 'Asset',
-                                'Event', 'Platform', 'Wallet',
-                                'Destination or origin']))
+    text.append(tabulate(table, headers=TABLE_HEADERS))
     text.append('')
     text = '\n'.join(text)
 
@@ -213,3 +283,211 @@ async def transactions_list(
 
     return response
 
+
+def feed_key(tx):
+    """
+    Returns the (createdAt, _id) a transaction is sorted by on the lists,
+    whether its createdAt comes formatted by the projection or not
+    """
+    created = tx["createdAt"]
+    if isinstance(created, str):
+        created = datetime.fromisoformat(created.rstrip('Z'))
+    return created, str(tx["_id"])
+
+
+# single address pages requested at once by a transactions batch
+BATCH_CONCURRENCY = 5
+
+
+@router.post(
+    "/api/v1/webapp/transactions/batch/",
+    tags=["Webapp"],
+    response_description="Successful Response",
+    response_model=TransactionsBatch,
+    responses = make_responses(503, 400)
+)
+async def transactions_batch(request: TransactionsBatchRequest):
+    """
+    Returns the first page of operations (and the total) of each one of the
+    given addresses, and optionally their operations merged in one feed.
+    Each next_cursor continues the list of its address.
+    """
+
+    fields = None
+    if request.fields is not None:
+        fields = selected_fields(request.fields)
+
+    addresses = list(dict.fromkeys(a.lower() for a in request.addresses))
+
+    # the same indexed page of the list of a single address, a few at once
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def address_page(address):
+        async with semaphore:
+            return await transactions_page(
+                address, request.token, request.limit, 0, None,
+                request.include_total,
+                sorted(fields) if fields is not None else None, True)
+
+    pages = await asyncio.gather(*[address_page(a) for a in addresses])
+
+    accounts = []
+    for address, (transactions, total, next_cursor) in zip(addresses, pages):
+        accounts.append({
+            "address": address,
+            "transactions": transactions,
+            "count": len(transactions),
+            "total": total,
+            "next_cursor": next_cursor
+        })
+
+    merged = None
+    if request.merged:
+        # the newest operations of all of them are among the first pages
+        merged = sorted(
+            (tx for transactions, _, _ in pages for tx in transactions),
+            key=feed_key, reverse=True)[:request.limit]
+
+    dict_values = {
+        "accounts": accounts,
+        "merged": merged
+    }
+
+    if FAST_SERIALIZATION or fields is None:
+        return fast_response(dict_values)
+
+    # leave out the fields that were not selected
+    return JSONResponse(TransactionsBatch(**dict_values).model_dump(
+        mode='json', by_alias=True, exclude_unset=True))
+
+
+# documents fetched per round trip and lines written per chunk on exports
+EXPORT_BATCH_SIZE = 500
+
+# fixed width of each TABLE_HEADERS column on text exports
+TEXT_WIDTHS = [19, 8, 10, 8, 28, 28, 42]
+
+
+def export_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, Decimal):
+        return format(value, 'f')
+    return str(value)
+
+
+def text_line(values):
+    cells = []
+    for value, width in zip(values, TEXT_WIDTHS):
+        if isinstance(value, (int, Decimal)):
+            cells.append(export_value(value).rjust(width))
+        else:
+            cells.append(export_value(value).ljust(width))
+    return '  '.join(cells).rstrip() + '\n'
+
+
+def csv_line(values):
+    out = io.StringIO()
+    csv.writer(out, lineterminator='\n').writerow(
+        [export_value(v) for v in values])
+    return out.getvalue()
+
+
+def ndjson_line(tx):
+    """
+    Returns the transaction as the list routes return it
+    """
+    return dumps(model_document(Transactions, tx)).decode() + '\n'
+
+
+async def export_lines(cursor, address, token, format):
+    """
+    Yields the export in chunks of EXPORT_BATCH_SIZE lines, as the
+    documents arrive from the cursor
+    """
+
+    chunk = []
+
+    if format==ExportFormat.TEXT:
+        chunk += [line + '\n' for line in title_lines(address)]
+        chunk.append(f"Token:  {token_label(token)}\n\n")
+        chunk.append(text_line(TABLE_HEADERS))
+        chunk.append(text_line(['-' * w for w in TEXT_WIDTHS]))
+    elif format==ExportFormat.CSV:
+        chunk.append(csv_line(TABLE_HEADERS + ['Transaction hash']))
+
+    async for tx in cursor:
+        if format==ExportFormat.NDJSON:
+            chunk.append(ndjson_line(tx))
+        elif format==ExportFormat.CSV:
+            chunk.append(csv_line(
+                transaction_row(tx) + [tx.get('transactionHash')]))
+        else:
+            chunk.append(text_line(transaction_row(tx)))
+        if len(chunk) >= EXPORT_BATCH_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+
+    if chunk:
+        yield ''.join(chunk)
+
+
+@router.get(
+    "/api/v1/webapp/transactions/export/",
+    tags=["Webapp"],
+    response_description="Successful Response",
+    response_class=StreamingResponse,
+    responses = make_responses(
+       (200, {
+           "description": "Successful Response",
+           "content": {
+                "text/csv": {
+                   "example": """Date / time,#Block,Asset,Event,Platform,Wallet,Destination or origin,Transaction hash
+2024-02-08 14:35:27,6065900,Stable,Transfer,-549.78,,0x0000000000000000000000000000000000000002,0x0000000000000000000000000000000000000000000000000000000000000001
+"""
+                },
+                "application/x-ndjson": {
+                   "example": """{"_id":"65c4e6a1d2c1f7a1b2c3d4e5","address":"0x0000000000000000000000000000000000000001","event":"Transfer","createdAt":"2024-02-08T14:35:27Z"}
+"""
+                }
+            }
+        }),
+        503
+    )
+)
+async def transactions_export(
+        address: Annotated[str, Query(
+            title="Address",
+            description="User Address",
+            regex='^0x[a-fA-F0-9]{40}$')] = '0xCD8A1c9aCc980ae031456573e34dC05cD7daE6e3',
+        token: TokenName = None,
+        format: ExportFormat = ExportFormat.CSV,
+        ):
+    """
+    Exports the complete history of operations of the given address user,
+    streamed as it is read
+    """
+
+    # get mongo db connection
+    db = await get_db("webapp")
+
+    if db is None:
+        raise HTTPException(status_code=503, detail="Cannot get DB access")
+
+    cursor = db["Transaction"]\
+        .find(transactions_filter(address, token),
+              collation=ADDRESS_COLLATION)\
+        .sort([("createdAt", -1), ("_id", -1)])\
+        .batch_size(EXPORT_BATCH_SIZE)
+
+    media_type, extension = {
+        ExportFormat.CSV: ('text/csv', 'csv'),
+        ExportFormat.NDJSON: ('application/x-ndjson', 'ndjson'),
+        ExportFormat.TEXT: ('text/plain', 'txt')
+    }[format]
+
+    return StreamingResponse(
+        export_lines(cursor, address, token, format),
+        media_type=media_type,
+        headers={"Content-Disposition":
+                 f"attachment; filename=tx_account_{address}.{extension}"})
@@ -1,15 +1,28 @@
 from fastapi import APIRouter, HTTPException, Query
+from api.common import get_env_var
 from api.db import get_db
+from api.logger import log
+from api.tenants import get_tenant
+from api import rollups, columnar
+from api.cache import cached, stale_response
+from api.admission import admitted
+from api.pipelines import period_date, transactions_pipeline
+from api.serialization import FAST_SERIALIZATION, FastJSONResponse, \
+    fast_response
 from .common import make_responses
 from api.models.stats import (TransactionsCountList, Periods,
                               TransactionsCountType, TransactionsCountToken,
                               TransactionsCountEvent, TransactionsCountFnc,
-                              TopTransactorList)
-from fastapi.responses import PlainTextResponse
+                              TopTransactorList, TopTransactorWindows, RankBy,
+                              StatsSeriesRequest, StatsSeries,
+                              TOKEN_INVOLVED, EVENT_NAMES)
+from fastapi.responses import JSONResponse, PlainTextResponse
 from api.models.common import OutputFormat
-from typing import Annotated
+from typing import Annotated, List
 from tabulate import tabulate
-from datetime import datetime, timedelta
+from datetime import date as date_type
+import asyncio
+import time
 
 
 link_url = 'https://grafana.moneyonchain.com/'
@@ -21,20 +34,21 @@ tags_metadata = [{
 
 router = APIRouter(tags=["Stats"])
 
+# Seconds the responses that end on a closed day can be reused, bounded
+# since a reindex of the indexer can still change them
+CLOSED_MAX_AGE = get_env_var("APP_STATS_CLOSED_MAX_AGE", int) or 86400
 
-async def transactions_base(
-    type: TransactionsCountType = TransactionsCountType.ONLY_NEW_ACCOUNTS,
-    token: TransactionsCountToken = TransactionsCountToken.ALL,
-    event: TransactionsCountEvent = TransactionsCountEvent.ALL,
-    group_by: Periods = Periods.DAY,
-    fnc: TransactionsCountFnc = TransactionsCountFnc.COUNT
-    ):
+# Every stats computation within this many seconds shares one read of the
+# closed mark, per tenant
+CLOSED_MARK_TTL = 5.0
 
-    # get mongo db connection
-    db = await get_db()
+_closed_marks = {}
 
-    if db is None:
-        raise HTTPException(status_code=503, detail="Cannot get DB access")
+
+def check_series(type, token, event, fnc):
+    """
+    Raises an HTTPException for the combinations that make no sense
+    """
 
     if type==TransactionsCountType.ONLY_NEW_ACCOUNTS \
             and fnc==TransactionsCountFnc.SUM:
@@ -52,205 +66,81 @@ async def transactions_base(
                    TransactionsCountEvent.ONLY_REDEEM,
                    TransactionsCountEvent.ONLY_MINT_AND_REDEEM]):
         raise HTTPException(status_code=404,
-            detail=("governance token cannot be redeemed or minted."))   
+            detail=("governance token cannot be redeemed or minted."))
 
-    query = []
 
-    if token==TransactionsCountToken.ONLY_STABLE:
-        query.append({
-            '$match': {
-                'tokenInvolved': 'STABLE'
-            }    
-        })
-    elif token==TransactionsCountToken.ONLY_PRO:
-        query.append({
-            '$match': {
-                'tokenInvolved': 'RISKPRO'
-            }    
-        })
-    elif token==TransactionsCountToken.ONLY_GOVERNANCE:
-        query.append({
-            '$match': {
-                'tokenInvolved': 'MOC'
-            }    
-        })
+@cached('transactions_base', ttl=60)
+@admitted('transactions_base')
+async def transactions_base(
+    type: TransactionsCountType = TransactionsCountType.ONLY_NEW_ACCOUNTS,
+    token: TransactionsCountToken = TransactionsCountToken.ALL,
+    event: TransactionsCountEvent = TransactionsCountEvent.ALL,
+    group_by: Periods = Periods.DAY,
+    fnc: TransactionsCountFnc = TransactionsCountFnc.COUNT,
+    from_: date_type = None,
+    to: date_type = None
+    ):
 
-    if event==TransactionsCountEvent.ONLY_TRANSFER:
-        query.append({
-            '$match': {
-                'event': 'Transfer'
-            }    
-        })
-    elif event==TransactionsCountEvent.ONLY_MINT:
-        query.append({
-            '$match': {
-                '$or': [
-                    {'event' : "RiskProMint"},
-                    {'event' : "StableTokenMint"}
-                ]
-            }    
-        })
-    elif event==TransactionsCountEvent.ONLY_REDEEM:
-        query.append({
-            '$match': {
-                '$or': [
-                    {'event' : "RiskProRedeem"},
-                    {'event' : "FreeStableTokenRedeem"}
-                ]
-            }    
-        })
-    elif event==TransactionsCountEvent.ONLY_MINT_AND_REDEEM:
-        query.append({
-            '$match': {
-                '$or': [
-                    {'event' : "RiskProMint"},
-                    {'event' : "StableTokenMint"},
-                    {'event' : "RiskProRedeem"},
-                    {'event' : "FreeStableTokenRedeem"}
-                ]
-            }    
-        })
+    # get mongo db connection
+    db = await get_db("stats")
 
-    if type==TransactionsCountType.ALL: # start from all
-        query.append({
-            '$project': {
-                'amount': '$amount',
-                'timestamp': '$confirmationTime'
-            }
-        })
-    else: # start from only new accounts
-        query.append({
-            '$group': {
-                '_id': '$address', 
-                'timestamp': {
-                    '$first': '$confirmationTime'
-                }
-            }
-        })
-    
-    query.append({
-        '$match': {
-            'timestamp': {
-                '$ne': None
-            }
-        }    
-    })
+    if db is None:
+        raise HTTPException(status_code=503, detail="Cannot get DB access")
 
-    if group_by==Periods.WEEK:
-        query.append({
-            '$project': {
-                'amount': '$amount',
-                'date': {
-                    '$dateToString': {
-                        'format': '%Y-%m-%d', 
-                        'date': {
-                            '$dateFromParts': {
-                                'isoWeekYear': {
-                                    '$year': '$timestamp'
-                                }, 
-                                'isoWeek': {
-                                    '$isoWeek': '$timestamp'
-                                },
-                                "isoDayOfWeek": 7,
-                            }
-                        }
-                    }
-                }
-            }
-        })
-    
-    elif group_by==Periods.MONTH:
-        query.append({
-            '$project': {
-                'amount': '$amount',
-                'date': {
-                    '$dateToString': {
-                        'format': '%Y-%m-%d', 
-                        'date': {
-                            '$subtract': [
-                                {
-                                    '$dateFromParts': {
-                                        'year': {
-                                            '$year': '$timestamp'
-                                        }, 
-                                        'month': {
-                                            '$add': [
-                                                {
-                                                    '$month': '$timestamp'
-                                                },
-                                                1
-                                            ]
-                                        }
-                                    }
-                                },
-                                86400000
-                            ]
-                        }
-                    }
-                }
-            }
-        })
-    
-    elif group_by==Periods.YEAR:
-        query.append({
-            '$project': {
-                'amount': '$amount',
-                'date': {
-                    '$dateToString': {
-                        'format': '%Y-12-31', 
-                        'date': '$timestamp'
-                    }
-                }
-            }
-        })
-    
-    else: # group per day
-        query.append({
-            '$project': {
-                'amount': '$amount',
-                'date': {
-                    '$dateToString': {
-                        'format': '%Y-%m-%d', 
-                        'date': '$timestamp'
-                    }
-                }
-            }
-        })
-    
-    if fnc==TransactionsCountFnc.COUNT:
-        query.append({
-            '$group': {
-                '_id': '$date', 
-                'count': {
-                    '$sum': 1.0
-                }
-            }
-        })
-    else:
-        query.append({
-            '$group': {
-                '_id': '$date', 
-                'count': {
-                    '$sum': { '$toDecimal': '$amount' }
-                }
-            }
-        })
-    
-    query.append({
-        '$sort': {
-            '_id': 1
-        }
-    })
-    
-    cursor = db["Transaction"].aggregate(query)
- 
-    accounts = await cursor.to_list(length=None)
+    check_series(type, token, event, fnc)
+
+    # read first, the values are computed at least up to it
+    mark = await closed_mark()
 
     if fnc==TransactionsCountFnc.COUNT:
         transform_count = lambda x: float(str(x))
     else:
         transform_count = lambda x: float(str(x))/(10**18)
 
+    snapshot = columnar.ready_snapshot()
+    if snapshot is not None:
+        buckets = snapshot.count_by_date(
+            type, TOKEN_INVOLVED.get(token), EVENT_NAMES.get(event), group_by,
+            fnc, from_, to)
+        return {
+            "accounts": [{'date': b[0], 'count': transform_count(b[1])}
+                         for b in buckets],
+            "group_by": group_by.value,
+            "type": type.value,
+            "closed_mark": mark
+        }
+
+    if type==TransactionsCountType.ALL and await rollups.rollup_ready(db):
+        buckets = await rollups.transactions_by_date(
+            db, TOKEN_INVOLVED.get(token), EVENT_NAMES.get(event), group_by,
+            from_, to)
+        value = 1 if fnc==TransactionsCountFnc.COUNT else 2
+        return {
+            "accounts": [{'date': b[0], 'count': transform_count(b[value])}
+                         for b in buckets],
+            "group_by": group_by.value,
+            "type": type.value,
+            "closed_mark": mark
+        }
+
+    if type==TransactionsCountType.ONLY_NEW_ACCOUNTS \
+            and await rollups.rollup_ready(db, "first_seen"):
+        buckets = await rollups.new_accounts_by_date(
+            db, TOKEN_INVOLVED.get(token), EVENT_NAMES.get(event), group_by,
+            from_, to)
+        return {
+            "accounts": [{'date': b[0], 'count': transform_count(b[1])}
+                         for b in buckets],
+            "group_by": group_by.value,
+            "type": type.value,
+            "closed_mark": mark
+        }
+
+    cursor = db["Transaction"].aggregate(list(transactions_pipeline(
+        type, token, event, group_by, fnc, from_, to)))
+ 
+    accounts = await cursor.to_list(length=None)
+
     transform_fnc = lambda x: {'date': x['_id'],
                                'count': transform_count(x['count']) }
 
@@ -259,12 +149,117 @@ async def transactions_base(
     dict_values = {
         "accounts": accounts,
         "group_by": group_by.value,
-        "type": type.value
+        "type": type.value,
+        "closed_mark": mark
     }
 
     return dict_values
 
 
+def date_range(group_by, from_=None, to=None, since_bucket=None):
+    """
+    Returns the from and to days of a request, since_bucket (the last bucket
+    the client has complete) moves from up to the first day of that bucket
+    and of the later ones
+    """
+    if since_bucket is not None:
+        start = rollups.first_day(since_bucket, group_by)
+        from_ = start if from_ is None else max(from_, start)
+    if from_ is not None and to is not None and from_ > to:
+        raise HTTPException(status_code=400,
+            detail="from cannot be later than to.")
+    return from_, to
+
+
+async def closed_mark():
+    """
+    Returns the confirmationTime that closes the periods: the latest one
+    the indexer reached among the transactions the stats are computed from
+    (the ones synced by the columnar engine and the ones in the rollups,
+    when they answer them). Read at most once every CLOSED_MARK_TTL seconds,
+    the previous one (or None) is kept when it cannot be read.
+    """
+    key = get_tenant()["name"]
+    cached = _closed_marks.get(key)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+
+    mark = cached[0] if cached is not None else None
+    db = await get_db("stats")
+    if db is not None:
+        try:
+            until = []
+            snapshot = columnar.ready_snapshot()
+            if snapshot is not None:
+                until.append(snapshot.synced_until)
+            rollup_mark = await rollups.rollups_mark(db)
+            if rollup_mark is not None:
+                until.append(rollup_mark)
+            mark = await rollups.chain_mark(db, min(until, default=None))
+        except Exception as e:
+            # the values may be served stale while Mongo is down
+            log.warning(f'Could not read the stats closed mark: {e}')
+
+    _closed_marks[key] = (mark, time.monotonic() + CLOSED_MARK_TTL)
+    return mark
+
+
+def since_label(value, since_bucket):
+    """
+    Whether the bucket labeled value (a date or its string) is since_bucket
+    or a later one, all of them without since_bucket
+    """
+    return since_bucket is None or str(value) >= since_bucket.isoformat()
+
+
+async def count_list_response(values, to=None, since_bucket=None):
+    """
+    Returns the values of transactions_base as a TransactionsCountList, its
+    computed fields are worked out here on the fast path. Only the buckets
+    since since_bucket are kept, the days from the start of it can also
+    fall in earlier ones. They can be reused for CLOSED_MAX_AGE seconds when
+    they end on a closed day.
+    """
+    mark = values["closed_mark"]
+    values = {
+        "accounts": [a for a in values["accounts"]
+                     if since_label(a["date"], since_bucket)],
+        "group_by": values["group_by"],
+        "type": values["type"],
+        "closed_until": rollups.last_closed_bucket(
+            Periods(values["group_by"]), mark)
+    }
+
+    # not the stale ones, computed before the mark of the values moved
+    headers = {}
+    closed_day = rollups.last_closed_bucket(Periods.DAY, mark)
+    if to is not None and closed_day is not None and to <= closed_day \
+            and not stale_response.get():
+        headers["Cache-Control"] = f"public, max-age={CLOSED_MAX_AGE}"
+
+    if not FAST_SERIALIZATION:
+        return JSONResponse(
+            TransactionsCountList(**values).model_dump(mode='json'),
+            headers=headers)
+    accounts = values["accounts"]
+    return FastJSONResponse({
+        **values,
+        "since": accounts[0]["date"] if accounts else None,
+        "to": accounts[-1]["date"] if accounts else None,
+        "total": float(sum([a["count"] for a in accounts])),
+        "count": float(len(accounts))
+    }, headers=headers)
+
+
+FromQuery = Annotated[date_type, Query(
+    alias="from", description="First day of the series")]
+ToQuery = Annotated[date_type, Query(
+    description="Last day of the series")]
+SinceBucketQuery = Annotated[date_type, Query(
+    description="Last bucket the client already has complete, only it and "
+                "the later ones are returned")]
+
+
 @router.get(
     "/api/v1/stats/volumen/stable",
     response_description="Successful Response",
@@ -274,18 +269,24 @@ async def transactions_base(
 async def volumen_stable_token(
     event: TransactionsCountEvent = TransactionsCountEvent.ALL,
     group_by: Periods = Periods.DAY,
+    from_: FromQuery = None,
+    to: ToQuery = None,
+    since_bucket: SinceBucketQuery = None
     ):
     """
     Returns a list of the volumen of (per _day_, _week_, _month_ or _year_) of
     the **Stable** token.
     """
-    return await transactions_base(
+    from_, to = date_range(group_by, from_, to, since_bucket)
+    return await count_list_response(await transactions_base(
         type = TransactionsCountType.ALL,
         token = TransactionsCountToken.ONLY_STABLE,
         event = event,
         group_by = group_by,
-        fnc = TransactionsCountFnc.SUM
-    )
+        fnc = TransactionsCountFnc.SUM,
+        from_ = from_,
+        to = to
+    ), to, since_bucket)
 
 
 @router.get(
@@ -297,18 +298,24 @@ async def volumen_stable_token(
 async def volumen_pro_token(
     event: TransactionsCountEvent = TransactionsCountEvent.ALL,
     group_by: Periods = Periods.DAY,
+    from_: FromQuery = None,
+    to: ToQuery = None,
+    since_bucket: SinceBucketQuery = None
     ):
     """
     Returns a list of the volumen of (per _day_, _week_, _month_ or _year_) of
     the **Pro** token.
     """
-    return await transactions_base(
+    from_, to = date_range(group_by, from_, to, since_bucket)
+    return await count_list_response(await transactions_base(
         type = TransactionsCountType.ALL,
         token = TransactionsCountToken.ONLY_PRO,
         event = event,
         group_by = group_by,
-        fnc = TransactionsCountFnc.SUM
-    )
+        fnc = TransactionsCountFnc.SUM,
+        from_ = from_,
+        to = to
+    ), to, since_bucket)
 
 
 @router.get(
@@ -320,18 +327,24 @@ async def volumen_pro_token(
 async def volumen_governance_token(
     event: TransactionsCountEvent = TransactionsCountEvent.ALL,
     group_by: Periods = Periods.DAY,
+    from_: FromQuery = None,
+    to: ToQuery = None,
+    since_bucket: SinceBucketQuery = None
     ):
     """
     Returns a list of the volumen of (per _day_, _week_, _month_ or _year_) of
     the **Governance** token.
     """
-    return await transactions_base(
+    from_, to = date_range(group_by, from_, to, since_bucket)
+    return await count_list_response(await transactions_base(
         type = TransactionsCountType.ALL,
         token = TransactionsCountToken.ONLY_GOVERNANCE,
         event = event,
         group_by = group_by,
-        fnc = TransactionsCountFnc.SUM
-    )
+        fnc = TransactionsCountFnc.SUM,
+        from_ = from_,
+        to = to
+    ), to, since_bucket)
 
 
 @router.get(
@@ -345,21 +358,339 @@ async def transactions_count(
     token: TransactionsCountToken = TransactionsCountToken.ALL,
     event: TransactionsCountEvent = TransactionsCountEvent.ALL,
     group_by: Periods = Periods.DAY,
-    fnc: TransactionsCountFnc = TransactionsCountFnc.COUNT
+    fnc: TransactionsCountFnc = TransactionsCountFnc.COUNT,
+    from_: FromQuery = None,
+    to: ToQuery = None,
+    since_bucket: SinceBucketQuery = None
     ):
     """
     Returns a list of the amount (per _day_, _week_, _month_ or _year_) of
-    transactions that the protocol has had.
+    transactions that the protocol has had, between the days `from` and `to`
+    when given. With `since_bucket` only that bucket and the later ones are
+    returned, the ones up to `closed_until` do not change anymore.
 
     *On this one are based the previous endpoints.*
     """
-    return await transactions_base(
+    from_, to = date_range(group_by, from_, to, since_bucket)
+    return await count_list_response(await transactions_base(
         type = type,
         token = token,
         event = event,
         group_by = group_by,
-        fnc = fnc
-    )
+        fnc = fnc,
+        from_ = from_,
+        to = to
+    ), to, since_bucket)
+
+
+def series_facet(type, token, event, fnc, group_by, from_=None):
+    """
+    Returns the $facet pipeline of a series over the documents projected by
+    series_pipeline, from the day from_ when given
+    """
+
+    stages = []
+
+    match = {}
+    if token in TOKEN_INVOLVED:
+        match['tokenInvolved'] = TOKEN_INVOLVED[token]
+    if event in EVENT_NAMES:
+        match['event'] = {'$in': EVENT_NAMES[event]}
+    in_range = dict(match)
+    if from_ is not None and type==TransactionsCountType.ALL:
+        in_range['timestamp'] = rollups.time_range(from_)
+    if in_range:
+        stages.append({'$match': in_range})
+
+    if type==TransactionsCountType.ONLY_NEW_ACCOUNTS:
+        stages.append({
+            '$group': {
+                '_id': '$address',
+                'timestamp': {'$min': '$timestamp'}
+            }
+        })
+        if from_ is not None:
+            stages.append({'$match': {'timestamp': rollups.time_range(from_)}})
+
+    stages.append({
+        '$group': {
+            '_id': period_date(group_by, '$timestamp'),
+            'value': {'$sum': 1.0} if fnc==TransactionsCountFnc.COUNT
+                     else {'$sum': {'$toDecimal': '$amount'}}
+        }
+    })
+
+    return stages, match
+
+
+def series_pipeline(specs, group_by, from_=None, to=None):
+    """
+    Returns a single aggregation that computes every series of the specs,
+    one $facet each, in one pass over the transactions any of them needs
+    """
+
+    # the lower bound goes first unless a new accounts series needs the
+    # earlier transactions to know the first one of each address
+    first = from_ if all(s[0]==TransactionsCountType.ALL for s in specs) \
+        else None
+
+    facets = {}
+    matches = []
+    for i, spec in enumerate(specs):
+        facets[f"series{i}"], match = series_facet(
+            *spec, group_by, None if first else from_)
+        matches.append(match)
+
+    match = {'confirmationTime': dict(
+        rollups.time_range(first, to) or {}, **{'$ne': None})}
+    if {} not in matches:
+        match['$or'] = matches
+
+    return [{
+        '$match': match
+    }, {
+        '$project': {
+            'address': {'$toLower': '$address'},
+            'tokenInvolved': 1,
+            'event': 1,
+            'amount': 1,
+            'timestamp': '$confirmationTime'
+        }
+    }, {
+        '$facet': facets
+    }]
+
+
+@cached('stats_series', ttl=60)
+@admitted('stats_series')
+async def series_base(specs, group_by: Periods = Periods.DAY,
+                      from_: date_type = None, to: date_type = None):
+    """
+    Returns the aligned dates and the values of each (type, token, event,
+    fnc) series, the ones the rollups can answer from them and the rest
+    from a single aggregation
+    """
+
+    # get mongo db connection
+    db = await get_db("stats")
+
+    if db is None:
+        raise HTTPException(status_code=503, detail="Cannot get DB access")
+
+    for spec in specs:
+        check_series(*spec)
+
+    # read first, the values are computed at least up to it
+    mark = await closed_mark()
+
+    # {date: value} per series
+    columns = [None] * len(specs)
+
+    snapshot = columnar.ready_snapshot()
+    if snapshot is not None:
+        for i, spec in enumerate(specs):
+            columns[i] = dict(snapshot.count_by_date(
+                spec[0], TOKEN_INVOLVED.get(spec[1]),
+                EVENT_NAMES.get(spec[2]), group_by, spec[3], from_, to))
+
+    if await rollups.rollup_ready(db):
+        indexes = [i for i, s in enumerate(specs)
+                   if s[0]==TransactionsCountType.ALL and columns[i] is None]
+        if indexes:
+            series = await rollups.series_by_date(
+                db, [(TOKEN_INVOLVED.get(specs[i][1]),
+                      EVENT_NAMES.get(specs[i][2])) for i in indexes],
+                group_by, from_, to)
+            for i, buckets in zip(indexes, series):
+                value = 1 if specs[i][3]==TransactionsCountFnc.COUNT else 2
+                columns[i] = {b[0]: b[value] for b in buckets}
+
+    if await rollups.rollup_ready(db, "first_seen"):
+        indexes = [i for i, s in enumerate(specs)
+                   if s[0]==TransactionsCountType.ONLY_NEW_ACCOUNTS
+                   and columns[i] is None]
+        series = await asyncio.gather(*[rollups.new_accounts_by_date(
+            db, TOKEN_INVOLVED.get(specs[i][1]),
+            EVENT_NAMES.get(specs[i][2]), group_by, from_, to)
+            for i in indexes])
+        for i, buckets in zip(indexes, series):
+            columns[i] = {b[0]: b[1] for b in buckets}
+
+    indexes = [i for i, c in enumerate(columns) if c is None]
+    if indexes:
+        cursor = db["Transaction"].aggregate(
+            series_pipeline([specs[i] for i in indexes], group_by, from_, to),
+            allowDiskUse=True)
+        facets = (await cursor.to_list(length=1))[0]
+        for n, i in enumerate(indexes):
+            columns[i] = {date_type.fromisoformat(r['_id']): r['value']
+                          for r in facets[f"series{n}"]}
+
+    dates = sorted(set().union(*columns))
+
+    values = []
+    for spec, column in zip(specs, columns):
+        if spec[3]==TransactionsCountFnc.COUNT:
+            transform_count = lambda x: float(str(x))
+        else:
+            transform_count = lambda x: float(str(x))/(10**18)
+        values.append([transform_count(column.get(d, 0)) for d in dates])
+
+    return {"dates": dates, "values": values, "closed_mark": mark}
+
+
+@router.post(
+    "/api/v1/stats/series",
+    response_description="Successful Response",
+    response_model = StatsSeries,
+    responses = make_responses(503, 400, 404)
+)
+async def stats_series(request: StatsSeriesRequest):
+    """
+    Returns several series of `/api/v1/stats/transactions/{fnc}` at once,
+    over one aligned axis of dates (per _day_, _week_, _month_ or _year_)
+    with a column of values per series. They are computed together in a
+    single pass over the transactions, or from the rollups. They take the
+    same `from`, `to` and `since_bucket` bounds.
+    """
+    specs = [(s.type, s.token, s.event, s.fnc) for s in request.series]
+
+    from_, to = date_range(request.group_by, request.from_, request.to,
+                           request.since_bucket)
+
+    values = await series_base(specs, request.group_by, from_, to)
+
+    # the buckets since since_bucket only, like count_list_response
+    kept = [i for i, d in enumerate(values["dates"])
+            if since_label(d, request.since_bucket)]
+
+    return fast_response({
+        "group_by": request.group_by.value,
+        "dates": [values["dates"][i] for i in kept],
+        "closed_until": rollups.last_closed_bucket(request.group_by,
+                                                   values["closed_mark"]),
+        "series": [{
+            "name": s.name or ':'.join(v.value for v in spec),
+            "type": s.type.value,
+            "token": s.token.value,
+            "event": s.event.value,
+            "fnc": s.fnc.value,
+            "values": [column[i] for i in kept]
+        } for s, spec, column in zip(request.series, specs, values["values"])]
+    })
+
+
+transform_volume = lambda x: float(str(x))/(10**18)
+
+# Different windows of days a request of the top transactors can ask for
+MAX_WINDOWS = 5
+
+
+@cached('top_transactors', ttl=60)
+@admitted('top_transactors')
+async def top_transactors_base(windows: List[int] = [30], top: int = 10,
+                               rank_by: RankBy = RankBy.COUNT):
+    """
+    Returns a list with the top transactors of each window of days
+    """
+
+    # get mongo db connection
+    db = await get_db("stats")
+
+    if db is None:
+        raise HTTPException(status_code=503, detail="Cannot get DB access")
+
+    snapshot = columnar.ready_snapshot()
+    if snapshot is not None:
+        return [[{'address': address,
+                  'tx_count': count,
+                  'volume': transform_volume(volume)}
+                 for address, count, volume in snapshot.top_transactors(
+                     days, top, rank_by.value)]
+                for days in windows]
+
+    if await rollups.rollup_ready(db, "transactors"):
+        tops = await rollups.top_transactors_by_window(
+            db, windows, top, rank_by.value)
+        return [[{'address': address,
+                  'tx_count': count,
+                  'volume': transform_volume(volume)}
+                 for address, count, volume in tops[days]]
+                for days in windows]
+
+    return await top_transactors_aggregation(db, windows, top, rank_by)
+
+
+def window_facet(days, top, rank_by):
+    return [
+        {
+            '$match': {
+                'createdAt': {
+                    '$gte': rollups.window_since(days)
+                }
+            }
+        }, {
+            '$group': {
+                '_id': {'$toLower': '$address'},
+                'count': {
+                    '$sum': 1
+                },
+                'volume': {
+                    '$sum': {
+                        '$toDecimal': {'$ifNull': ['$USDAmount', 0]}
+                    }
+                }
+            }
+        }, {
+            '$sort': {
+                rank_by.value: -1
+            }
+        }, {
+            '$limit': top
+        }
+    ]
+
+
+async def top_transactors_aggregation(db, windows, top, rank_by):
+    """
+    Returns the top transactors of each window of days from a single scan
+    of the widest one, with a $facet per window
+    """
+
+    query = [
+        {
+            '$match': {
+                'event': {
+                    '$in': EVENT_NAMES[
+                        TransactionsCountEvent.ONLY_MINT_AND_REDEEM]
+                },
+                'createdAt': {
+                    '$gte': rollups.window_since(max(windows))
+                }
+            }
+        }, {
+            '$project': {
+                'address': 1,
+                'USDAmount': 1,
+                'createdAt': 1
+            }
+        }, {
+            '$facet': {
+                str(days): window_facet(days, top, rank_by)
+                for days in windows
+            }
+        }
+    ]
+
+    cursor = db["Transaction"].aggregate(query, allowDiskUse=True)
+
+    facets = (await cursor.to_list(length=1))[0]
+
+    transform_fnc = lambda x: {'address': x['_id'],
+                               'tx_count': x['count'],
+                               'volume': transform_volume(x['volume']) }
+
+    return [[transform_fnc(t) for t in facets[str(days)]] for days in windows]
 
 
 @router.get(
@@ -406,76 +737,30 @@ async def top_transactors(
             title="Top",
             description="Top, limit the number of records.",
             ge=1, le=10000)] = 10,
+        rank_by: RankBy = RankBy.COUNT,
         format: OutputFormat = None,
     ):
     """
-    Shows the top of **transactors** accounts of the protocol.
+    Shows the top of **transactors** accounts of the protocol, ranked by
+    number of transactions or by volume (USD) of mints and redeems.
     """
 
-    # get mongo db connection
-    db = await get_db()
-
-    if db is None:
-        raise HTTPException(status_code=503, detail="Cannot get DB access")
-    
-    query = [
-        {
-            '$match': {
-                '$and': [
-                    {
-                        '$or': [
-                            {
-                                'event': 'RiskProMint'
-                            }, {
-                                'event': 'StableTokenMint'
-                            }, {
-                                'event': 'RiskProRedeem'
-                            }, {
-                                'event': 'FreeStableTokenRedeem'
-                            }
-                        ]
-                    }, {
-                        '$expr': {
-                            '$gt': [
-                                '$createdAt',
-                                datetime.now() - timedelta(days=days+1)
-                            ]
-                        }
-                    }
-                ]
-            }
-        }, {
-            '$group': {
-                '_id': '$address', 
-                'count': {
-                    '$sum': 1
-                }
-            }
-        }, {
-            '$sort': {
-                'count': -1
-            }
-        }, {
-            '$limit': top
-        }
-    ]
-
-    cursor = db["Transaction"].aggregate(query)
- 
-    top_transactors = await cursor.to_list(length=None)
-    
-    transform_fnc = lambda x: {'address': x['_id'],
-                               'tx_count': x['count'] }
-
-    top_transactors = [transform_fnc(t) for t in top_transactors]
+    top_transactors, = await top_transactors_base(windows=[days], top=top,
+                                                  rank_by=rank_by)
 
     if format in [OutputFormat.JSON, None]:
-        return {'transactors': top_transactors}
+        return fast_response({'transactors': top_transactors})
     
-    table =  [[t['address'], t['tx_count']] for t in top_transactors]
+    if rank_by==RankBy.VOLUME:
+        table = [[t['address'], t['tx_count'], t['volume']]
+                 for t in top_transactors]
+        headers = ['Address', 'TX Count', 'Volume']
+    else:
+        table = [[t['address'], t['tx_count']] for t in top_transactors]
+        headers = ['Address', 'TX Count']
     
     text = []
-    text.append(tabulate(table, headers=['Address', 'TX Count']))
+    text.append(tabulate(table, headers=headers))
     text = '\n'.join(text)
 
     response = PlainTextResponse(text)
@@ -483,3 +768,43 @@ async def top_transactors(
     response.headers["Content-Disposition"] = f"attachment; filename=top_transactors.txt"
 
     return response
+
+
+@router.get(
+    "/api/v1/stats/top_transactors/windows",
+    response_description="Successful Response",
+    response_model = TopTransactorWindows,
+    responses = make_responses(503, 400)
+)
+async def top_transactors_windows(
+        windows: Annotated[List[int], Query(
+            title="Windows",
+            description="Days until today (UTC) of each window, up to "
+                        f"{MAX_WINDOWS} different ones.")] = [1, 7, 30],
+        top: Annotated[int, Query(
+            title="Top",
+            description="Top, limit the number of records per window.",
+            ge=1, le=10000)] = 10,
+        rank_by: RankBy = RankBy.COUNT,
+    ):
+    """
+    Shows the top of **transactors** accounts of the protocol for several
+    windows of days at once.
+    """
+
+    windows = sorted(set(windows))
+    if not windows or windows[0] < 1 or windows[-1] > 3655:
+        raise HTTPException(status_code=400,
+            detail="Windows must be between 1 and 3655 days.")
+    if len(windows) > MAX_WINDOWS:
+        raise HTTPException(status_code=400,
+            detail=f"At most {MAX_WINDOWS} different windows.")
+
+    tops = await top_transactors_base(windows=windows, top=top,
+                                      rank_by=rank_by)
+
+    return fast_response({
+        'rank_by': rank_by.value,
+        'windows': [{'days': days, 'transactors': transactors}
+                    for days, transactors in zip(windows, tops)]
+    })
@@ -0,0 +1,37 @@
+from fastapi.responses import JSONResponse
+from pydantic_core import to_json
+
+from api.common import get_env_var
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Responses built from documents already shaped by the Mongo projections
+# skip the response_model validation and are encoded straight to JSON.
+# Set APP_FAST_SERIALIZATION=False to go through pydantic again.
+FAST_SERIALIZATION = get_env_var("APP_FAST_SERIALIZATION", bool) is not False
+
+
+def dumps(content):
+    if orjson is not None:
+        return orjson.dumps(content, default=str)
+    return to_json(content)
+
+
+class FastJSONResponse(JSONResponse):
+
+    def render(self, content):
+        return dumps(content)
+
+
+def fast_response(content):
+    """
+    Returns the content as a FastJSONResponse, or as it is to be validated
+    against the response_model of the route when the fast path is disabled
+    """
+    if not FAST_SERIALIZATION:
+        return content
+    return FastJSONResponse(content)
@@ -0,0 +1,144 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from os import getenv
+
+from dotenv import load_dotenv, dotenv_values
+
+from api.common import get_env_var
+
+load_dotenv()
+
+
+# Settings that change from one protocol environment to another, with their
+# defaults
+TENANT_SETTINGS = {
+    "APP_MONGO_URI": "mongodb://localhost:27017",
+    "APP_MONGO_DB": "example",
+    "VENDOR_ADDRESS": "0x",
+    "COMMISSION_SPLITTER_V2": "0x"
+}
+
+# Environments served by this process, like
+# {"moc-mainnet": {"env_file": "environments/moc-mainnet.env",
+#                  "hosts": ["moc-mainnet.example.com"],
+#                  "prefix": "/moc-mainnet"},
+#  "roc-mainnet": {"APP_MONGO_DB": "roc_mainnet", "prefix": "/roc-mainnet"}}
+# Each one takes the settings given, then the ones of its env_file and then
+# the process ones. Without it the process serves a single environment.
+TENANTS_CONFIG = get_env_var("APP_TENANTS", dict)
+
+# Tenant of the requests that match no host nor prefix, they get a 404 when
+# it is not set
+DEFAULT_TENANT = get_env_var("APP_DEFAULT_TENANT", str)
+
+
+def make_tenant(name, config):
+    values = dotenv_values(config["env_file"]) if "env_file" in config else {}
+    tenant = {
+        "name": name,
+        "hosts": [h.lower() for h in config.get("hosts", [])],
+        "prefix": config.get("prefix", '').rstrip('/')
+    }
+    for setting, default in TENANT_SETTINGS.items():
+        tenant[setting] = config.get(setting) or values.get(setting) or \
+            getenv(setting, default=default)
+    return tenant
+
+
+if TENANTS_CONFIG:
+    TENANTS = {name: make_tenant(name, config)
+               for name, config in TENANTS_CONFIG.items()}
+else:
+    TENANTS = {"default": make_tenant("default", {})}
+    DEFAULT_TENANT = "default"
+
+current_tenant: ContextVar = ContextVar("tenant", default=None)
+
+
+def get_tenant():
+    """
+    Returns the tenant of the request being answered (or set with
+    use_tenant), the default one outside of them
+    """
+    tenant = current_tenant.get()
+    if tenant is None:
+        return TENANTS[DEFAULT_TENANT or next(iter(TENANTS))]
+    return tenant
+
+
+def tenant_setting(name):
+    return get_tenant()[name]
+
+
+@contextmanager
+def use_tenant(tenant):
+    token = current_tenant.set(tenant)
+    try:
+        yield tenant
+    finally:
+        current_tenant.reset(token)
+
+
+def resolve_tenant(scope):
+    """
+    Returns the tenant of the request and the prefix matched, by its Host
+    header first and then by the prefix of its path
+    """
+    host = dict(scope.get('headers', [])).get(b'host', b'')\
+        .decode('latin-1').split(':')[0].lower()
+    for tenant in TENANTS.values():
+        if host in tenant["hosts"]:
+            return tenant, ''
+    path = scope['path']
+    for tenant in TENANTS.values():
+        prefix = tenant["prefix"]
+        if prefix and (path == prefix or path.startswith(prefix + '/')):
+            return tenant, prefix
+    if DEFAULT_TENANT is not None:
+        return TENANTS[DEFAULT_TENANT], ''
+    return None, ''
+
+
+def route_path(scope):
+    """
+    Returns the path of the request without the root_path (the prefix of
+    its tenant), the one the routes are declared with
+    """
+    path = scope['path']
+    root_path = scope.get('root_path', '')
+    if root_path and path.startswith(root_path):
+        return path[len(root_path):]
+    return path
+
+
+class TenantMiddleware:
+    """
+    Answers every request in the context of its tenant. A matched path
+    prefix is added to the root_path, so the routes stay the same.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        tenant, prefix = resolve_tenant(scope)
+
+        if tenant is None:
+            await send({'type': 'http.response.start', 'status': 404,
+                        'headers': [(b'content-type', b'application/json')]})
+            await send({'type': 'http.response.body',
+                        'body': b'{"detail":"Unknown tenant"}'})
+            return
+
+        if prefix:
+            # the path stays as received, Starlette routes it without the
+            # root_path
+            scope = dict(scope, root_path=scope.get('root_path', '') + prefix)
+
+        with use_tenant(tenant):
+            await self.app(scope, receive, send)
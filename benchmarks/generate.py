@@ -0,0 +1,187 @@
+"""
+Synthetic Transaction and FastBtcBridge documents shaped like the ones the
+indexer writes.
+
+    python -m benchmarks.generate --accounts 100 --transactions 1000 > txs.ndjson
+"""
+import argparse
+import json
+import random
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+
+# (tokenInvolved, event): weight
+DEFAULT_MIX = {
+    ('STABLE', 'StableTokenMint'): 20,
+    ('STABLE', 'FreeStableTokenRedeem'): 15,
+    ('STABLE', 'Transfer'): 25,
+    ('RISKPRO', 'RiskProMint'): 10,
+    ('RISKPRO', 'RiskProRedeem'): 8,
+    ('RISKPRO', 'Transfer'): 7,
+    ('MOC', 'Transfer'): 15
+}
+
+
+def make_accounts(count, rng):
+    """
+    Returns count addresses with a random mix of upper and lower case, like
+    checksummed addresses
+    """
+    accounts = []
+    for _ in range(count):
+        digits = f"{rng.getrandbits(160):040x}"
+        accounts.append('0x' + ''.join(
+            c.upper() if rng.random() < 0.5 else c for c in digits))
+    return accounts
+
+
+def object_id(when, i):
+    """
+    Unique ObjectId generated at when, as the indexer would have got it
+    """
+    seconds = int((when - datetime(1970, 1, 1)).total_seconds())
+    return ObjectId(seconds.to_bytes(4, 'big') +
+                    i.to_bytes(8, 'big'))
+
+
+def wei(rng, low, high):
+    return str(int(rng.uniform(low, high) * 10**18))
+
+
+def transaction(rng, i, address, other, token, event, when, block):
+    """
+    Returns the i-th Transaction document, of the token and event at when
+    """
+    amount = wei(rng, 1, 5000) if token!='RISKPRO' else wei(rng, 0.001, 5)
+    rbtc = wei(rng, 0.0001, 0.1)
+    usd = wei(rng, 1, 5000)
+    document = {
+        '_id': object_id(when, i),
+        'address': address,
+        'transactionHash': '0x' + f"{rng.getrandbits(256):064x}",
+        'blockNumber': block,
+        'event': event,
+        'gas': 300000,
+        'gasPrice': '65164000',
+        'gasUsed': rng.randint(50000, 300000),
+        'gasFeeRBTC': str(rng.randint(10**12, 10**13)),
+        'amount': amount,
+        'confirmationTime': when + timedelta(seconds=30),
+        'createdAt': when,
+        'lastUpdatedAt': when + timedelta(seconds=30),
+        'isPositive': rng.random() < 0.5,
+        'processLogs': True,
+        'status': 'confirmed',
+        'tokenInvolved': token,
+        'confirmingPercent': 100
+    }
+    if event=='Transfer':
+        document['otherAddress'] = other
+    else:
+        document.update({
+            'RBTCAmount': rbtc,
+            'RBTCTotal': rbtc,
+            'USDAmount': usd,
+            'USDCommission': str(int(usd) // 1000),
+            'USDTotal': usd,
+            'mocCommissionValue': '0',
+            'mocPrice': wei(rng, 0.1, 2),
+            'rbtcCommission': str(int(rbtc) // 1000),
+            'reservePrice': wei(rng, 20000, 70000),
+            'userAmount': amount
+        })
+    return document
+
+
+def generate_transactions(accounts, transactions, days, mix=None, seed=0,
+                          until=None):
+    """
+    Yields transactions documents (sorted by createdAt) spread over the last
+    days until until, between the given number of accounts. Activity per
+    account follows a Pareto distribution, a few accounts make most of the
+    transactions as in production.
+    """
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    until = until or datetime.utcnow().replace(microsecond=0)
+    start = until - timedelta(days=days)
+
+    addresses = make_accounts(accounts, rng)
+    weights = [rng.paretovariate(1.2) for _ in addresses]
+    kinds = list(mix)
+    kind_weights = [mix[k] for k in kinds]
+
+    times = sorted(rng.uniform(0, days * 86400) for _ in range(transactions))
+    for i, seconds in enumerate(times):
+        when = start + timedelta(seconds=int(seconds))
+        address, other = rng.choices(addresses, weights, k=2)
+        token, event = rng.choices(kinds, kind_weights)[0]
+        yield transaction(rng, i, address, other, token, event, when,
+                          4000000 + int(seconds // 30) + i % 30)
+
+
+def generate_peg_outs(accounts, count, days, seed=0, until=None):
+    """
+    Yields FastBtcBridge documents of the same accounts than
+    generate_transactions with the same seed
+    """
+    rng = random.Random(seed)
+    addresses = make_accounts(accounts, rng)
+    until = until or datetime.utcnow().replace(microsecond=0)
+    start = until - timedelta(days=days)
+
+    times = sorted(rng.uniform(0, days * 86400) for _ in range(count))
+    for nonce, seconds in enumerate(times):
+        when = start + timedelta(seconds=int(seconds))
+        tx_hash = '0x' + f"{rng.getrandbits(256):064x}"
+        yield {
+            '_id': object_id(when, nonce),
+            'transferId': '0x' + f"{rng.getrandbits(256):064x}",
+            'amountSatoshi': str(rng.randint(10**5, 10**8)),
+            'blockNumber': 4000000 + int(seconds // 30),
+            'btcAddress': '1' + f"{rng.getrandbits(160):040x}"[:33],
+            'feeSatoshi': str(rng.randint(10**4, 10**5)),
+            'nonce': nonce,
+            'processLogs': True,
+            'rskAddress': rng.choice(addresses),
+            'status': rng.choice([0, 1, 2]),
+            'timestamp': when,
+            'transactionHash': tx_hash,
+            'transactionHashLastUpdated': tx_hash,
+            'type': 'PEG_OUT' if rng.random() < 0.8 else 'PEG_IN',
+            'updated': when + timedelta(seconds=60)
+        }
+
+
+def parse_mix(value):
+    """
+    Parses a mix like {"STABLE:Transfer": 3, "MOC:Transfer": 1}
+    """
+    return {tuple(k.split(':', 1)): w for k, w in json.loads(value).items()}
+
+
+def add_arguments(parser):
+    parser.add_argument('--accounts', type=int, default=1000)
+    parser.add_argument('--transactions', type=int, default=50000)
+    parser.add_argument('--peg-outs', type=int, default=5000)
+    parser.add_argument('--days', type=int, default=730)
+    parser.add_argument('--mix', type=parse_mix, default=None,
+                        help='weights per "tokenInvolved:event", as JSON')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    for document in generate_transactions(args.accounts, args.transactions,
+                                          args.days, args.mix, args.seed):
+        print(json.dumps(document, default=str))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,385 @@
+"""
+Drives every route of the API in-process (straight through ASGI, no network)
+under concurrency and prints, as JSON, the p50/p95/p99 latency, throughput
+and Mongo documents examined per route.
+
+Against the local mongod (APP_MONGO_URI / APP_MONGO_DB), loading it first:
+
+    python -m benchmarks.harness --load --requests 200 --concurrency 16 > a.json
+
+Against the in-memory stand-in (no documents examined reported, and the
+routes that hit one of its KNOWN_GAPS are skipped):
+
+    python -m benchmarks.harness --memory --transactions 5000
+
+Give --baseline a previous output to get the ratios against it. Exits with
+1 when a route answers with a 5xx that is not a known gap.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+from urllib.parse import urlencode
+
+import api.db
+from api import cache, columnar, live, rollups
+from api.app import app
+from api.tenants import get_tenant
+
+from .generate import add_arguments
+from .load import connect, load
+
+
+# name: (method, path, parameters), the parameters go in the query string of
+# a GET and as the JSON body of a POST
+ROUTES = {
+    "transactions_list": ("GET",
+        "/api/v1/webapp/transactions/list/", {'limit': 20}),
+    "transactions_list_fields": ("GET",
+        "/api/v1/webapp/transactions/list/",
+        {'limit': 20, 'fields': 'event,amount,confirmationTime'}),
+    "transactions_list_text": ("GET",
+        "/api/v1/webapp/transactions/list/", {'limit': 20, 'format': 'text'}),
+    "transactions_batch": ("POST",
+        "/api/v1/webapp/transactions/batch/", {'limit': 20, 'merged': True}),
+    "transactions_export": ("GET",
+        "/api/v1/webapp/transactions/export/", {'format': 'csv'}),
+    "peg_out_list": ("GET",
+        "/api/v1/webapp/fastbtc/pegout/", {'limit': 20}),
+    "live_feed": ("GET",
+        "/api/v1/webapp/live/", {}),
+    "stats_new_accounts": ("GET",
+        "/api/v1/stats/transactions/count",
+        {'type': 'only_new_accounts', 'group_by': 'month'}),
+    "stats_transactions": ("GET",
+        "/api/v1/stats/transactions/count",
+        {'type': 'all', 'event': 'only_mint_and_redeem', 'group_by': 'day'}),
+    "stats_series": ("POST",
+        "/api/v1/stats/series",
+        {'series': [
+            {'name': 'stable', 'token': 'only_stable', 'fnc': 'sum'},
+            {'name': 'pro', 'token': 'only_pro', 'fnc': 'sum'},
+            {'name': 'new_accounts', 'type': 'only_new_accounts'}],
+         'group_by': 'month'}),
+    "volumen_stable": ("GET",
+        "/api/v1/stats/volumen/stable", {'group_by': 'week'}),
+    "volumen_pro": ("GET",
+        "/api/v1/stats/volumen/pro", {'group_by': 'month'}),
+    "top_transactors": ("GET",
+        "/api/v1/stats/top_transactors", {'days': 30}),
+    "top_transactors_windows": ("GET",
+        "/api/v1/stats/top_transactors/windows", {'rank_by': 'volume'})
+}
+
+# address is filled with a random account
+ADDRESS_ROUTES = ["transactions_list", "transactions_list_fields",
+                  "transactions_list_text", "transactions_export",
+                  "peg_out_list", "live_feed"]
+
+# addresses is filled with BATCH_ACCOUNTS random accounts
+BATCH_ROUTES = ["transactions_batch"]
+BATCH_ACCOUNTS = 5
+
+# Streams that never end on their own, timed until their first event and
+# then disconnected
+STREAM_ROUTES = ["live_feed"]
+
+# What mongomock_motor does not implement, as the start of the exceptions it
+# raises. A route failing with one of them in --memory mode is skipped, any
+# other 5xx is a failure.
+KNOWN_GAPS = {
+    "collation": "NotImplementedError('The collation argument",
+    "$isoWeek": "NotImplementedError(\"Although '$isoWeek'",
+    "$dateFromParts month overflow": "ValueError('month must be in 1..12')",
+    "Decimal128 sort": "NotImplementedError(\"Mongomock does not know how "
+                       "to sort"
+}
+
+
+async def request(method, path, parameters, stream=False):
+    """
+    Sends the request to the app and returns (status, size of the body,
+    error). With stream=True the client disconnects after the first chunk
+    of the body.
+    """
+    query, body, headers = parameters, b'', [(b'host', b'localhost')]
+    if method == 'POST':
+        query, body = {}, json.dumps(parameters).encode()
+        headers += [(b'content-type', b'application/json'),
+                    (b'content-length', str(len(body)).encode())]
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': urlencode(query, doseq=True).encode(),
+        'root_path': '',
+        'headers': headers,
+        'client': ('127.0.0.1', 0),
+        'server': ('localhost', 80)
+    }
+    response = {'status': None, 'size': 0}
+    requested = False
+    done = asyncio.Event()
+
+    async def receive():
+        # the body once, then the disconnect streaming responses listen for
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        await done.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+        elif message['type'] == 'http.response.body':
+            response['size'] += len(message.get('body', b''))
+            if stream or not message.get('more_body', False):
+                done.set()
+
+    try:
+        await app(scope, receive, send)
+    except Exception as e:
+        # already answered with a 500 by the app
+        done.set()
+        return response['status'] or 500, response['size'], repr(e)
+    return response['status'], response['size'], None
+
+
+def known_gap(error):
+    """
+    Returns the name of the known gap of the stand-in behind the exception,
+    None for any other
+    """
+    for name, start in KNOWN_GAPS.items():
+        if error and error.startswith(start):
+            return name
+    return None
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of the sorted values
+    """
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))
+    return values[rank]
+
+
+async def scanned(db):
+    """
+    Returns the (documents, keys) examined by the server so far, or None
+    when the database does not report them
+    """
+    try:
+        status = await db.client.admin.command('serverStatus')
+        executor = status['metrics']['queryExecutor']
+        return executor['scannedObjects'], executor['scanned']
+    except Exception:
+        return None
+
+
+async def run_route(db, name, accounts, args, rng):
+    method, path, parameters = ROUTES[name]
+    stream = name in STREAM_ROUTES
+
+    def query():
+        if name in ADDRESS_ROUTES:
+            return {**parameters, 'address': rng.choice(accounts)}
+        if name in BATCH_ROUTES:
+            return {**parameters, 'addresses': rng.sample(
+                accounts, min(BATCH_ACCOUNTS, len(accounts)))}
+        return parameters
+
+    # a route that fails on its own is not timed, skipped when it uses what
+    # the in-memory stand-in does not implement and failed otherwise
+    status, _, error = await request(method, path, query(), stream)
+    if status >= 500:
+        gap = known_gap(error) if args.memory else None
+        return {
+            "skipped": gap is not None,
+            "failed": gap is None,
+            "gap": gap,
+            "statuses": {str(status): 1},
+            "exceptions": [error] if error else []
+        }
+
+    for _ in range(args.warmup):
+        await request(method, path, query(), stream)
+
+    latencies = []
+    statuses = {}
+    errors = set()
+    size = 0
+    pending = iter(range(args.requests))
+
+    async def worker():
+        nonlocal size
+        for _ in pending:
+            start = time.perf_counter()
+            status, length, error = await request(method, path, query(),
+                                                  stream)
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+            size += length
+            if error is not None:
+                errors.add(error)
+
+    before = await scanned(db)
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+    after = await scanned(db)
+
+    latencies.sort()
+    ms = lambda s: round(s * 1000, 3) if s is not None else None
+    result = {
+        "skipped": False,
+        "failed": any(k >= 500 for k in statuses),
+        "requests": len(latencies),
+        "statuses": {str(k): v for k, v in sorted(statuses.items())},
+        "errors": sum(v for k, v in statuses.items() if k >= 400),
+        "exceptions": sorted(errors),
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "mean_ms": ms(sum(latencies) / len(latencies)),
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "bytes_per_request": size // len(latencies),
+        "docs_examined": None,
+        "keys_examined": None
+    }
+    if before is not None and after is not None:
+        result["docs_examined"] = after[0] - before[0]
+        result["keys_examined"] = after[1] - before[1]
+        result["docs_examined_per_request"] = \
+            round(result["docs_examined"] / len(latencies), 1)
+    return result
+
+
+def compare(results, baseline):
+    """
+    Ratios of the results to the baseline ones, < 1 is faster or cheaper
+    except for the throughput
+    """
+    ratios = {}
+    for name, result in results.items():
+        before = baseline.get("routes", {}).get(name)
+        if before is None or "p50_ms" not in before or \
+                "p50_ms" not in result:
+            continue
+        ratios[name] = {key: round(result[key] / before[key], 3)
+                        for key in ["p50_ms", "p95_ms", "p99_ms",
+                                    "throughput_rps", "docs_examined"]
+                        if result.get(key) and before.get(key)}
+    return ratios
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args):
+
+    if args.memory:
+        api.db.db_clients[(get_tenant()["APP_MONGO_URI"], None)] = \
+            connect(memory=True)
+    else:
+        await api.db.connect_and_init_db()
+    db = await api.db.get_db()
+
+    counts = None
+    if args.memory or args.load:
+        counts = await load(db, args)
+
+    if args.no_cache:
+        cache.CACHE_TTL = {"transactions_base": 0, "top_transactors": 0,
+                           "stats_series": 0, "transactions_list": 0,
+                           "pegout_list": 0}
+        cache.response_cache.stale_if_error = 0
+        cache.pages_cache.stale_if_error = 0
+
+    if args.rollups:
+        os.environ.setdefault("APP_STATS_ROLLUPS_INTERVAL", "3600")
+        await rollups.refresh_rollups(db)
+        await rollups.start_rollups()
+
+    if args.engine:
+        if columnar.np is None:
+            raise SystemExit("The columnar engine needs numpy "
+                             "(pip install numpy)")
+        snapshot = columnar._snapshots[get_tenant()["name"]] = \
+            columnar.Snapshot()
+        await snapshot.sync(db)
+
+    rng = random.Random(args.seed)
+    accounts = await db["Transaction"].distinct('address')
+
+    results = {}
+    try:
+        for name in args.routes or ROUTES:
+            results[name] = await run_route(db, name, accounts, args, rng)
+    finally:
+        await live.stop_live()
+        await rollups.stop_rollups()
+        await api.db.close_db_connect()
+
+    output = {
+        "commit": git_commit(),
+        "date": datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        "database": "memory" if args.memory else "mongod",
+        "documents": counts,
+        "settings": {k: v for k, v in vars(args).items()
+                     if k not in ['baseline', 'mix']},
+        "cache": cache.response_cache.stats(),
+        "skipped": [name for name, r in results.items() if r["skipped"]],
+        "failed": [name for name, r in results.items() if r["failed"]],
+        "routes": results
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            output["vs_baseline"] = compare(results, json.load(f))
+
+    print(json.dumps(output, indent=2))
+    if output["failed"]:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    parser.add_argument('--requests', type=int, default=100,
+                        help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--warmup', type=int, default=1,
+                        help='requests per route not measured')
+    parser.add_argument('--routes', nargs='*', choices=list(ROUTES))
+    parser.add_argument('--memory', action='store_true',
+                        help='use the in-memory stand-in (mongomock_motor)')
+    parser.add_argument('--load', action='store_true',
+                        help='load the generated documents into mongod first')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='disable the response cache')
+    parser.add_argument('--rollups', action='store_true',
+                        help='build and serve the stats from the rollups')
+    parser.add_argument('--engine', action='store_true',
+                        help='serve the stats from the numpy columnar engine')
+    parser.add_argument('--baseline', help='previous output to compare with')
+    asyncio.run(main(parser.parse_args()))
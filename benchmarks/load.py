@@ -0,0 +1,87 @@
+"""
+Loads synthetic documents into a local mongod (APP_MONGO_URI / APP_MONGO_DB
+of the default tenant) or into the in-memory stand-in of mongomock_motor,
+when installed.
+
+    python -m benchmarks.load --accounts 1000 --transactions 50000
+"""
+import argparse
+import asyncio
+from itertools import islice
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from api.indexes import create_indexes
+from api.tenants import get_tenant
+
+from .generate import add_arguments, generate_transactions, generate_peg_outs
+
+
+BATCH_SIZE = 5000
+
+
+def connect(memory=False):
+    """
+    Returns a client of the local mongod, or of an in-memory database
+    """
+    if memory:
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            raise SystemExit("The in-memory stand-in needs mongomock_motor "
+                             "(pip install mongomock-motor)")
+        return AsyncMongoMockClient()
+    return AsyncIOMotorClient(get_tenant()["APP_MONGO_URI"])
+
+
+def database(client):
+    return client[get_tenant()["APP_MONGO_DB"]]
+
+
+async def insert(collection, documents):
+    documents = iter(documents)
+    count = 0
+    while True:
+        batch = list(islice(documents, BATCH_SIZE))
+        if not batch:
+            return count
+        await collection.insert_many(batch, ordered=False)
+        count += len(batch)
+
+
+async def load(db, args):
+    """
+    Replaces the Transaction and FastBtcBridge collections with the
+    generated documents and creates the indexes the routers rely on.
+    Returns the count of documents per collection.
+    """
+
+    for name in ["Transaction", "FastBtcBridge"]:
+        await db[name].drop()
+
+    counts = {
+        "Transaction": await insert(db["Transaction"], generate_transactions(
+            args.accounts, args.transactions, args.days, args.mix, args.seed)),
+        "FastBtcBridge": await insert(db["FastBtcBridge"], generate_peg_outs(
+            args.accounts, args.peg_outs, args.days, args.seed))
+    }
+
+    await create_indexes(db)
+
+    return counts
+
+
+async def main(args):
+    client = connect()
+    try:
+        counts = await load(database(client), args)
+    finally:
+        client.close()
+    for name, count in counts.items():
+        print(f"{count} documents loaded into {name}.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    add_arguments(parser)
+    asyncio.run(main(parser.parse_args()))
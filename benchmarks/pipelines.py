@@ -0,0 +1,232 @@
+"""
+Checks the pipelines of transactions_pipeline against the ones
+transactions_base built stage by stage right before it, with the from / to
+bounds already (tests/test_pipelines.py compares them with the original
+ones, without bounds): every combination of
+parameters has to return the very same buckets and, on a mongod, be planned
+over an index (no COLLSCAN). Prints a JSON report and exits with 1 on any
+difference.
+
+Against the local mongod (APP_MONGO_URI / APP_MONGO_DB), loading it first:
+
+    python -m benchmarks.pipelines --load --transactions 50000
+
+Against the in-memory stand-in (results only, it has no explain nor
+$isoWeek, so only the day and year periods):
+
+    python -m benchmarks.pipelines --memory --transactions 5000
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import sys
+from datetime import date, timedelta
+
+from fastapi import HTTPException
+
+import api.db
+from api import rollups
+from api.models.stats import (Periods, TransactionsCountType,
+                              TransactionsCountToken, TransactionsCountEvent,
+                              TransactionsCountFnc, TOKEN_INVOLVED,
+                              EVENT_NAMES)
+from api.pipelines import period_date, transactions_pipeline
+from api.routers.diagnosis import plan_values
+from api.routers.stats import check_series
+from api.tenants import get_tenant
+
+from .generate import add_arguments
+from .load import connect, load
+
+
+def legacy_pipeline(type, token, event, group_by, fnc, from_=None, to=None):
+    """
+    The pipeline of transactions_base before transactions_pipeline
+    """
+
+    query = []
+
+    # the bounds go first, over the index on confirmationTime. The earliest
+    # transaction of an address is known only after the $group, so the new
+    # accounts take the lower bound there.
+    if type==TransactionsCountType.ALL:
+        times = rollups.time_range(from_, to)
+    else:
+        times = rollups.time_range(until=to)
+    if times is not None:
+        query.append({
+            '$match': {
+                'confirmationTime': times
+            }
+        })
+
+    if token in TOKEN_INVOLVED:
+        query.append({
+            '$match': {
+                'tokenInvolved': TOKEN_INVOLVED[token]
+            }    
+        })
+
+    if event==TransactionsCountEvent.ONLY_TRANSFER:
+        query.append({
+            '$match': {
+                'event': 'Transfer'
+            }    
+        })
+    elif event in EVENT_NAMES:
+        query.append({
+            '$match': {
+                '$or': [{'event' : e} for e in EVENT_NAMES[event]]
+            }    
+        })
+
+    if type==TransactionsCountType.ALL: # start from all
+        query.append({
+            '$project': {
+                'amount': '$amount',
+                'timestamp': '$confirmationTime'
+            }
+        })
+    else: # start from only new accounts
+        query.append({
+            '$group': {
+                '_id': '$address', 
+                'timestamp': {
+                    '$min': '$confirmationTime'
+                }
+            }
+        })
+    
+    timestamp = {'$ne': None}
+    if type==TransactionsCountType.ONLY_NEW_ACCOUNTS and from_ is not None:
+        timestamp = rollups.time_range(from_)
+
+    query.append({
+        '$match': {
+            'timestamp': timestamp
+        }    
+    })
+
+    query.append({
+        '$project': {
+            'amount': '$amount',
+            'date': period_date(group_by, '$timestamp')
+        }
+    })
+
+    if fnc==TransactionsCountFnc.COUNT:
+        query.append({
+            '$group': {
+                '_id': '$date', 
+                'count': {
+                    '$sum': 1.0
+                }
+            }
+        })
+    else:
+        query.append({
+            '$group': {
+                '_id': '$date', 
+                'count': {
+                    '$sum': { '$toDecimal': '$amount' }
+                }
+            }
+        })
+    
+    query.append({
+        '$sort': {
+            '_id': 1
+        }
+    })
+
+    return query
+
+
+def combinations(periods, ranges):
+    for spec in itertools.product(
+            TransactionsCountType, TransactionsCountToken,
+            TransactionsCountEvent, periods, TransactionsCountFnc, ranges):
+        try:
+            check_series(spec[0], spec[1], spec[2], spec[4])
+        except HTTPException:
+            continue
+        yield spec[:5] + spec[5]
+
+
+def buckets(rows):
+    return [(r['_id'], str(r['count'])) for r in rows]
+
+
+async def check(db, spec, explain):
+    legacy = await db["Transaction"].aggregate(
+        legacy_pipeline(*spec)).to_list(length=None)
+    pipeline = list(transactions_pipeline(*spec))
+    current = await db["Transaction"].aggregate(pipeline)\
+        .to_list(length=None)
+
+    report = {
+        "spec": [v.value if hasattr(v, 'value') else
+                 v.isoformat() if v is not None else None for v in spec],
+        "same": buckets(legacy) == buckets(current),
+        "buckets": len(current)
+    }
+    if explain:
+        plan = await db.command('explain', {
+            'aggregate': "Transaction", 'pipeline': pipeline, 'cursor': {}
+        }, verbosity='queryPlanner')
+        stages = []
+        for winning_plan in plan_values(plan, 'winningPlan'):
+            stages += plan_values(winning_plan, 'stage')
+        report["indexes"] = sorted(set(plan_values(plan, 'indexName')))
+        report["collscan"] = 'COLLSCAN' in stages
+    return report
+
+
+async def main(args):
+
+    if args.memory:
+        api.db.db_clients[(get_tenant()["APP_MONGO_URI"], None)] = \
+            connect(memory=True)
+    else:
+        await api.db.connect_and_init_db()
+    db = await api.db.get_db()
+
+    if args.memory or args.load:
+        await load(db, args)
+
+    periods = [Periods.DAY, Periods.YEAR] if args.memory else list(Periods)
+    today = date.today()
+    ranges = [(None, None), (today - timedelta(days=args.days // 2), None),
+              (today - timedelta(days=args.days // 2),
+               today - timedelta(days=args.days // 4))]
+
+    try:
+        reports = [await check(db, spec, not args.memory)
+                   for spec in combinations(periods, ranges)]
+    finally:
+        await api.db.close_db_connect()
+
+    failed = [r for r in reports if not r["same"] or r.get("collscan")]
+    print(json.dumps({
+        "database": "memory" if args.memory else "mongod",
+        "checked": len(reports),
+        "failed": failed,
+        "reports": reports if args.verbose else None
+    }, indent=2))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    parser.add_argument('--memory', action='store_true',
+                        help='use the in-memory stand-in (mongomock_motor)')
+    parser.add_argument('--load', action='store_true',
+                        help='load the generated documents into mongod first')
+    parser.add_argument('--verbose', action='store_true',
+                        help='report every combination')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,52 @@
+from datetime import date, timedelta
+
+import pytest
+
+from api.models.stats import Periods
+from api.rollups import bucket_date, closed_label
+from api.routers.stats import date_range
+
+
+@pytest.mark.parametrize("label, start", [
+    (date(2021, 1, 3), date(2020, 12, 28)),
+    (date(2023, 1, 1), date(2022, 1, 1)),
+    (date(2024, 1, 7), date(2024, 1, 1)),
+    (date(2024, 6, 9), date(2024, 6, 3))
+])
+def test_since_week_bucket_at_year_boundaries(label, start):
+    from_, _ = date_range(Periods.WEEK, since_bucket=label)
+    assert from_ == start
+    # every day of that week and of the later ones is read
+    for offset in range(-400, 400):
+        day = label + timedelta(days=offset)
+        if bucket_date(day, Periods.WEEK) >= label:
+            assert day >= from_
+
+
+@pytest.mark.parametrize("group_by, since, start", [
+    (Periods.DAY, date(2024, 3, 15), date(2024, 3, 15)),
+    (Periods.MONTH, date(2024, 2, 29), date(2024, 2, 1)),
+    (Periods.YEAR, date(2023, 12, 31), date(2023, 1, 1))
+])
+def test_since_bucket(group_by, since, start):
+    assert date_range(group_by, since_bucket=since)[0] == start
+
+
+def test_since_bucket_keeps_a_later_from():
+    assert date_range(Periods.MONTH, from_=date(2024, 2, 10),
+                      since_bucket=date(2024, 2, 29))[0] == date(2024, 2, 10)
+
+
+@pytest.mark.parametrize("today, group_by, closed", [
+    (date(2024, 6, 12), Periods.DAY, date(2024, 6, 11)),
+    (date(2024, 6, 12), Periods.MONTH, date(2024, 5, 31)),
+    (date(2024, 6, 12), Periods.YEAR, date(2023, 12, 31)),
+    # the week labeled 2024-01-07 still takes 2024-12-30 and 31
+    (date(2024, 6, 12), Periods.WEEK, date(2023, 12, 31)),
+    (date(2025, 1, 2), Periods.WEEK, date(2024, 12, 29))
+])
+def test_closed_label(today, group_by, closed):
+    assert closed_label(today, group_by) == closed
+    for offset in range(0, 400):
+        day = today + timedelta(days=offset)
+        assert bucket_date(day, group_by) > closed
@@ -0,0 +1,41 @@
+import asyncio
+import inspect
+
+from api import cache
+from api.cache import ResponseCache, cached
+from api.routers import fastbtc, operations
+
+
+def test_list_pages_do_not_evict_the_stats(monkeypatch):
+    monkeypatch.setattr(cache, "response_cache", ResponseCache(
+        max_entries=10, stale_if_error=60))
+    monkeypatch.setattr(cache, "pages_cache", ResponseCache(
+        max_entries=10, stale_if_error=60))
+    calls = []
+
+    @cached('transactions_base', ttl=60)
+    async def stats(group_by):
+        calls.append(group_by)
+        return {"accounts": [], "group_by": group_by}
+
+    @cached('transactions_list', ttl=0, cache=cache.pages_cache)
+    async def page(address, skip):
+        return {"transactions": [], "address": address, "skip": skip}
+
+    async def traffic():
+        await stats("day")
+        for i in range(100):
+            await page(f"0x{i:040x}", i * 20)
+        return await stats("day")
+
+    assert asyncio.run(traffic()) == {"accounts": [], "group_by": "day"}
+    assert calls == ["day"]
+    assert cache.response_cache.stats()["evictions"] == 0
+    assert cache.response_cache.stats()["misses"] == 1
+    assert cache.pages_cache.stats()["entries"] == 10
+
+
+def test_list_routes_use_the_pages_cache():
+    for page in [operations.transactions_page, fastbtc.peg_out_page]:
+        assert inspect.getclosurevars(page).nonlocals["cache"] is \
+            cache.pages_cache
@@ -0,0 +1,65 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import pytest
+
+from api import columnar
+from api.models.stats import (Periods, TransactionsCountType,
+                              TransactionsCountFnc)
+
+from benchmarks.generate import generate_transactions
+
+
+np = pytest.importorskip("numpy")
+
+UNTIL = datetime(2024, 6, 30)
+
+
+def test_sums_are_exact():
+    snapshot = columnar.Snapshot()
+    documents = list(generate_transactions(20, 500, 30, until=UNTIL))
+    # beyond the 2**53 a float64 keeps exactly
+    documents[0]["amount"] = str(10**27 + 1)
+    documents[1]["amount"] = None
+    snapshot.append(documents)
+    snapshot.index_rows()
+
+    expected = defaultdict(int)
+    for tx in documents:
+        expected[tx["confirmationTime"].date()] += int(tx["amount"] or 0)
+    assert dict(snapshot.count_by_date(
+        TransactionsCountType.ALL, group_by=Periods.DAY,
+        fnc=TransactionsCountFnc.SUM)) == expected
+
+    volumes = defaultdict(int)
+    for tx in documents:
+        if tx["event"].endswith(("Mint", "Redeem")):
+            volumes[tx["address"].lower()] += int(tx["USDAmount"])
+    top = snapshot.top_transactors(3650, 5, 'volume')
+    assert [(a, v) for a, _, v in top] == \
+        sorted(volumes.items(), key=lambda x: -x[1])[:5]
+
+
+def test_first_load_keeps_the_last_version():
+    snapshot = columnar.Snapshot(capacity=4)
+    documents = list(generate_transactions(5, 50, 10, until=UNTIL))
+    updated = dict(documents[3], amount='7',
+                   confirmationTime=UNTIL + timedelta(days=1))
+    snapshot.append(documents[:30])
+    snapshot.append([updated] + documents[30:])
+    snapshot.index_rows()
+
+    assert snapshot.size == 50
+    assert (snapshot._ids == np.array(
+        sorted(d["_id"].binary for d in documents), 'S12')).all()
+    assert dict(snapshot.count_by_date(
+        TransactionsCountType.ALL, group_by=Periods.DAY,
+        fnc=TransactionsCountFnc.SUM, since=UNTIL.date()))[
+            UNTIL.date() + timedelta(days=1)] == 7
+
+    # and later syncs find their rows
+    snapshot.upsert([dict(updated, amount='9')])
+    assert snapshot.size == 50
+    row = snapshot._id_rows[np.searchsorted(snapshot._ids,
+                                            updated["_id"].binary)]
+    assert snapshot.column('amounts_wei')[row] == 9
@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from api import live
+from api.metrics import LIVE_SUBSCRIBERS
+from api.routers.live import live_feed
+from api.tenants import get_tenant
+
+
+ADDRESS = "0x0000000000000000000000000000000000000001"
+
+
+def subscribers():
+    return LIVE_SUBSCRIBERS._values.get((get_tenant()["name"], ), 0)
+
+
+async def stream(first_chunks):
+    """
+    Sends the live feed of ADDRESS until first_chunks chunks of its body
+    were sent, then disconnects, and returns those chunks
+    """
+    response = await live_feed(ADDRESS)
+    chunks = []
+    done = asyncio.Event()
+    if not first_chunks:
+        done.set()
+
+    async def receive():
+        await done.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.body':
+            chunks.append(message['body'])
+            if len(chunks) >= first_chunks:
+                done.set()
+
+    await response({'type': 'http', 'asgi': {'version': '3.0'},
+                    'method': 'GET', 'path': '/api/v1/webapp/live/'},
+                   receive, send)
+    return chunks
+
+
+@pytest.fixture
+def watchers():
+    yield
+    asyncio.run(live.stop_live())
+
+
+@pytest.mark.parametrize("first_chunks", [0, 1])
+def test_disconnects_leave_no_subscriber(watchers, first_chunks):
+    before = subscribers()
+
+    async def follow():
+        chunks = await stream(first_chunks)
+        # let the stream be closed, as the server would
+        await asyncio.sleep(0)
+        return chunks
+
+    chunks = asyncio.run(follow())
+    assert len(chunks) >= first_chunks
+    assert subscribers() == before
+    assert not any(w.subscriptions for w in live._watchers.values())
+
+
+def test_responses_never_sent_leave_no_subscriber(watchers):
+    before = subscribers()
+
+    async def respond():
+        await live_feed(ADDRESS)
+
+    asyncio.run(respond())
+    assert subscribers() == before
+    assert not live._watchers
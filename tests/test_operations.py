@@ -0,0 +1,137 @@
+"""
+The webapp transactions routes against a mongod (set APP_TEST_MONGO_URI, its
+APP_TEST_MONGO_DB database is dropped) or mongomock_motor. The last one has
+no collation nor expressions on find() projections, so on it the routes
+query without collation and return the documents as they are. The
+addresses are stored lowercase for both.
+"""
+import asyncio
+import json
+import os
+from datetime import datetime
+
+import pytest
+
+from api.indexes import create_indexes
+from api.models.common import ExportFormat, date_to_json
+from api.models.operations import TransactionsBatchRequest, \
+    TRANSACTIONS_FIELDS
+from api.routers import operations
+
+from benchmarks.generate import generate_transactions
+
+
+MONGO_URI = os.getenv("APP_TEST_MONGO_URI")
+MONGO_DB = os.getenv("APP_TEST_MONGO_DB", "stable_protocol_api_test")
+
+ACCOUNTS = 5
+TRANSACTIONS = 300
+DAYS = 60
+UNTIL = datetime(2024, 6, 30)
+
+
+@pytest.fixture(scope="module")
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="module")
+def addresses(loop):
+    if MONGO_URI:
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        async def connect():
+            return AsyncIOMotorClient(MONGO_URI,
+                                      serverSelectionTimeoutMS=5000)
+        client = loop.run_until_complete(connect())
+    else:
+        mongomock_motor = pytest.importorskip("mongomock_motor")
+        client = mongomock_motor.AsyncMongoMockClient()
+    db = client[MONGO_DB]
+
+    documents = []
+    for tx in generate_transactions(ACCOUNTS, TRANSACTIONS, DAYS,
+                                    until=UNTIL):
+        tx["address"] = tx["address"].lower()
+        documents.append(tx)
+
+    async def load():
+        await client.drop_database(MONGO_DB)
+        await db["Transaction"].insert_many(documents)
+        if MONGO_URI:
+            await create_indexes(db)
+    loop.run_until_complete(load())
+
+    async def get_db(name):
+        return db
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(operations, "get_db", get_db)
+        if not MONGO_URI:
+            monkeypatch.setattr(operations, "ADDRESS_COLLATION", None)
+            monkeypatch.setattr(operations, "transactions_projection",
+                                lambda fields=None: None)
+        yield sorted(set(tx["address"] for tx in documents))
+    if MONGO_URI:
+        loop.run_until_complete(client.drop_database(MONGO_DB))
+    client.close()
+
+
+def list_page(loop, address, **kwargs):
+    response = loop.run_until_complete(operations.transactions_list(
+        address=address, **dict(dict(
+            token=None, limit=20, skip=0, cursor=None, include_total=True,
+            fields=None, format=None), **kwargs)))
+    return json.loads(response.body)
+
+
+def test_batch_returns_the_list_of_each_address(loop, addresses):
+    response = loop.run_until_complete(operations.transactions_batch(
+        TransactionsBatchRequest(addresses=addresses, limit=7, merged=True)))
+    batch = json.loads(response.body)
+
+    feed = []
+    for address, account in zip(addresses, batch["accounts"]):
+        page = list_page(loop, address, limit=7)
+        assert account == dict(page, address=address)
+        feed += page["transactions"]
+        # and its cursor continues that list
+        if account["next_cursor"] is not None:
+            assert list_page(loop, address, limit=7, cursor=account[
+                "next_cursor"]) == list_page(loop, address, limit=7, skip=7)
+
+    assert any(a["next_cursor"] for a in batch["accounts"])
+    feed.sort(key=operations.feed_key, reverse=True)
+    assert batch["merged"] == feed[:7]
+
+
+def test_ndjson_line_dates_as_the_lists():
+    tx = next(generate_transactions(1, 1, 1, until=UNTIL))
+    tx["createdAt"] = tx["createdAt"].replace(microsecond=123000)
+    line = operations.ndjson_line(dict(tx))
+    assert line.endswith('\n')
+    exported = json.loads(line)
+    assert list(exported) == TRANSACTIONS_FIELDS
+    assert exported["_id"] == str(tx["_id"])
+    assert exported["createdAt"] == date_to_json(tx["createdAt"]) == \
+        tx["createdAt"].strftime('%Y-%m-%dT%H:%M:%S.123000Z')
+    assert exported["confirmationTime"] == \
+        tx["confirmationTime"].strftime('%Y-%m-%dT%H:%M:%SZ')
+    assert exported["USDInterests"] is None
+
+
+@pytest.mark.skipif(not MONGO_URI,
+                    reason="the list projection needs APP_TEST_MONGO_URI")
+def test_exported_lines_are_the_list_items(loop, addresses):
+
+    async def export(address):
+        response = await operations.transactions_export(
+            address=address, token=None, format=ExportFormat.NDJSON)
+        return ''.join([chunk async for chunk in response.body_iterator])
+
+    for address in addresses:
+        page = list_page(loop, address, limit=1000)
+        lines = loop.run_until_complete(export(address)).splitlines()
+        assert [json.loads(line) for line in lines] == page["transactions"]
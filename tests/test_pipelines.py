@@ -0,0 +1,163 @@
+"""
+The pipelines of api.pipelines against the transactions_base of the
+baseline commit, read from the git history: every combination of the
+parameters it took has to return the very same buckets. On a mongod (set
+APP_TEST_MONGO_URI, its APP_TEST_MONGO_DB database is dropped) every
+combination, date ranges included, has to be planned over an index.
+Without it they run against mongomock_motor, which has no explain nor
+$isoWeek, so over the day and year periods only.
+"""
+import asyncio
+import importlib.util
+import itertools
+import os
+import subprocess
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+from api.indexes import create_indexes
+from api.models.stats import (Periods, TransactionsCountType,
+                              TransactionsCountToken, TransactionsCountEvent,
+                              TransactionsCountFnc)
+from api.pipelines import transactions_pipeline
+from api.routers.diagnosis import plan_values
+from api.routers.stats import check_series
+
+from benchmarks.generate import generate_transactions
+
+
+# Commit the transactions_base of api/routers/stats.py is compared with
+BASELINE_REVISION = "ed9cb3a96b10d18d0ba2b64c802ab2fd25e46bf2"
+
+MONGO_URI = os.getenv("APP_TEST_MONGO_URI")
+MONGO_DB = os.getenv("APP_TEST_MONGO_DB", "stable_protocol_api_test")
+
+# Synthetic documents, sorted by createdAt and one case per address, so the
+# $first of the baseline is the earliest transaction of each address
+UNTIL = datetime(2024, 6, 30)
+ACCOUNTS = 200
+TRANSACTIONS = 1000
+DAYS = 730
+
+PERIODS = list(Periods) if MONGO_URI else [Periods.DAY, Periods.YEAR]
+RANGES = [(None, None),
+          (UNTIL.date() - timedelta(days=DAYS // 2), None),
+          (UNTIL.date() - timedelta(days=DAYS // 2),
+           UNTIL.date() - timedelta(days=DAYS // 4))]
+
+
+def combinations(periods):
+    for spec in itertools.product(
+            TransactionsCountType, TransactionsCountToken,
+            TransactionsCountEvent, periods, TransactionsCountFnc):
+        try:
+            check_series(spec[0], spec[1], spec[2], spec[4])
+        except HTTPException:
+            continue
+        yield spec
+
+
+def spec_id(spec):
+    return ':'.join(v.value if hasattr(v, 'value') else str(v)
+                    for v in spec)
+
+
+@pytest.fixture(scope="module")
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="module")
+def db(loop):
+    if MONGO_URI:
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        async def connect():
+            return AsyncIOMotorClient(MONGO_URI,
+                                      serverSelectionTimeoutMS=5000)
+        client = loop.run_until_complete(connect())
+    else:
+        mongomock_motor = pytest.importorskip("mongomock_motor")
+        client = mongomock_motor.AsyncMongoMockClient()
+    db = client[MONGO_DB]
+
+    async def load():
+        await client.drop_database(MONGO_DB)
+        await db["Transaction"].insert_many(list(generate_transactions(
+            ACCOUNTS, TRANSACTIONS, DAYS, until=UNTIL)))
+        if MONGO_URI:
+            await create_indexes(db)
+
+    loop.run_until_complete(load())
+    yield db
+    if MONGO_URI:
+        loop.run_until_complete(client.drop_database(MONGO_DB))
+    client.close()
+
+
+@pytest.fixture(scope="module")
+def baseline(db):
+    """
+    The api.routers.stats module of the baseline commit, reading db
+    """
+    try:
+        source = subprocess.run(
+            ["git", "show", f"{BASELINE_REVISION}:api/routers/stats.py"],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True, check=True, text=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        pytest.skip(f"The baseline {BASELINE_REVISION} is not in the history")
+
+    spec = importlib.util.spec_from_loader("api.routers.baseline_stats",
+                                           loader=None)
+    module = importlib.util.module_from_spec(spec)
+    module.__package__ = "api.routers"
+    exec(compile(source, "baseline/api/routers/stats.py", "exec"),
+         module.__dict__)
+
+    async def get_db():
+        return db
+    module.get_db = get_db
+    return module
+
+
+async def current_values(db, spec, from_=None, to=None):
+    """
+    The accounts of transactions_base, from transactions_pipeline
+    """
+    if spec[4]==TransactionsCountFnc.COUNT:
+        transform_count = lambda x: float(str(x))
+    else:
+        transform_count = lambda x: float(str(x))/(10**18)
+    rows = await db["Transaction"].aggregate(
+        list(transactions_pipeline(*spec, from_, to))).to_list(length=None)
+    return [{'date': r['_id'], 'count': transform_count(r['count'])}
+            for r in rows]
+
+
+@pytest.mark.parametrize("spec", list(combinations(PERIODS)), ids=spec_id)
+def test_same_buckets_as_baseline(loop, db, baseline, spec):
+    expected = loop.run_until_complete(baseline.transactions_base(*spec))
+    assert loop.run_until_complete(current_values(db, spec)) == \
+        expected["accounts"]
+
+
+@pytest.mark.skipif(not MONGO_URI, reason="explain needs APP_TEST_MONGO_URI")
+@pytest.mark.parametrize("spec", [
+    spec + bounds for spec, bounds in itertools.product(
+        combinations(PERIODS), RANGES)], ids=spec_id)
+def test_planned_over_an_index(loop, db, spec):
+    plan = loop.run_until_complete(db.command('explain', {
+        'aggregate': "Transaction",
+        'pipeline': list(transactions_pipeline(*spec)),
+        'cursor': {}
+    }, verbosity='queryPlanner'))
+    stages = []
+    for winning_plan in plan_values(plan, 'winningPlan'):
+        stages += plan_values(winning_plan, 'stage')
+    assert 'COLLSCAN' not in stages
+    assert 'IXSCAN' in stages